@@ -0,0 +1,223 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# Multi-scale LoG detector of nanoparticles, as Detection/LoG.m.
+#
+# The image is smoothed by a Gaussian and filtered by scale-normalized
+# LoG kernels, one per radius of Rmin:step:Rmax. The maximum over scales
+# (and the radius giving it) is smoothed again; its regional maxima that
+# are also maxima over a disk and above the threshold are the
+# detections, once those whose disk leaves the image are dropped.
+#
+# Filters follow imfilter: correlation, kernels of even size centred on
+# their element size/2 - 1, and the same border modes ('symmetric' is
+# ndimage's 'reflect', 'replicate' its 'nearest'). Every kernel is
+# applied as separable 1-D passes, or through the FFT when it is not
+# separable. Coordinates are 1-based, as those LoG.m gives.
+# ------------------------------------------------------------------------------------
+import os, sys
+import numpy
+from scipy import ndimage
+from scipy.signal import fftconvolve
+import cv2
+
+lib_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '../TL/'))
+sys.path.append(lib_path)
+from parallel import get_pool
+
+# 8-connected neighbours of a pixel
+NEIGHBOURS = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if (dy, dx) != (0, 0)]
+
+def kernel_origin(hsize):
+    """ ndimage origin of a kernel of size `hsize` centred as by imfilter """
+    return (hsize - 1) / 2 - hsize / 2
+
+def gaussian_kernel(hsize, sigma):
+    """ 1-D factor of fspecial('gaussian', hsize, sigma) """
+    x = numpy.arange(hsize) - (hsize - 1) / 2.
+    g = numpy.exp(-x * x / (2. * sigma * sigma))
+    return g / g.sum()
+
+def separable_filter(img, ky, kx, mode):
+    """ imfilter(img, ky' * kx) """
+    out = ndimage.correlate1d(img, ky, axis=0, mode=mode, origin=kernel_origin(len(ky)))
+    return ndimage.correlate1d(out, kx, axis=1, mode=mode, origin=kernel_origin(len(kx)))
+
+def fft_filter(img, h):
+    """ imfilter(img, h, 'replicate') of any 2-D kernel, through the FFT """
+    (hy, hx) = h.shape
+    (cy, cx) = ((hy - 1) / 2, (hx - 1) / 2)
+    padded = numpy.pad(img, ((cy, hy - 1 - cy), (cx, hx - 1 - cx)), mode='edge')
+    return fftconvolve(padded, h[::-1, ::-1], mode='valid')
+
+def log_filter(img, s, signal):
+    """ imfilter(img, s^2 * signal * fspecial('log', round(5*s), s), 'replicate')
+
+    The kernel of fspecial, g(y)g(x)(x^2+y^2-2s^2)/s^4 less its mean, is
+    q(y)g(x) + g(y)q(x) - mean, with q(x) = g(x)(x^2-s^2)/s^4: two
+    separable filters and a box filter. With signal 2 (the absolute value
+    of the kernel) it is not separable any more.
+    """
+    hsize = int(round(5 * s))
+    s2    = float(s * s)
+    x     = numpy.arange(hsize) - (hsize - 1) / 2.
+    g     = gaussian_kernel(hsize, s)
+    q     = g * (x * x - s2) / (s2 * s2)
+    mean  = 2 * q.sum() / (hsize * hsize)
+
+    if signal == 2:
+        h = numpy.abs(s2 * (numpy.outer(q, g) + numpy.outer(g, q) - mean))
+        return fft_filter(img, h)
+
+    ones = numpy.ones((hsize,))
+    resp = separable_filter(img, q, g, 'nearest') + separable_filter(img, g, q, 'nearest') \
+           - mean * separable_filter(img, ones, ones, 'nearest')
+    return signal * s2 * resp
+
+def regional_maxima(f):
+    """ imregionalmax(f): 8-connected plateaus whose neighbours are all
+    lower """
+    peak = ndimage.maximum_filter(f, size=3, mode='constant', cval=-numpy.inf) == f
+
+    # a plateau of peaks is not a regional maximum when it goes on with
+    # pixels that are not peaks (they have a higher neighbour)
+    (h, w)  = f.shape
+    f_pad   = numpy.pad(f, 1, mode='constant', constant_values=numpy.nan)
+    low_pad = numpy.pad(~peak, 1, mode='constant', constant_values=False)
+    tainted = numpy.zeros(f.shape, dtype=numpy.bool)
+    for (dy, dx) in NEIGHBOURS:
+        tainted |= (f_pad[1+dy:1+dy+h, 1+dx:1+dx+w] == f) & low_pad[1+dy:1+dy+h, 1+dx:1+dx+w]
+
+    (labels, n) = ndimage.label(peak, structure=numpy.ones((3,3)))
+    bad = numpy.unique(labels[tainted & peak])
+    return peak & ~numpy.in1d(labels.ravel(), bad).reshape(f.shape)
+
+def disk(radius):
+    """ Footprint of strel('disk', radius, 0) """
+    (y, x) = numpy.ogrid[-radius:radius+1, -radius:radius+1]
+    return x * x + y * y <= radius * radius
+
+def log_detector(im, Rmin, Rmax, step, sigma, th, disk_size, mask=None, signal=1):
+    """ Detections of LoG(im, Rmin, Rmax, step, sigma, th, disk_size, mask, signal)
+
+    signal: -1 white color cells
+            +1 black color cells
+             2 abs
+
+    Returns a dict of arrays 'x', 'y', 'radius' and 'resp', ordered by
+    decreasing response.
+    """
+    img = numpy.asarray(im, dtype=numpy.float64)
+    (rows, cols) = img.shape
+    if mask is None:
+        mask = numpy.ones(img.shape)
+
+    g   = gaussian_kernel(int(round(5 * sigma)), sigma)
+    img = separable_filter(img, g, g, 'reflect')
+
+    # Rmin:step:Rmax
+    nscales = int(numpy.floor((Rmax - Rmin) / float(step) + 1e-10)) + 1
+    radii   = Rmin + step * numpy.arange(nscales)
+
+    # maximum over scales, and the radius of the first scale reaching it
+    for (k, r) in enumerate(radii):
+        result = log_filter(img, int(round(r / 1.5)), signal)
+        if k == 0:
+            Cxy    = result
+            radius = numpy.empty(img.shape)
+            radius.fill(r)
+        else:
+            better = result > Cxy
+            Cxy[better]    = result[better]
+            radius[better] = r
+
+    g     = gaussian_kernel(10, 1.4)
+    Cxy_g = separable_filter(Cxy, g, g, 'reflect')
+
+    ir_max = regional_maxima(Cxy_g) * Cxy_g * mask
+    ir_med = ndimage.grey_dilation(ir_max, footprint=disk(disk_size), mode='constant', cval=-numpy.inf)
+    ir_max = (ir_med == ir_max) * ir_max
+
+    # column-major order, as find
+    (c, r) = numpy.nonzero((ir_max > th).T)
+    rdx    = radius[r, c]
+    (x, y) = (c + 1, r + 1)
+    inside = (x - rdx > 0) & (y - rdx > 0) & (x + rdx < cols) & (y + rdx < rows)
+    (x, y, rdx) = (x[inside], y[inside], rdx[inside])
+    resp   = ir_max[y - 1, x - 1]
+
+    order = numpy.argsort(-resp, kind='mergesort')
+    return {'x': x[order], 'y': y[order], 'radius': rdx[order], 'resp': resp[order]}
+
+def detect_image(filename, nanoparticle_size, th, resize=1.):
+    """ Detections of the image `filename`, as the log_detector method
+    of RUN_goldNanoparticlesCounter.m (without mask)
+
+    imresize is bicubic and antialiased when it shrinks; cv2 has no such
+    filter, the image is shrunk by pixel area averaging instead (enlarged
+    bicubic). With resize != 1 the candidates are close to, but not
+    always the same as, the ones of the MATLAB pipeline.
+    """
+    im = cv2.imread(filename)
+    if resize > 1:
+        im = cv2.resize(im, (0,0), fx=1./resize, fy=1./resize, interpolation=cv2.INTER_AREA)
+    elif resize < 1:
+        im = cv2.resize(im, (0,0), fx=1./resize, fy=1./resize, interpolation=cv2.INTER_CUBIC)
+    # first channel in matlab (red)
+    im = im[:,:,2]
+
+    size = nanoparticle_size / float(resize)
+    step = 1. / resize
+    sp   = log_detector(im, size - step, size + step, step, 1, th, int(numpy.floor(size * 0.9)))
+
+    # spots over the scale bar, always at the same place
+    (rows, cols) = im.shape
+    keep = ~((sp['x'] < .1 * cols) & (sp['y'] > .9 * rows))
+    return dict((k, v[keep]) for (k, v) in sp.items())
+
+def _detect_image(args):
+    return detect_image(*args)
+
+def detect_images(filenames, nanoparticle_size, th, resize=1., nworkers=1):
+    """ detect_image of every file, by `nworkers` processes at once """
+    tasks = [(f, nanoparticle_size, th, resize) for f in filenames]
+    if nworkers <= 1:
+        return map(_detect_image, tasks)
+
+    pool = get_pool(min(nworkers, len(tasks)), 1)
+    detections = pool.map(_detect_image, tasks)
+    pool.close()
+    pool.join()
+    return detections
+
+def print_usage():
+    print './log_detector.py nanoparticle_size threshold image [image ...]'
+
+if __name__ == '__main__':
+    if len(os.sys.argv) < 4:
+        print_usage()
+        os.sys.exit(-1)
+
+    filenames = os.sys.argv[3:]
+    for (f, sp) in zip(filenames, detect_images(filenames, float(os.sys.argv[1]), float(os.sys.argv[2]),
+                                                nworkers=len(filenames))):
+        print "{0:s}: {1:d} detections".format(f, len(sp['x']))
@@ -34,6 +34,7 @@ import gzip
 import os
 import sys
 import time
+import tempfile
 
 import itertools, numpy
 
@@ -46,6 +47,44 @@ from logistic_sgd import LogisticRegression
 from mlp import HiddenLayer
 from dA import dA
 
+# uint8 patches are grey levels, normalized as shared_store does float ones
+GREY_SCALE = 255 + 0.001
+
+def decode_input(data_x):
+    ''' floatX input of the model from (a slice of) the stored data
+
+    uint8 patches are converted and normalized inside the graph, one
+    minibatch at a time, so the data itself stays in uint8.
+    '''
+    if data_x.dtype == 'uint8':
+        return T.cast(data_x, theano.config.floatX) / numpy.asarray(GREY_SCALE, dtype=theano.config.floatX)
+    return data_x
+
+def dataset_rows(dataset):
+    ''' (x, y, rows) of a dataset, given either as a pair (x, y) of shared
+    variables or as a triple (x, y, rows) where the int32 shared vector
+    `rows` selects the samples of x and y; rows is None for a pair '''
+    if len(dataset) == 3:
+        return tuple(dataset)
+    return (dataset[0], dataset[1], None)
+
+def take_rows(data, rows, begin, end):
+    ''' Symbolic samples begin:end of `data`, gathered through `rows` when
+    given '''
+    if rows is None:
+        return data[begin:end]
+    return data[rows[begin:end]]
+
+def dataset_size(dataset):
+    ''' Number of samples of a dataset (read from the shared variables) '''
+    if hasattr(dataset, 'nsamples'):
+        # streamed, see streaming.StreamingSet
+        return dataset.nsamples
+    (set_x, set_y, rows) = dataset_rows(dataset)
+    if rows is None:
+        return set_x.get_value(borrow=True).shape[0]
+    return rows.get_value(borrow=True).shape[0]
+
 
 class SdA(object):
     """Stacked denoising auto-encoder class (SdA)
@@ -91,6 +130,9 @@ class SdA(object):
         self.params = []
         self.params_b = []
         self.n_layers = len(hidden_layers_sizes)
+        self.n_ins = n_ins
+        self.hidden_layers_sizes = hidden_layers_sizes
+        self.n_outs = n_outs
 
         assert self.n_layers > 0
 
@@ -213,9 +255,94 @@ class SdA(object):
         self.finetune_cost_b = self.logLayer_b.negative_log_likelihood(self.y)
         self.errors_b = self.logLayer_b.errors(self.y)
 
+    def reset_params(self, numpy_rng):
+        ''' Draws a new set of initial weights, exactly as the constructor
+        does, without rebuilding the graph. Functions compiled for this
+        model remain valid, so it can be reused for a new training job.
+
+        :type numpy_rng: numpy.random.RandomState
+        :param numpy_rng: numpy random number generator used to draw initial
+                    weights
+        '''
+        for sigmoid_layer, dA_layer in zip(self.sigmoid_layers, self.dA_layers):
+            (n_in, n_out) = sigmoid_layer.W.get_value(borrow=True).shape
+
+            # same initialisation as HiddenLayer for a sigmoid activation
+            W_values = numpy.asarray(numpy_rng.uniform(
+                low=-numpy.sqrt(6. / (n_in + n_out)),
+                high=numpy.sqrt(6. / (n_in + n_out)),
+                size=(n_in, n_out)), dtype=theano.config.floatX)
+            W_values *= 4
+
+            sigmoid_layer.W.set_value(W_values, borrow=True)
+            sigmoid_layer.b.set_value(numpy.zeros((n_out,), dtype=theano.config.floatX), borrow=True)
+            dA_layer.b_prime.set_value(numpy.zeros((n_in,), dtype=theano.config.floatX), borrow=True)
+
+        for logLayer in [self.logLayer, self.logLayer_b]:
+            for param in logLayer.params:
+                param.set_value(numpy.zeros_like(param.get_value(borrow=True)), borrow=True)
+
+    def model_variables(self):
+        ''' Every shared variable of the model: hidden layers, both
+        logistic layers and the visible biases of the dAs '''
+        variables = []
+        for var in self.params + self.params_b + [dA.b_prime for dA in self.dA_layers]:
+            if not any(var is v for v in variables):
+                variables.append(var)
+        return variables
+
+    def snapshot(self, values=None):
+        ''' Copies the current parameter values (or `values`, as returned
+        by snapshot_values) into preallocated numpy buffers, e.g. to keep
+        the best model during finetuning.
+
+        Two buffers are used in turn: the copy goes to the spare one, which
+        only then becomes the current snapshot, so an interrupted copy never
+        corrupts the last good one. No object is cloned and nothing is
+        recompiled.
+        '''
+        if values is None:
+            values = [var.get_value(borrow=True) for var in self.model_variables()]
+
+        if getattr(self, '_snapshot', None) is None or \
+           [b.shape for b in self._snapshot['buffers'][0]] != [v.shape for v in values]:
+            self._snapshot = {
+                'buffers': [[numpy.empty_like(v) for v in values] for k in range(2)],
+                'current': None,
+            }
+
+        if self._snapshot['current'] == 0:
+            spare = 1
+        else:
+            spare = 0
+        for buf, value in zip(self._snapshot['buffers'][spare], values):
+            numpy.copyto(buf, value)
+        self._snapshot['current'] = spare
+
+    def snapshot_values(self):
+        ''' Values of the current snapshot (not copied), or None '''
+        if getattr(self, '_snapshot', None) is None or self._snapshot['current'] is None:
+            return None
+        return self._snapshot['buffers'][self._snapshot['current']]
+
+    def restore_snapshot(self, values=None):
+        ''' Copies the snapshot (or `values`, as returned by
+        snapshot_values) back into the live model '''
+        if values is None:
+            values = self.snapshot_values()
+        if values is None:
+            return
+
+        for var, value in zip(self.model_variables(), values):
+            var.set_value(value, borrow=False)
+
+    def __getstate__(self):
+        # snapshot buffers are not part of a saved model
+        state = self.__dict__.copy()
+        state.pop('_snapshot', None)
+        return state
         
-        
-    def pretraining_functions(self, train_set_x, batch_size, tau):
+    def pretraining_functions(self, train_set_x, batch_size, tau, train_rows=None):
         ''' Generates a list of functions, each of them implementing one
         step in trainnig the dA corresponding to the layer with same index.
         The function will require as input the minibatch index, and to train
@@ -229,6 +356,10 @@ class SdA(object):
         :type batch_size: int
         :param batch_size: size of a [mini]batch
 
+        :type train_rows: theano.tensor.TensorType
+        :param train_rows: int32 shared vector with the rows of train_set_x
+                           to train on, or None for all of them
+
         :type learning_rate: float
         :param learning_rate: learning rate used during training for any of
                               the dA layers
@@ -257,62 +388,195 @@ class SdA(object):
                               theano.Param(learning_rate, default=0.1)],
                                  outputs=[cost],
                                  updates=updates,
-                                 givens={self.x: train_set_x[batch_begin:
-                                                             batch_end]})
+                                 givens={self.x: decode_input(take_rows(train_set_x, train_rows,
+                                                                        batch_begin, batch_end))})
             # append `fn` to the list of functions
             pretrain_fns.append(fn)
 
         return pretrain_fns
 
+    def cached_pretraining_functions(self, train_set_x, batch_size, tau,
+                                     encode_batch_size=5000, train_rows=None):
+        ''' Same as pretraining_functions, except that the dA of layer `i`
+        trains on a cached copy of the hidden representation of layer
+        `i-1`, instead of running the frozen layers below on every
+        minibatch of every epoch.
+
+        Returns the list of pretraining functions and a function
+        `encode(i, folder=None)`, to be called after layer `i-1` is trained
+        and before layer `i` is. It computes the representation of the
+        whole training set through layer `i-1`, once, and makes it the
+        input of layer `i`. The representation is kept in memory, or in a
+        memory-mapped (anonymous) file of `folder`.
+
+        :type encode_batch_size: int
+        :param encode_batch_size: samples encoded by each call
+        '''
 
-    def build_test_function(self, dataset, batch_size):
-        (test_set_x, test_set_y) = dataset
+        # index to a [mini]batch
+        index = T.lscalar('index')  # index to a minibatch
+        corruption_level = T.scalar('corruption')  # % of corruption to use
+        learning_rate = T.scalar('lr')  # learning rate to use
 
-        n_test_batches  = test_set_x.get_value(borrow=True).shape[0]
-        n_test_batches /= batch_size
+        # begining of a batch, given `index`
+        batch_begin = index * batch_size
+        # ending of a batch given `index`
+        batch_end = batch_begin + batch_size
+
+        # input of each layer: the training set, then the cached
+        # representations (in the order of train_rows)
+        layer_inputs = [train_set_x]
+        layer_rows   = [train_rows]
+        for n_hidden in self.hidden_layers_sizes[:-1]:
+            layer_inputs.append(theano.shared(numpy.zeros((0, int(n_hidden)),
+                                                          dtype=theano.config.floatX),
+                                              borrow=True))
+            layer_rows.append(None)
 
+        pretrain_fns = []
+        encode_fns   = []
+        for i, dA in enumerate(self.dA_layers):
+            x_i = T.matrix('x_{0:d}'.format(i))
+
+            cost, updates, y, z, L, h = dA.get_cost_updates(corruption_level,
+                                                learning_rate, tau, input=x_i)
+            fn = theano.function(inputs=[index,
+                              theano.Param(corruption_level, default=0.2),
+                              theano.Param(learning_rate, default=0.1)],
+                                 outputs=[cost],
+                                 updates=updates,
+                                 givens={x_i: decode_input(take_rows(layer_inputs[i], layer_rows[i],
+                                                                     batch_begin, batch_end))})
+            pretrain_fns.append(fn)
+
+            # clean (uncorrupted) representation, as seen by the layer above
+            encode_fns.append(theano.function(inputs=[index],
+                                 outputs=dA.get_hidden_values(x_i)[0],
+                                 givens={x_i: decode_input(take_rows(layer_inputs[i], layer_rows[i],
+                                                                     index * encode_batch_size,
+                                                                     (index + 1) * encode_batch_size))}))
+
+        def encode(i, folder=None):
+            assert 0 < i < self.n_layers
+
+            nsamples  = dataset_size((layer_inputs[i-1], None, layer_rows[i-1]))
+            n_batches = (nsamples + encode_batch_size - 1) / encode_batch_size
+            shape     = (nsamples, int(self.hidden_layers_sizes[i-1]))
+
+            if folder is None:
+                data = numpy.empty(shape, dtype=theano.config.floatX)
+            else:
+                # the file is unlinked at once, the mapping outlives it
+                with tempfile.TemporaryFile(dir=folder) as f:
+                    data = numpy.memmap(f, dtype=theano.config.floatX, mode='w+', shape=shape)
+
+            for batch_index in xrange(n_batches):
+                data[batch_index * encode_batch_size:
+                     (batch_index + 1) * encode_batch_size] = encode_fns[i-1](batch_index)
+
+            layer_inputs[i].set_value(numpy.asarray(data), borrow=True)
+            # the layer below is trained, its own input is no longer needed
+            if i > 1:
+                layer_inputs[i-1].set_value(numpy.zeros((0, int(self.hidden_layers_sizes[i-2])),
+                                                        dtype=theano.config.floatX), borrow=True)
+
+        return (pretrain_fns, encode)
+
+    def reconstruction_functions(self, dataset_x, batch_size, rows=None):
+        ''' Generates, for each dA, a function returning its mean
+        reconstruction cost (cross-entropy, no corruption) over the whole
+        of `dataset_x`, e.g. a held-out set to monitor pretraining.
+
+        :type dataset_x: theano.tensor.TensorType
+        :param dataset_x: Shared variable with the datapoints
+
+        :type rows: theano.tensor.TensorType
+        :param rows: int32 shared vector with the rows of dataset_x to
+                     use, or None for all of them
+
+        :type batch_size: int
+        :param batch_size: number of samples evaluated by each call to the
+                           compiled function
+        '''
         index = T.lscalar('index')  # index to a [mini]batch
-        
-        test_score_i = theano.function([index], self.errors,
-                 givens={
-                   self.x: test_set_x[index * batch_size:
-                                      (index + 1) * batch_size],
-                   self.y: test_set_y[index * batch_size:
-                                      (index + 1) * batch_size]},
-                      name='test')
-
-        prediction_i = theano.function([index], outputs=self.logLayer.y_pred,
-                 givens={
-                   self.x: test_set_x[index * batch_size:
-                                      (index + 1) * batch_size]},
-                      name='pred')
-
-        prediction_prob_i = theano.function([index], outputs=self.logLayer.p_y_given_x,
-                                            givens={
-                                                self.x: test_set_x[index * batch_size:
-                                                                   (index + 1) * batch_size]},
-                                            name='pred_prob')
-        
-        y_test_i = theano.function([index], outputs=test_set_y[index * batch_size:
-                                                               (index + 1) * batch_size],
-                                      name = 'test')
-                
-        # Create a function that scans the entire test set
-        def test_score():
-            preds  = [prediction_i(i).tolist() for i in xrange(n_test_batches)]
-            y_pred = list(itertools.chain(*preds))
-
-            probs  = [prediction_prob_i(i).tolist() for i in xrange(n_test_batches)]
-            y_pred_prob = numpy.array( list(itertools.chain(*probs)) )
-
-            y_test_fnt = [y_test_i(i).tolist() for i in xrange(n_test_batches)]
-            y_test     = numpy.array( list(itertools.chain(*y_test_fnt)) )
-            
-            return (y_test, y_pred, y_pred_prob)
-            
-        return test_score
+
+        recon_fns = []
+        for dA in self.dA_layers:
+            y = dA.get_hidden_values(dA.x)[0]
+            z = dA.get_reconstructed_input(y)
+            L = - T.sum(dA.x * T.log(z) + (1 - dA.x) * T.log(1 - z), axis=1)
+
+            batch_i = theano.function([index], outputs=T.sum(L),
+                                      givens={self.x: decode_input(take_rows(dataset_x, rows,
+                                                                             index * batch_size,
+                                                                             (index + 1) * batch_size))})
+
+            def recon(batch_i=batch_i):
+                nsamples  = dataset_size((dataset_x, None, rows))
+                n_batches = (nsamples + batch_size - 1) / batch_size
+                total     = sum(batch_i(k) for k in xrange(n_batches))
+                return total / max(nsamples, 1)
+
+            recon_fns.append(recon)
+
+        return recon_fns
+
+
+    def build_test_function(self, dataset, batch_size):
+        ''' Generates a function that scans the entire test set and returns
+        the labels, the predictions and the class probabilities
+
+        :type dataset: pair of theano.tensor.TensorType
+        :param dataset: datapoints and labels of the test set
+
+        :type batch_size: int
+        :param batch_size: number of samples evaluated by each call to the
+                           compiled function; use a large one
+        '''
+        return self.build_scan_function(dataset, batch_size, self.logLayer, name='test')
 
     
+    def build_scan_function(self, dataset, batch_size, logLayer, name):
+        ''' Compiles one function returning labels, argmax and
+        probabilities of a batch together, and wraps it in a function that
+        scans the whole set into preallocated numpy arrays.
+
+        The last batch is simply shorter (the slices are clipped as in
+        numpy), so no sample is dropped.
+        '''
+        (set_x, set_y, rows) = dataset_rows(dataset)
+
+        index = T.lscalar('index')  # index to a [mini]batch
+
+        batch_i = theano.function([index],
+                                  outputs=[take_rows(set_y, rows, index * batch_size,
+                                                     (index + 1) * batch_size),
+                                           logLayer.y_pred,
+                                           logLayer.p_y_given_x],
+                                  givens={
+                                      self.x: decode_input(take_rows(set_x, rows, index * batch_size,
+                                                                     (index + 1) * batch_size))},
+                                  name=name)
+
+        n_outs = logLayer.b.get_value(borrow=True).shape[0]
+
+        def scan():
+            # the size is read at call time, so the shared variables may
+            # be given new values between calls
+            nsamples  = dataset_size(dataset)
+            n_batches = (nsamples + batch_size - 1) / batch_size
+
+            y_set       = numpy.empty((nsamples,), dtype=numpy.int32)
+            y_pred      = numpy.empty((nsamples,), dtype=numpy.int64)
+            y_pred_prob = numpy.empty((nsamples,n_outs), dtype=theano.config.floatX)
+            for i in xrange(n_batches):
+                batch = slice(i * batch_size, (i + 1) * batch_size)
+                (y_set[batch], y_pred[batch], y_pred_prob[batch]) = batch_i(i)
+
+            return (y_set, y_pred, y_pred_prob)
+
+        return scan
+
     def build_finetune_functions(self, datasets, batch_size, learning_rate):
         '''Generates a function `train` that implements one step of
         finetuning, a function `validate` that computes the error on
@@ -330,17 +594,14 @@ class SdA(object):
         :param batch_size: size of a minibatch
 
         :type learning_rate: float
-        :param learning_rate: learning rate used during finetune stage
+        :param learning_rate: default learning rate used during finetune
+                              stage; `train` accepts another one via `lr`
         '''
 
-        (train_set_x, train_set_y) = datasets[0]
-        (valid_set_x, valid_set_y) = datasets[1]
-
-        # compute number of minibatches for training, validation and testing
-        n_valid_batches = valid_set_x.get_value(borrow=True).shape[0]
-        n_valid_batches /= batch_size
+        (train_set_x, train_set_y, train_rows) = dataset_rows(datasets[0])
 
         index = T.lscalar('index')  # index to a [mini]batch
+        lr    = T.scalar('lr')      # learning rate, an input of `train`
 
         # compute the gradients with respect to the model parameters
         gparams = T.grad(self.finetune_cost, self.params)
@@ -348,100 +609,35 @@ class SdA(object):
         # compute list of fine-tuning updates
         updates = []
         for param, gparam in zip(self.params, gparams):
-            updates.append((param, param - gparam * learning_rate))
+            updates.append((param, param - gparam * lr))
 
-        train_fn = theano.function(inputs=[index],
+        train_fn = theano.function(inputs=[index,
+                                           theano.Param(lr, default=learning_rate)],
               outputs=self.finetune_cost,
               updates=updates,
               givens={
-                self.x: train_set_x[index * batch_size:
-                                    (index + 1) * batch_size],
-                self.y: train_set_y[index * batch_size:
-                                    (index + 1) * batch_size]})
-        
-        valid_score_i = theano.function([index], self.errors,
-              givens={
-                 self.x: valid_set_x[index * batch_size:
-                                     (index + 1) * batch_size],
-                 self.y: valid_set_y[index * batch_size:
-                                     (index + 1) * batch_size]})
-
-        prediction_i = theano.function([index], outputs=self.logLayer.y_pred,
-                                       givens={
-                                           self.x: valid_set_x[index * batch_size:
-                                                              (index + 1) * batch_size]},
-                                       name='pred')
-
-        prediction_prob_i = theano.function([index], outputs=self.logLayer.p_y_given_x,
-                                            givens={
-                                                self.x: valid_set_x[index * batch_size:
-                                                                   (index + 1) * batch_size]},
-                                            name='pred_prob')
-        y_valid_i = theano.function([index], outputs=valid_set_y[index * batch_size:
-                                                                   (index + 1) * batch_size],
-                                      name = 'valid')
+                self.x: decode_input(take_rows(train_set_x, train_rows, index * batch_size,
+                                               (index + 1) * batch_size)),
+                self.y: take_rows(train_set_y, train_rows, index * batch_size,
+                                  (index + 1) * batch_size)})
         
         # Create a function that scans the entire validation set
-        def valid_score():
-            # return [valid_score_i(i) for i in xrange(n_valid_batches)]
-            preds  = [prediction_i(i).tolist() for i in xrange(n_valid_batches)]
-            y_pred = list(itertools.chain(*preds))
-            probs  = [prediction_prob_i(i).tolist() for i in xrange(n_valid_batches)]
-            y_pred_prob = numpy.array( list(itertools.chain(*probs)) )
-
-            y_valid_fnt = [y_valid_i(i).tolist() for i in xrange(n_valid_batches)]
-            y_valid     = numpy.array( list(itertools.chain(*y_valid_fnt)) )
-            
-            return (y_valid, y_pred, y_pred_prob)
+        valid_score = self.build_scan_function(datasets[1], batch_size, self.logLayer, name='valid')
 
         return train_fn, valid_score
     
     def build_test_function_reuse(self, dataset, batch_size):
-        (test_set_x, test_set_y) = dataset
+        ''' Generates a function that scans the entire test set and returns
+        the labels, the predictions and the class probabilities
 
-        n_test_batches  = test_set_x.get_value(borrow=True).shape[0]
-        n_test_batches /= batch_size
+        :type dataset: pair of theano.tensor.TensorType
+        :param dataset: datapoints and labels of the test set
 
-        index = T.lscalar('index')  # index to a [mini]batch
-
-        test_score_i = theano.function([index], self.errors_b,
-                 givens={
-                   self.x: test_set_x[index * batch_size:
-                                      (index + 1) * batch_size],
-                   self.y: test_set_y[index * batch_size:
-                                      (index + 1) * batch_size]},
-                      name='test')
-
-        prediction_i = theano.function([index], outputs=self.logLayer_b.y_pred,
-                 givens={
-                   self.x: test_set_x[index * batch_size:
-                                      (index + 1) * batch_size]},
-                      name='pred')
-
-        prediction_prob_i = theano.function([index], outputs=self.logLayer_b.p_y_given_x,
-                                            givens={
-                                                self.x: test_set_x[index * batch_size:
-                                                                   (index + 1) * batch_size]},
-                                            name='pred_prob')
-        
-        y_test_i = theano.function([index], outputs=test_set_y[index * batch_size:
-                                                               (index + 1) * batch_size],
-                                      name = 'test')
-                
-        # Create a function that scans the entire test set
-        def test_score():
-            preds  = [prediction_i(i).tolist() for i in xrange(n_test_batches)]
-            y_pred = list(itertools.chain(*preds))
-
-            probs  = [prediction_prob_i(i).tolist() for i in xrange(n_test_batches)]
-            y_pred_prob = numpy.array( list(itertools.chain(*probs)) )
-
-            y_test_fnt = [y_test_i(i).tolist() for i in xrange(n_test_batches)]
-            y_test     = numpy.array( list(itertools.chain(*y_test_fnt)) )
-            
-            return (y_test, y_pred, y_pred_prob)
-            
-        return test_score
+        :type batch_size: int
+        :param batch_size: number of samples evaluated by each call to the
+                           compiled function; use a large one
+        '''
+        return self.build_scan_function(dataset, batch_size, self.logLayer_b, name='test')
 
     def build_finetune_functions_reuse(self, datasets, batch_size, learning_rate, update_layerwise):
         '''Generates a function `train` that implements one step of
@@ -460,20 +656,15 @@ class SdA(object):
         :param batch_size: size of a minibatch
 
         :type learning_rate: float
-        :param learning_rate: learning rate used during finetune stage
+        :param learning_rate: default learning rate used during finetune
+                              stage; `train` accepts another one via `lr`
         '''
 
-        (train_set_x, train_set_y) = datasets[0]
-        (valid_set_x, valid_set_y) = datasets[1]
+        (train_set_x, train_set_y, train_rows) = dataset_rows(datasets[0])
         #(test_set_x, test_set_y) = datasets[2]
 
-        # compute number of minibatches for training, validation and testing
-        n_valid_batches = valid_set_x.get_value(borrow=True).shape[0]
-        n_valid_batches /= batch_size
-        #n_test_batches = test_set_x.get_value(borrow=True).shape[0]
-        #n_test_batches /= batch_size
-
         index = T.lscalar('index')  # index to a [mini]batch
+        lr    = T.scalar('lr')      # learning rate, an input of `train`
 
         # compute the gradients with respect to the model parameters
         gparams = T.grad(self.finetune_cost_b, self.params_b)
@@ -495,58 +686,25 @@ class SdA(object):
                 # print >> sys.stderr, 'no change at layer ', layer_num/2
             elif update == 1:
                 if layer_num % 2 == 0: # even for weights
-                    updates.append((param, param - gparam * learning_rate))
+                    updates.append((param, param - gparam * lr))
                     #print 'Update weights at layer ', layer_num/2
                 else:
-                    updates.append((param, param - gparam * learning_rate))
+                    updates.append((param, param - gparam * lr))
                     #print 'update bias at layer ', layer_num/2
                 # print >> sys.stderr, 'updates at layer ', layer_num/2
 
-        train_fn = theano.function(inputs=[index],
+        train_fn = theano.function(inputs=[index,
+                                           theano.Param(lr, default=learning_rate)],
               outputs=self.finetune_cost_b,
               updates=updates,
               givens={
-                self.x: train_set_x[index * batch_size:
-                                    (index + 1) * batch_size],
-                self.y: train_set_y[index * batch_size:
-                                    (index + 1) * batch_size]})
+                self.x: decode_input(take_rows(train_set_x, train_rows, index * batch_size,
+                                               (index + 1) * batch_size)),
+                self.y: take_rows(train_set_y, train_rows, index * batch_size,
+                                  (index + 1) * batch_size)})
 
-        valid_score_i = theano.function([index], self.errors_b,
-              givens={
-                 self.x: valid_set_x[index * batch_size:
-                                     (index + 1) * batch_size],
-                 self.y: valid_set_y[index * batch_size:
-                                     (index + 1) * batch_size]})
-        
-        prediction_i = theano.function([index], outputs=self.logLayer_b.y_pred,
-                                       givens={
-                                           self.x: valid_set_x[index * batch_size:
-                                                              (index + 1) * batch_size]},
-                                       name='pred')
-
-        prediction_prob_i = theano.function([index], outputs=self.logLayer_b.p_y_given_x,
-                                            givens={
-                                                self.x: valid_set_x[index * batch_size:
-                                                                   (index + 1) * batch_size]},
-                                            name='pred_prob')
-
-        y_valid_i = theano.function([index], outputs=valid_set_y[index * batch_size:
-                                                                   (index + 1) * batch_size],
-                                      name = 'valid')
-        
         # Create a function that scans the entire validation set
-        def valid_score():
-            # return [valid_score_i(i) for i in xrange(n_valid_batches)]
-            preds  = [prediction_i(i).tolist() for i in xrange(n_valid_batches)]
-            y_pred = list(itertools.chain(*preds))
-
-            probs  = [prediction_prob_i(i).tolist() for i in xrange(n_valid_batches)]
-            y_pred_prob = numpy.array( list(itertools.chain(*probs)) )
-
-            y_valid_fnt = [y_valid_i(i).tolist() for i in xrange(n_valid_batches)]
-            y_valid     = numpy.array( list(itertools.chain(*y_valid_fnt)) )
-            
-            return (y_valid, y_pred, y_pred_prob)
+        valid_score = self.build_scan_function(datasets[1], batch_size, self.logLayer_b, name='valid')
         
 
         # # Create a function that scans the entire test set
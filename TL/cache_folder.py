@@ -0,0 +1,84 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+# ------------------------------------------------------------------------------------
+# Folders of cache entries bounded in size.
+#
+# An entry is a file or a folder of the cache folder whose name starts
+# with the prefix of the cache; its modification time is its last use.
+# Entries being written are named <entry>.<pid>.tmp (see
+# data_handling.save_gzdata_atomic and patch_store.save_store): they are
+# neither counted nor removed.
+# ------------------------------------------------------------------------------------
+import os, shutil
+
+def ensure_dir(folder):
+    """ Creates `folder`, unless it exists """
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # created meanwhile by another process
+            if not os.path.isdir(folder):
+                raise
+
+def folder_size(folder):
+    return sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+
+def lru_entries(folder, prefix):
+    """ (last use, size, path) of the entries of `folder`, oldest first """
+    entries = []
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if not name.startswith(prefix) or name.endswith('.tmp'):
+            continue
+        try:
+            if os.path.isdir(path):
+                size = folder_size(path)
+            else:
+                size = os.path.getsize(path)
+            entries.append((os.path.getmtime(path), size, path))
+        except OSError:
+            # removed meanwhile by another process
+            pass
+    entries.sort()
+    return entries
+
+def lru_evict(folder, prefix, maxbytes, keep=None):
+    """ Removes the least recently used entries of `folder` until they fit
+    in maxbytes; `keep` is never removed. Returns the removed entries """
+    entries = lru_entries(folder, prefix)
+    total   = sum(size for (mtime, size, path) in entries)
+    removed = []
+    for (mtime, size, path) in entries:
+        if total <= maxbytes:
+            break
+        if path == keep:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        removed.append(path)
+        total = total - size
+    return removed
@@ -0,0 +1,125 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+# ------------------------------------------------------------------------------------
+# Resumable experiments.
+#
+# A run is done once its res_* file exists, written by an experiment with
+# the same options (see experiment_signature). Inside a run the grid file
+# keeps the error of every finished (combination, fold) job, and each
+# training job keeps the parameters, random state and early-stopping
+# state of its last checkpointed epoch.
+# ------------------------------------------------------------------------------------
+import os, sys, glob, string
+
+from data_handling import save_gzdata_atomic, load_savedgzdata
+
+def checkpoint_filename(options, nrun, tag):
+    return '{0:s}/ckpt_{1:05d}_{2:03d}_{3:s}.pkl.gz'.format(options['outputfolderres'],nrun,
+                                                            string.atoi(options['resolution']),tag)
+
+def remove_checkpoints(options, nrun):
+    for filename in glob.glob(checkpoint_filename(options, nrun, '*')):
+        os.remove(filename)
+
+def rng_variables(theano_rng):
+    if theano_rng is None:
+        return []
+    return [su[0] for su in theano_rng.state_updates]
+
+# options the results of a run depend on
+EXPERIMENT_OPTIONS = ['database', 'resolution', 'dataset_key', 'input_dtype', 'datanormalize',
+                      'patchsize', 'trainsize', 'folds', 'measure', 'weight', 'replicate',
+                      'oneclass', 'retrain', 'retrain_ft_layers', 'sourcemodelspath',
+                      'resolution_source', 'nneurons', 'hlayers', 'pretraining_epochs',
+                      'training_epochs', 'pretrain_lr', 'finetune_lr', 'threshold', 'batchsize',
+                      'corruptlevels', 'cache_layer_outputs', 'pretrain_stop', 'pretrain_stop_tol',
+                      'pretrain_stop_window', 'pretrain_stop_patience', 'pretrain_stop_seconds',
+                      'sampler', 'sampler_weights', 'streaming', 'stream_chunk']
+
+def experiment_signature(options):
+    # finished runs and grid files are only reused by the same experiment
+    return [(name, repr(options.get(name))) for name in EXPERIMENT_OPTIONS]
+
+def signature_filename(options, nrun):
+    """ Signature of the experiment that wrote the res_* file of `nrun` """
+    return '{0:s}/res_{1:05d}_{2:03d}_signature.pkl.gz'.format(options['outputfolderres'],nrun,
+                                                              string.atoi(options['resolution']))
+
+def is_done(options, nrun, resfilename):
+    signature = signature_filename(options, nrun)
+    return os.path.isfile(resfilename) and os.path.isfile(signature) and \
+        load_savedgzdata(signature) == options['signature']
+
+def job_signature(options):
+    # a checkpoint is only resumed by the very same job
+    return (options['seed'],
+            tuple(int(n) for n in options['hlayers']),
+            tuple(float(c) for c in options['corruptlevels']),
+            options['pretraining_epochs'], options['training_epochs'],
+            options['pretrain_lr'], options['finetune_lr'],
+            options['batchsize'], tuple(options['retrain_ft_layers']),
+            options['signature'])
+
+
+class Checkpoint(object):
+    """ Training state of one job, written atomically every `interval`
+    epochs """
+
+    def __init__(self, filename, signature, interval):
+        self.filename  = filename
+        self.signature = signature
+        self.interval  = interval
+
+    def due(self, epoch):
+        return self.filename is not None and self.interval and epoch % self.interval == 0
+
+    def save(self, sda, theano_rng, state):
+        if self.filename is None:
+            return
+
+        state = dict(state)
+        state['signature'] = self.signature
+        state['params']    = [var.get_value() for var in sda.model_variables()]
+        state['rng']       = [var.get_value() for var in rng_variables(theano_rng)]
+        save_gzdata_atomic(self.filename, state)
+
+    def load(self):
+        """ Returns the saved state, or None when there is nothing to resume """
+        if self.filename is None or not os.path.isfile(self.filename):
+            return None
+
+        state = load_savedgzdata(self.filename)
+        if state['signature'] != self.signature:
+            print >> sys.stderr, "Ignoring checkpoint {0:s} of another job".format(self.filename)
+            return None
+        return state
+
+    def restore(self, sda, theano_rng, state):
+        for var, value in zip(sda.model_variables(), state['params']):
+            var.set_value(value)
+        for var, value in zip(rng_variables(theano_rng), state['rng']):
+            var.set_value(value)
+        print >> sys.stderr, "Resuming from {0:s} ({1:s}, epoch {2:d})".format(self.filename,
+                                                                              state['phase'], state['epoch'])
+
+    def remove(self):
+        if self.filename is not None and os.path.isfile(self.filename):
+            os.remove(self.filename)
@@ -223,11 +223,18 @@ class dA(object):
         """
         return  T.nnet.sigmoid(T.dot(hidden, self.W_prime) + self.b_prime)
 
-    def get_cost_updates(self, corruption_level, learning_rate, tau):
+    def get_cost_updates(self, corruption_level, learning_rate, tau, input=None):
         """ This function computes the cost and the updates for one trainng
-        step of the dA """
+        step of the dA
 
-        tilde_x = self.get_corrupted_input(self.x, corruption_level)
+        `input` replaces the input of the dA (self.x) in the cost, e.g. by
+        a variable holding precomputed activations of the layers below
+        """
+        x = self.x
+        if input is not None:
+            x = input
+
+        tilde_x = self.get_corrupted_input(x, corruption_level)
         y, h = self.get_hidden_values(tilde_x)
         z = self.get_reconstructed_input(y)
         # note : we sum over the size of a datapoint; if we are using
@@ -239,13 +246,13 @@ class dA(object):
         
         #(CE)
         if cost_func == 'CE':
-            L = - T.sum(self.x * T.log(z) + (1 - self.x) * T.log(1 - z), axis=1)
+            L = - T.sum(x * T.log(z) + (1 - x) * T.log(1 - z), axis=1)
         #(MSE)
         elif cost_func == 'MSE':
-            L = T.sum(T.sqr(z - self.x), axis=1)
+            L = T.sum(T.sqr(z - x), axis=1)
         #(EXP)
         elif cost_func == 'EXP':
-            L = (tau * 784) * T.exp((1./(tau * 784)) * T.sum(T.sqr(z - self.x), axis=1))
+            L = (tau * 784) * T.exp((1./(tau * 784)) * T.sum(T.sqr(z - x), axis=1))
         # old form  #L = tau * T.exp(1./tau * T.sum(T.sqr(z - self.x), axis=1))
 
         # note : L is now a vector, where each element is the
@@ -19,7 +19,7 @@
 # along with NanoParticles. If not, see http://www.gnu.org/licenses/.
 
 # ------------------------------------------------------------------------------------
-import sys
+import os, sys
 import cPickle as pickle
 import gzip
 
@@ -35,6 +35,13 @@ def save_gzdata(filename,data):
     f.close()
     return data
 
+def save_gzdata_atomic(filename,data):
+    # written aside and renamed, a crash never leaves a truncated file;
+    # processes writing the same file do not share the temporary one
+    tmpfilename = '{0:s}.{1:d}.tmp'.format(filename, os.getpid())
+    save_gzdata(tmpfilename,data)
+    os.rename(tmpfilename,filename)
+
 def print_file(filename,string):
     f = open(filename, 'a')
     f.write(string)
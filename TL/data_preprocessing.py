@@ -21,12 +21,11 @@
 # ------------------------------------------------------------------------------------
 
 import csv, re, sys, string, gzip, cPickle
-import numpy, h5py
+import numpy
 
 import theano
 import theano.tensor as T
 
-import cv2
 from os import listdir, system
 from os.path import isfile, join, splitext
 
@@ -35,15 +34,41 @@ from matplotlib import pyplot as plt
 import cPickle as pickle
 
 from data_handling import save_results, save_gzdata, load_savedgzdata
-
-def confusion_matrix(ytest,ypred,K):
-    nsamples = min(len(ytest),len(ypred))
-    
-    cm = numpy.zeros((K,K))
-    for elem in range(0,nsamples):
-        cm[ytest[elem],ypred[elem]] = cm[ytest[elem],ypred[elem]] + 1
-
-    return cm
+from metrics import confusion_matrix
+from patch_store import PatchStore, write_store, packed_store, save_store
+from dataset_cache import get_cache, dataset_key
+from streaming import StreamingSet
+
+def extract_patches( img, x, y, size=20 ):
+    """ size x size patches img[y-size/2:y+size/2, x-size/2:x+size/2]
+    of a 2-D image around the points (x, y), one per row (rasterized row
+    by row)
+
+    Returns (patches, valid): patches of points whose patch leaves the
+    image are not valid and left at zero. The check is made on the
+    coordinates as given; non-integer ones are then truncated, as slicing
+    with float bounds did. All patches are gathered at once from a strided
+    view of the image.
+    """
+    img  = numpy.ascontiguousarray(img)
+    x    = numpy.asarray(x).ravel()
+    y    = numpy.asarray(y).ravel()
+    half = size / 2
+    (height, width) = img.shape
+
+    valid   = (y - half >= 0) & (y + half <= height) & (x - half >= 0) & (x + half <= width)
+    (x, y)  = (x.astype(numpy.intp), y.astype(numpy.intp))
+    patches = numpy.zeros((len(x), size*size), dtype=img.dtype)
+    if height < size or width < size:
+        return (patches, valid)
+
+    # windows[i,j] is the patch starting at row i, column j
+    (s0, s1) = img.strides
+    windows  = numpy.lib.stride_tricks.as_strided(img, shape=(height-size+1, width-size+1, size, size),
+                                                  strides=(s0, s1, s0, s1))
+    patches[valid] = windows[y[valid] - half, x[valid] - half].reshape((-1, size*size))
+
+    return (patches, valid)
 
 def view_data( data, label ):
     (npoints, ndim) = data.shape
@@ -59,21 +84,93 @@ def view_data( data, label ):
             plt.show()
 
 
-def loadConvertMNIST(patchsize, ids, dataset, imgwidth, train_set_x, train_set_y):
-    nelem = len(train_set_y)
-    for k in range(0,nelem):
-        p = train_set_x[k,:]
-        p = numpy.reshape(p,(imgwidth,imgwidth))
-        p = cv2.resize(p,(patchsize,patchsize))
-        p = p.ravel()
-        # view_data(p, train_set_y[k])
-        dataset[:,ids] = numpy.r_[ids,p,train_set_y[k]]
-        ids = ids + 1
+# images resized at once by loadConvertMNIST
+RESIZE_CHUNK = 10000
+
+# interpolation matrices, by (source size, destination size)
+_resize_matrices = {}
+
+def resize_matrix(src, dst):
+    """ (dst, src) matrix of the bilinear interpolation of cv2.resize
+    (INTER_LINEAR) along one axis: resizing an image is R_y . img . R_x^T """
+    if (src, dst) not in _resize_matrices:
+        scale = src / float(dst)
+        fx    = (numpy.arange(dst) + 0.5) * scale - 0.5
+        sx    = numpy.floor(fx).astype(numpy.int64)
+        fx    = fx - sx
+
+        # borders are replicated, as cv2 does
+        low  = sx < 0
+        (sx[low], fx[low]) = (0, 0)
+        high = sx >= src - 1
+        (sx[high], fx[high]) = (src - 1, 0)
+
+        R = numpy.zeros((dst, src))
+        R[numpy.arange(dst), sx] += 1 - fx
+        R[numpy.arange(dst), numpy.minimum(sx + 1, src - 1)] += fx
+        _resize_matrices[(src, dst)] = R.astype(numpy.float32)
+    return _resize_matrices[(src, dst)]
+
+def loadConvertMNIST(patchsize, ids, store, imgwidth, train_set_x, train_set_y):
+    """ Resizes the images (one per row) to patchsize x patchsize into
+    the rows ids, ids+1, ... of the store; the interpolation is two
+    matrix products over a chunk of images at a time """
+    nelem    = len(train_set_y)
+    imgwidth = int(imgwidth)
+    Ry = resize_matrix(imgwidth, patchsize)
+    Rx = resize_matrix(imgwidth, patchsize)
+
+    for first in xrange(0, nelem, RESIZE_CHUNK):
+        last = min(first + RESIZE_CHUNK, nelem)
+        n    = last - first
+
+        imgs = numpy.asarray(train_set_x[first:last], dtype=numpy.float32)
+        # columns: (n*h, w) . (w, p) -> (n, h, p)
+        tmp  = imgs.reshape((n*imgwidth, imgwidth)).dot(Rx.T).reshape((n, imgwidth, patchsize))
+        # rows: (n*p, h) . (h, p) -> (n, p(x), p(y))
+        tmp  = tmp.transpose((0,2,1)).reshape((n*patchsize, imgwidth)).dot(Ry.T)
+        p    = tmp.reshape((n, patchsize, patchsize)).transpose((0,2,1))
 
-    return (dataset, ids)
+        # view_data(p, train_set_y[k])
+        store.patches[ids+first:ids+last,:] = p.reshape((n, patchsize*patchsize))
+        store.ids[ids+first:ids+last]       = numpy.arange(ids+first, ids+last)
+        store.labels[ids+first:ids+last]    = train_set_y[first:last]
+
+    return (store, ids + nelem)
+
+def convertMNIST(patchsize):
+    """ Store of the train, valid and test sets of mnist.pkl.gz, resized
+    to patchsize x patchsize """
+    train_set, valid_set, test_set = load_savedgzdata('mnist.pkl.gz')
+
+    train_set_x = numpy.array(train_set[0])
+    train_set_y = numpy.array(train_set[1])
+    valid_set_x = numpy.array(valid_set[0])
+    valid_set_y = numpy.array(valid_set[1])
+    test_set_x  = numpy.array(test_set[0])
+    test_set_y  = numpy.array(test_set[1])
+
+    (nelem_train,ndim) = train_set_x.shape
+    (nelem_valid,ndim) = valid_set_x.shape
+    (nelem_test,ndim)  = test_set_x.shape
+
+    nelem    = nelem_train+nelem_valid+nelem_test
+    dataset  = PatchStore(numpy.zeros((nelem,patchsize*patchsize),dtype=numpy.float32),
+                          numpy.zeros((nelem,),dtype=numpy.int32),
+                          numpy.zeros((nelem,),dtype=numpy.int8))
+    ids      = 0
+    imgwidth = numpy.sqrt(ndim)
+    #print >> sys.stderr, "train....", ids
+    (dataset, ids) = loadConvertMNIST(patchsize, ids, dataset, imgwidth, train_set_x, train_set_y)
+    #print >> sys.stderr, "val....", ids
+    (dataset, ids) = loadConvertMNIST(patchsize, ids, dataset, imgwidth, valid_set_x, valid_set_y)
+    #print >> sys.stderr, "test....", ids
+    (dataset, ids) = loadConvertMNIST(patchsize, ids, dataset, imgwidth, test_set_x, test_set_y )
+
+    return dataset
 
 def load_data(datasetpath, options):
-    ''' Loads the dataset
+    ''' Loads the dataset as a PatchStore
 
     :type dataset: string
     :param dataset: the path to the dataset 
@@ -90,35 +187,19 @@ def load_data(datasetpath, options):
     # LOAD DATA #
     #############
 
+    # datasets are converted once into a memory-mapped store (see
+    # dataset_cache)
+    cache = get_cache(options['dataset_cache'], options['dataset_cache_size'])
+
     if options['database'] == 'mnist':
-        train_set, valid_set, test_set = load_savedgzdata('mnist.pkl.gz')
-
-        train_set_x = numpy.array(train_set[0])
-        train_set_y = numpy.array(train_set[1])
-        valid_set_x = numpy.array(valid_set[0])
-        valid_set_y = numpy.array(valid_set[1])
-        test_set_x  = numpy.array(test_set[0])
-        test_set_y  = numpy.array(test_set[1])
-
-        (nelem_train,ndim) = train_set_x.shape
-        (nelem_valid,ndim) = valid_set_x.shape
-        (nelem_test,ndim)  = test_set_x.shape
-        
-        dataset  = numpy.zeros((options['patchsize']*options['patchsize']+2,nelem_train+nelem_valid+nelem_test))
-        ids      = 0
-        imgwidth = numpy.sqrt(ndim)
-        #print >> sys.stderr, "train....", ids
-        (dataset, ids) = loadConvertMNIST(options['patchsize'], ids, dataset, imgwidth, train_set_x, train_set_y)
-        #print >> sys.stderr, "val....", ids
-        (dataset, ids) = loadConvertMNIST(options['patchsize'], ids, dataset, imgwidth, valid_set_x, valid_set_y)
-        #print >> sys.stderr, "test....", ids
-        (dataset, ids) = loadConvertMNIST(options['patchsize'], ids, dataset, imgwidth, test_set_x, test_set_y )
-        
-        nclasses = len(list(set(train_set_y)))
+        write   = lambda folder, key: save_store(folder, convertMNIST(options['patchsize']), key)
+        dataset = cache.load(dataset_key(['mnist.pkl.gz'], options), write)
+
+        nclasses = len(numpy.unique(dataset.labels))
         return (dataset, options['patchsize']*options['patchsize'], nclasses)
 
     elif options['database'] == 'shapes':
-        dataset = load_savedgzdata('shapes.pkl.gz')
+        dataset = packed_store( load_savedgzdata('shapes.pkl.gz') )
 
         return(dataset,20*20,4)
         
@@ -134,91 +215,116 @@ def load_data(datasetpath, options):
     # onlyfiles = [ f for f in listdir(datasetpath) if ( isfile(join(datasetpath,f)) and splitext(f)[1] == '.mat' ) ]
     onlyfiles.sort()
 
-    first = True
-    ids   = 0;
-    for file in onlyfiles:
-        print >> sys.stderr, ( "---> " + datasetpath + file )
-        f = h5py.File(datasetpath + file,'r')
-        
-        # print f.items();
-        mpatches = f.get('mpatches')
-        # print mpatches.items();
-        back = numpy.array( mpatches.get('negative') )
-        nano = numpy.array( mpatches.get('positive') )
-        if options['replicate']:
-            nano = numpy.c_[ back, back ]
-        
-        # print >> sys.stderr, back.shape
-        # print >> sys.stderr, nano.shape
-        
-        (back_ndim,back_npoints) = back.shape
-        (nano_ndim,nano_npoints) = nano.shape
-        back[0,:] = back[0,:] + ids
-        nano[0,:] = nano[0,:] + ids
+    write   = lambda folder, key: write_store(folder, datasetpath, onlyfiles, options, key)
+    dataset = cache.load(dataset_key([join(datasetpath,f) for f in onlyfiles], options), write)
 
-        ids = max(back[0,:])
-        # raw_input('> press any key <')
-        
-        back = numpy.r_[ back, numpy.ones((1,back_npoints)) ]
-        nano = numpy.r_[ nano, -1 * numpy.ones((1,nano_npoints)) ]
-
-        if first:
-            dataset = numpy.c_[ back, nano]
-            first   = False
-        else:
-            dataset = numpy.c_[ dataset, back, nano]
-        
-        # print type( dataset )
-        # raw_input('....')
+    return (dataset, dataset.ndim, nclasses)
+
+def input_dtype( dataset, options ):
+    """ dtype of the patches get_data gives to the model """
+    if options['datanormalize'] and dataset.patches.dtype == numpy.uint8:
+        return 'uint8'
+    return theano.config.floatX
+
+def read_samples( dataset, idx, options ):
+    """ Patches and labels of the rows `idx` of the store, as the model
+    takes them """
+    # convert classes for 0,1,...,K
+    if options['datanormalize']:
+        data_y = (dataset.labels[idx] + 1.) / 2
+    else:
+        data_y = dataset.labels[idx]
+
+    minvalue = 0 #numpy.min( train_set_x )
+    maxvalue = 255 #numpy.max( train_set_x )
+
+    # print "Min value: {0:0.2f} | Max value: {1:.2f}".format( minvalue, maxvalue )
+    if input_dtype( dataset, options ) == 'uint8':
+        data_x = dataset.gather(idx, dtype=numpy.uint8)
+    elif options['datanormalize']:
+        data_x = dataset.gather(idx, minvalue, maxvalue)
+    else:
+        data_x = dataset.gather(idx)
 
-    # dataset was constructed according to the following structure
-    # [[ .... ids ....],
-    #  [ .... data ...],
-    #  [ ..... cls ...]]
+    return (data_x, data_y)
 
-    datasetfilename = 'nanoparticles.npz'
-    #save_gzdata(datasetfilename,dataset)
-    numpy.savez_compressed(datasetfilename,dataset)
+def shared_store( dataset, options ):
+    """ The whole store as one (x, y) pair of shared variables, which
+    every fold indexes
 
-    kakak
-    return (dataset, nano_ndim-1, nclasses)
+    uint8 patches are not copied (a memory-mapped store stays so); they
+    are normalized by the model itself (SdA.decode_input).
+    """
+    if input_dtype( dataset, options ) == 'uint8':
+        # labels straight from the store, as read_samples converts them
+        data_x = numpy.asarray(dataset.patches)
+        data_y = (dataset.labels + 1.) / 2
+    else:
+        (data_x, data_y) = read_samples( dataset, numpy.arange(dataset.nsamples), options )
 
-def get_data( dataset, ids, options, isFirst = True, minvalue=0, maxvalue=1 ):
+    return shared_dataset(data_x, data_y)
 
-    # get idx from id's
-    idx = numpy.in1d(dataset[0,:],ids)
+def labels_variable(data_y):
+    """ Returns the shared variable behind the labels
+
+    shared_dataset returns the labels as a cast over a shared variable
+    """
+    if hasattr(data_y, 'get_value'):
+        return data_y
+    return data_y.owner.inputs[0]
+
+def dataset_labels( dataset ):
+    """ Labels of a (x, y) or (x, y, rows) dataset, or of a
+    StreamingSet, as a numpy array """
+    if isinstance(dataset, StreamingSet):
+        return dataset.labels
+    y = labels_variable(dataset[1]).get_value(borrow=True)
+    if len(dataset) == 3:
+        y = y[dataset[2].get_value(borrow=True)]
+    return numpy.asarray(y, dtype=numpy.int32)
+
+def get_data( data, dataset, ids, options, isFirst = True, stream = False ):
+    """ Dataset (x, y, rows) of the images `ids`: the shared data of
+    the whole store and the int32 rows of their patches; only the rows
+    are created
+
+    In streaming mode (`data` is None) a training set (`stream`) is a
+    StreamingSet, read from the store while training, and the other sets
+    hold their own patches.
+    """
+
+    # rows of the patches of the images `ids`, from the offset table
+    idx = dataset.rows(ids)
 
     if isFirst == False and options['oneclass'] == True:
         # print dataset.shape
         # print idx.shape
         # remove background
-        ind = dataset[-1,:] == 1
+        ind = dataset.labels[idx] == 1
         # remove negative examples
-        idx[ind] = False
-        
-    # get all data except ids and classes
-    train_set_x = dataset[1:-1,idx].T
-    # convert classes for 0,1,...,K
-    if options['datanormalize']:
-        train_set_y = (dataset[-1,idx] + 1 ) / 2
-    else:
-        train_set_y = dataset[-1,idx]
-        
-    if isFirst:
-        minvalue = 0 #numpy.min( train_set_x )
-        maxvalue = 255 #numpy.max( train_set_x )
+        idx = idx[~ind]
 
-    # print "Min value: {0:0.2f} | Max value: {1:.2f}".format( minvalue, maxvalue )
-    if options['datanormalize']:
-        train_set_x = (train_set_x - minvalue) / (maxvalue-minvalue+0.001)
-    
-    x, y = shared_dataset(train_set_x,train_set_y)
+    if data is None and stream:
+        read   = lambda rows: read_samples( dataset, rows, options )
+        labels = numpy.asarray(read_samples( dataset, idx, options )[1], dtype=numpy.int32)
+        return StreamingSet(read, idx, labels, dataset.patches, options['stream_chunk'], options['seed'])
+    elif data is None:
+        return shared_dataset( *read_samples( dataset, idx, options ) )
+
+    rows = theano.shared(numpy.asarray(idx, dtype=numpy.int32), borrow=True)
     
-    return (x,y,minvalue,maxvalue)
+    return (data[0],data[1],rows)
 
 
 def gen_folds( dataset, options, nrun ):
-    nids = len( set( dataset[0,:] ) )
+    # every fold is a set of rows of the same shared data, unless the
+    # training sets are streamed
+    if options['streaming']:
+        data = None
+    else:
+        data = shared_store( dataset, options )
+
+    nids = dataset.nimages
     ids  = options['numpy_rng'].permutation(nids)
 
     # train / test ids
@@ -255,21 +361,21 @@ def gen_folds( dataset, options, nrun ):
         val    = val_ids[others[0]]
         test   = val_ids[others[1]]
 
-        xtrain,ytrain,minv,maxv = get_data( dataset, train, options )
-        xval,yval   = get_data( dataset,  val, options, isFirst=False, minvalue=minv, maxvalue=maxv )[0:2]
-        xtest,ytest = get_data( dataset, test, options, isFirst=False, minvalue=minv, maxvalue=maxv )[0:2]
+        trainset = get_data( data, dataset, train, options, stream=True )
+        valset   = get_data( data, dataset,  val, options, isFirst=False )
+        testset  = get_data( data, dataset, test, options, isFirst=False )
         
-        trainval.append( (xtrain,ytrain) )
-        valval.append( (xval,yval) )
-        testval.append( (xtest,ytest) )
+        trainval.append( trainset )
+        valval.append( valset )
+        testval.append( testset )
 
         if options['verbose'] > 0:
-            print 'Train set with size %d for fold %d' % (ytrain.shape.eval(),k)
-            print 'Test  set with size %d for fold %d' % (ytest.shape.eval(),k)
+            print 'Train set with size %d for fold %d' % (len(dataset_labels(trainset)),k)
+            print 'Test  set with size %d for fold %d' % (len(dataset_labels(testset)),k)
             if options['verbose'] > 5:
                 for cls in range(0,2):
-                    print >>sys.stderr, "\tNumber of training elements for cls {0:02d} is {1:05d}".format(cls,sum(ytrain.eval() == cls))
-                    print >>sys.stderr, "\tNumber of testing elements for cls {0:02d} is {1:05d}".format(cls,sum(ytest.eval() == cls))
+                    print >>sys.stderr, "\tNumber of training elements for cls {0:02d} is {1:05d}".format(cls,sum(dataset_labels(trainset) == cls))
+                    print >>sys.stderr, "\tNumber of testing elements for cls {0:02d} is {1:05d}".format(cls,sum(dataset_labels(testset) == cls))
 
     # final ids
     final_ids = numpy.copy(train_ids)
@@ -278,25 +384,21 @@ def gen_folds( dataset, options, nrun ):
     trainfinal_ids = final_ids[0]
     valfinal_ids   = final_ids[1]
 
-    xtrain,ytrain,minv,maxv = get_data( dataset, trainfinal_ids, options )
-    xval,yval    = get_data( dataset, valfinal_ids, options, isFirst = False, minvalue=minv, maxvalue=maxv )[0:2]
-    xtest,ytest  = get_data( dataset, test_ids    , options, isFirst = True , minvalue=minv, maxvalue=maxv )[0:2]
-
-    trainFinal = (xtrain,ytrain)
-    valFinal   = (xval,yval)
-    testFinal  = (xtest,ytest)
+    trainFinal = get_data( data, dataset, trainfinal_ids, options, stream=True )
+    valFinal   = get_data( data, dataset, valfinal_ids, options, isFirst = False )
+    testFinal  = get_data( data, dataset, test_ids    , options, isFirst = True )
 
     print >> sys.stderr, test_ids
     
     if options['verbose'] > 0:
-        print 'Train set with size %d ' % (ytrain.shape.eval())
-        print 'Val  set with size %d ' % (yval.shape.eval())
-        print 'Test  set with size %d ' % (ytest.shape.eval())
+        print 'Train set with size %d ' % (len(dataset_labels(trainFinal)))
+        print 'Val  set with size %d ' % (len(dataset_labels(valFinal)))
+        print 'Test  set with size %d ' % (len(dataset_labels(testFinal)))
         if options['verbose'] > 5:
             for cls in range(0,2):
-                print >>sys.stderr, "\tNumber of training elements for cls {0:02d} is {1:05d}".format(cls,sum(ytrain.eval() == cls))
-                print >>sys.stderr, "\tNumber of validation elements for cls {0:02d} is {1:05d}".format(cls,sum(yval.eval() == cls))
-                print >>sys.stderr, "\tNumber of testing elements for cls {0:02d} is {1:05d}".format(cls,sum(ytest.eval() == cls))
+                print >>sys.stderr, "\tNumber of training elements for cls {0:02d} is {1:05d}".format(cls,sum(dataset_labels(trainFinal) == cls))
+                print >>sys.stderr, "\tNumber of validation elements for cls {0:02d} is {1:05d}".format(cls,sum(dataset_labels(valFinal) == cls))
+                print >>sys.stderr, "\tNumber of testing elements for cls {0:02d} is {1:05d}".format(cls,sum(dataset_labels(testFinal) == cls))
 
     basefilename = '{0:s}/{1:05d}_{2:03d}_'.format(options['outputfolder'],nrun,string.atoi(options['resolution']))
 
@@ -313,9 +415,9 @@ def gen_folds( dataset, options, nrun ):
     save_gzdata(testfilename,test_ids)
     
     if options['verbose'] > 0:
-        print 'Train set with size %d' % (trainFinal[1].shape.eval())
-        print 'Val   set with size %d' % (valFinal[1].shape.eval())
-        print 'Test  set with size %d' % (testFinal[1].shape.eval())
+        print 'Train set with size %d' % (len(dataset_labels(trainFinal)))
+        print 'Val   set with size %d' % (len(dataset_labels(valFinal)))
+        print 'Test  set with size %d' % (len(dataset_labels(testFinal)))
 
     rval = [trainval, valval, testval, trainFinal, valFinal, testFinal ]
 
@@ -336,9 +438,15 @@ def shared_dataset(data_x,data_y, borrow=True):
     Since copying data into the GPU is slow, copying a minibatch everytime
     is needed (the default behaviour if the data is not in a shared
     variable) would lead to a large decrease in performance.
+
+    uint8 patches are kept in uint8, a quarter of floatX; the model
+    converts them one minibatch at a time.
     """
+    dtype = theano.config.floatX
+    if numpy.asarray(data_x).dtype == numpy.uint8:
+        dtype = numpy.uint8
     shared_x = theano.shared(numpy.asarray(data_x,
-                                           dtype=theano.config.floatX),
+                                           dtype=dtype),
                              borrow=borrow)
     shared_y = theano.shared(numpy.asarray(data_y,
                                            dtype=theano.config.floatX),
@@ -0,0 +1,107 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# Content-addressed cache of converted datasets.
+#
+# A dataset is converted once into a patch store (see patch_store) in a
+# folder named after its key: the paths, sizes and modification times of
+# its source files and the options the conversion depends on. A TL call
+# on the same data opens the memory-mapped store instead of reading the
+# source files again. The least recently used stores are removed once
+# the cache grows over its size.
+# ------------------------------------------------------------------------------------
+import os, sys, hashlib
+
+from patch_store import open_store, is_current
+from cache_folder import ensure_dir, folder_size, lru_entries, lru_evict
+
+# options the stored patches depend on; normalization (datanormalize) is
+# applied when the patches are read (see data_preprocessing.read_samples)
+CACHE_OPTIONS = ['database', 'resolution', 'patchsize']
+
+def file_signature(filename):
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_size, int(stat.st_mtime))
+
+def dataset_key(sources, options):
+    """ Key of the dataset converted from the files `sources` """
+    return {'files': [file_signature(f) for f in sources],
+            'options': [(name, options.get(name)) for name in CACHE_OPTIONS]}
+
+
+class DatasetCache(object):
+    """ Patch stores kept in `folder`, one subfolder per key, up to
+    `maxbytes` in total """
+
+    def __init__(self, folder, maxbytes):
+        self.folder   = folder
+        self.maxbytes = maxbytes
+        self.hits     = 0
+        self.misses   = 0
+        ensure_dir(folder)
+
+    def store_folder(self, key):
+        name = hashlib.sha1(repr(sorted(key.items()))).hexdigest()
+        return '{0:s}/store_{1:s}'.format(self.folder, name)
+
+    def load(self, key, write):
+        """ Opens the store of `key`; on a miss `write(folder, key)` writes
+        it first, manifest included """
+        folder = self.store_folder(key)
+
+        if is_current(folder, key):
+            self.hits = self.hits + 1
+            # the modification time of a store is its last use
+            os.utime(folder, None)
+        else:
+            self.misses = self.misses + 1
+            print >> sys.stderr, ( "Writing patch store " + folder )
+            write(folder, key)
+            self.evict(keep=folder)
+
+        return open_store(folder)
+
+    def entries(self):
+        """ (last use, size, folder) of the stores, oldest first """
+        # stores being written are named store_<digest>.<pid>.tmp
+        return lru_entries(self.folder, 'store_')
+
+    def evict(self, keep=None):
+        """ Removes the least recently used stores until the cache fits in
+        maxbytes; `keep` is never removed """
+        for folder in lru_evict(self.folder, 'store_', self.maxbytes, keep):
+            print >> sys.stderr, ( "Removing patch store " + folder )
+
+    def stats(self):
+        entries = self.entries()
+        return "dataset cache: {0:d} stores, {1:.1f} of {2:.1f} MB | hits: {3:d} | misses: {4:d}".format(
+            len(entries), sum(size for (mtime, size, folder) in entries) / 1e6, self.maxbytes / 1e6,
+            self.hits, self.misses)
+
+# caches of this process, by folder: the counts add up over TL calls
+_caches = {}
+
+def get_cache(folder, maxbytes):
+    if folder not in _caches:
+        _caches[folder] = DatasetCache(folder, maxbytes)
+    _caches[folder].maxbytes = maxbytes
+    return _caches[folder]
@@ -0,0 +1,133 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# Dense scoring of whole images.
+#
+# An SdA classifies patchsize x patchsize patches. Scored at every
+# position of an image, its first hidden layer is a convolution by its
+# weights (one patchsize x patchsize filter per hidden unit) and the
+# layers above, the logistic one included, act on each pixel alone (1x1
+# convolutions). The image is processed in tiles, so the hidden maps
+# stay small, and the maxima of the nanoparticle probability map are
+# candidate detections.
+# ------------------------------------------------------------------------------------
+import numpy
+from scipy import ndimage
+
+import theano
+import theano.tensor as T
+from theano.tensor.nnet import conv2d
+
+from SdA import decode_input
+from metrics import nanoparticle
+
+class DenseSdA(object):
+    """ Class probabilities of the patch centred at every pixel of an
+    image, given by a trained `sda` through `logLayer` (sda.logLayer by
+    default)
+
+    The function is compiled once; it reads the weights of the model, so
+    it follows their changes.
+    """
+
+    def __init__(self, sda, patchsize=20, tile=128, logLayer=None):
+        if logLayer is None:
+            logLayer = sda.logLayer
+
+        W0 = sda.sigmoid_layers[0].W
+        assert W0.get_value(borrow=True).shape[0] == patchsize * patchsize
+
+        self.patchsize = patchsize
+        self.tile      = tile
+        self.nclasses  = logLayer.b.get_value(borrow=True).shape[0]
+
+        img = T.matrix('img', dtype='uint8')   # tile of the image, grey levels
+
+        # patches are rasterized row by row; the filters are applied as
+        # they are (a correlation): conv2d flips them, so they are given
+        # flipped. filter_flip=False would do the same, but it needs
+        # Theano >= 0.8, which the rest of TL does not
+        filters = W0.T.reshape((W0.shape[1], 1, patchsize, patchsize))[:, :, ::-1, ::-1]
+        h = conv2d(decode_input(img).dimshuffle('x', 'x', 0, 1), filters)[0]
+        h = T.nnet.sigmoid(h + sda.sigmoid_layers[0].b.dimshuffle(0, 'x', 'x'))
+
+        # one row per position for the 1x1 stages
+        (nrows, ncols) = (h.shape[1], h.shape[2])
+        h = h.reshape((h.shape[0], nrows * ncols)).T
+        for layer in sda.sigmoid_layers[1:]:
+            h = T.nnet.sigmoid(T.dot(h, layer.W) + layer.b)
+        p = T.nnet.softmax(T.dot(h, logLayer.W) + logLayer.b)
+
+        self.score_tile = theano.function([img], p.T.reshape((p.shape[1], nrows, ncols)),
+                                          name='dense')
+
+    def probabilities(self, img):
+        """ (nclasses, height, width) probabilities of the patch
+        img[y-p/2:y+p/2, x-p/2:x+p/2] at (y, x); NaN where it does not
+        fit in the image """
+        img = numpy.asarray(img, dtype=numpy.uint8)
+        (height, width) = img.shape
+        (size, half)    = (self.patchsize, self.patchsize / 2)
+
+        probs = numpy.empty((self.nclasses, height, width), dtype=theano.config.floatX)
+        probs.fill(numpy.nan)
+
+        # patches start at 0..height-size, 0..width-size
+        nrows = height - size + 1
+        ncols = width - size + 1
+        for y0 in xrange(0, nrows, self.tile):
+            for x0 in xrange(0, ncols, self.tile):
+                y1 = min(y0 + self.tile, nrows)
+                x1 = min(x0 + self.tile, ncols)
+                probs[:, half+y0:half+y1, half+x0:half+x1] = \
+                    self.score_tile(img[y0:y1+size-1, x0:x1+size-1])
+
+        return probs
+
+    def heatmap(self, img):
+        """ Probability of a nanoparticle at each pixel """
+        return self.probabilities(img)[nanoparticle]
+
+    def peaks(self, img, threshold, radius):
+        """ heatmap_peaks of the heatmap of `img` """
+        return heatmap_peaks(self.heatmap(img), threshold, radius)
+
+def heatmap_peaks(heatmap, threshold, radius):
+    """ (x, y, prob) of the maxima of `heatmap` over a disk of `radius`
+    above `threshold`, by decreasing probability
+
+    A plateau (probabilities saturate) gives one peak, its first pixel.
+    """
+    p = numpy.where(numpy.isnan(heatmap), -numpy.inf, heatmap)
+
+    (dy, dx)  = numpy.ogrid[-radius:radius+1, -radius:radius+1]
+    footprint = dx * dx + dy * dy <= radius * radius
+    peak = (ndimage.maximum_filter(p, footprint=footprint, mode='constant', cval=-numpy.inf) == p) & \
+           (p > threshold)
+
+    (labels, n) = ndimage.label(peak, structure=numpy.ones((3,3)))
+    (y, x)      = numpy.nonzero(peak)
+    first       = numpy.unique(labels[y, x], return_index=True)[1]
+    (y, x)      = (y[first], x[first])
+
+    order = numpy.argsort(-p[y, x], kind='mergesort')
+    return (x[order], y[order], p[y[order], x[order]])
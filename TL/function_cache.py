@@ -0,0 +1,302 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+# ------------------------------------------------------------------------------------
+import sys
+import numpy
+
+import theano
+from theano.tensor.shared_randomstreams import RandomStreams
+
+import theano.tensor as T
+
+from SdA import SdA, dataset_rows, dataset_size, decode_input
+from data_preprocessing import shared_dataset, labels_variable
+from streaming import StreamingSet, streamed
+
+def empty_dataset(ndim, dtype):
+    """ Placeholder (x,y,rows) triple the functions are compiled against;
+    the patches bound to it later must have the same dtype """
+    (x, y) = shared_dataset(numpy.zeros((0,ndim), dtype=dtype), numpy.zeros((0,)))
+    rows   = theano.shared(numpy.zeros((0,), dtype=numpy.int32), borrow=True)
+    return (x, y, rows)
+
+def bind_dataset(slot, dataset):
+    """ Gives the shared variables of `slot` the values of `dataset`, a
+    (x, y) pair or a (x, y, rows) triple
+
+    Values are borrowed, no data is copied: binding a fold only sets its
+    rows once the data is bound.
+    """
+    (slot_x, slot_y, slot_rows) = slot
+    (data_x, data_y, rows) = dataset_rows(dataset)
+
+    if slot_x.get_value(borrow=True) is not data_x.get_value(borrow=True):
+        slot_x.set_value(data_x.get_value(borrow=True), borrow=True)
+    slot_y = labels_variable(slot_y)
+    data_y = labels_variable(data_y)
+    if slot_y.get_value(borrow=True) is not data_y.get_value(borrow=True):
+        slot_y.set_value(data_y.get_value(borrow=True), borrow=True)
+
+    if rows is None:
+        slot_rows.set_value(numpy.arange(dataset_size(dataset), dtype=numpy.int32), borrow=True)
+    else:
+        slot_rows.set_value(rows.get_value(borrow=True), borrow=True)
+
+
+class CompiledSdA(object):
+    """ An SdA together with its compiled Theano functions
+
+    The functions read their data from the `train`, `valid` and `test`
+    slots, which are given the values (shared data and rows) of each fold
+    through `bind`.
+    Learning rates and corruption levels are inputs of the functions, so
+    the same graphs serve every fold, hyperparameter combination and run.
+
+    With `cache_layer_outputs` each layer is pretrained on the cached
+    output of the layer below, which `encode(i)` computes (see
+    SdA.cached_pretraining_functions); otherwise `encode` is None.
+
+    A StreamingSet bound as training set is fed to the training slot
+    chunk by chunk: `pretraining_fns` and `train_fn` are then wrapped
+    (see streaming.streamed) and keep their signature.
+    """
+
+    def __init__(self, sda, batch_size, test_batch_size, theano_rng=None, update_layerwise=None,
+                 cache_layer_outputs=False, input_dtype=theano.config.floatX):
+        self.sda        = sda
+        self.batch_size = batch_size
+        self.theano_rng = theano_rng
+        self.encode     = None
+        self.test_batch_size = test_batch_size
+        self._recon_fns = None
+        self.stream     = None
+        self.source     = None
+        self.source_values = None
+
+        ndim = sda.sigmoid_layers[0].W.get_value(borrow=True).shape[0]
+        self.train = empty_dataset(ndim, input_dtype)
+        self.valid = empty_dataset(ndim, input_dtype)
+        self.test  = empty_dataset(ndim, input_dtype)
+
+        if update_layerwise is None:
+            if cache_layer_outputs:
+                (self.pretraining_fns, self.encode) = sda.cached_pretraining_functions(
+                    train_set_x=self.train[0], batch_size=batch_size, tau=None,
+                    encode_batch_size=test_batch_size, train_rows=self.train[2])
+            else:
+                self.pretraining_fns = sda.pretraining_functions(train_set_x=self.train[0],
+                                                                 batch_size=batch_size, tau=None,
+                                                                 train_rows=self.train[2])
+            (self.train_fn, self.validate_model) = sda.build_finetune_functions(
+                datasets=[self.train, self.valid],
+                batch_size=batch_size,
+                learning_rate=0.1)
+            self.test_model = sda.build_test_function(dataset=self.test, batch_size=test_batch_size)
+        else:
+            self.pretraining_fns = None
+            (self.train_fn, self.validate_model) = sda.build_finetune_functions_reuse(
+                datasets=[self.train, self.valid],
+                batch_size=batch_size,
+                learning_rate=0.1, update_layerwise=update_layerwise)
+            self.test_model = sda.build_test_function_reuse(dataset=self.test, batch_size=test_batch_size)
+
+        # functions on the training slot, as compiled
+        self._train_fns = (self.pretraining_fns, self.train_fn)
+
+    def bind(self, train_set=None, valid_set=None, test_set=None):
+        if train_set is not None:
+            (self.pretraining_fns, self.train_fn) = self._train_fns
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+
+            if isinstance(train_set, StreamingSet):
+                self.stream = train_set.stream(self.batch_size)
+                bind_chunk  = lambda x, y: bind_dataset(self.train, shared_dataset(x, y))
+                if self.pretraining_fns is not None:
+                    self.pretraining_fns = [streamed(fn, self.stream, bind_chunk)
+                                            for fn in self.pretraining_fns]
+                self.train_fn = streamed(self.train_fn, self.stream, bind_chunk)
+            else:
+                bind_dataset(self.train, train_set)
+        if valid_set is not None:
+            bind_dataset(self.valid, valid_set)
+        if test_set is not None:
+            bind_dataset(self.test, test_set)
+
+    def reconstruction_fns(self):
+        """ Reconstruction cost of each dA on the `valid` slot, compiled
+        the first time it is asked for """
+        if self._recon_fns is None:
+            self._recon_fns = self.sda.reconstruction_functions(self.valid[0], self.test_batch_size,
+                                                                rows=self.valid[2])
+        return self._recon_fns
+
+    def reuse(self, source):
+        """ Prepares the model for a retraining job from the finetuned
+        model `source`
+
+        The values of a source are saved the first time it is reused,
+        before any job trains it (the compiled model may be the source
+        itself), and every job starts from them: a job does not depend
+        on the jobs run before it in the same process. The last layer
+        starts from the logistic layer of the source, or from zeros when
+        the number of classes changed.
+        """
+        sda = self.sda
+        if self.source is not source:
+            self.source_values = [ value.get_value() for value in source.params ]
+            self.source = source
+        for param, value in zip(sda.params, self.source_values):
+            param.set_value(value.copy())
+
+        for param, value in zip(sda.logLayer_b.params, sda.logLayer.params):
+            value = value.get_value()
+            if param.get_value(borrow=True).shape != value.shape:
+                value = numpy.zeros_like(param.get_value(borrow=True))
+            param.set_value(value)
+
+    def reset(self, numpy_rng, seed):
+        """ Prepares the model for a new job: new initial weights and the
+        corruption noise restarted from `seed` """
+        self.sda.reset_params(numpy_rng)
+        if self.theano_rng is not None:
+            self.theano_rng.seed(seed)
+
+
+class Predictor(object):
+    """ Labels and class probabilities of `sda` (through `logLayer`,
+    sda.logLayer by default) for numpy batches of patches
+
+    The function is compiled once and takes the patches themselves as
+    input, so any number of batches (e.g. the candidates of every image
+    of a run) go through it without new shared variables or functions.
+    uint8 patches are normalized as the stored ones (SdA.decode_input).
+    """
+
+    def __init__(self, sda, batch_size=5000, logLayer=None, input_dtype='uint8'):
+        if logLayer is None:
+            logLayer = sda.logLayer
+        self.batch_size  = batch_size
+        self.input_dtype = input_dtype
+        self.n_outs      = logLayer.b.get_value(borrow=True).shape[0]
+
+        x = T.matrix('x', dtype=input_dtype)
+        self.predict_batch = theano.function([x], [logLayer.y_pred, logLayer.p_y_given_x],
+                                             givens={sda.x: decode_input(x)},
+                                             name='predict')
+
+    def __call__(self, data_x):
+        """ (y_pred, y_pred_prob) of the patches `data_x`, one per row """
+        data_x   = numpy.asarray(data_x, dtype=self.input_dtype)
+        nsamples = data_x.shape[0]
+
+        y_pred      = numpy.empty((nsamples,), dtype=numpy.int64)
+        y_pred_prob = numpy.empty((nsamples,self.n_outs), dtype=theano.config.floatX)
+        for begin in xrange(0, nsamples, self.batch_size):
+            batch = slice(begin, begin + self.batch_size)
+            (y_pred[batch], y_pred_prob[batch]) = self.predict_batch(data_x[batch])
+
+        return (y_pred, y_pred_prob)
+
+
+class FunctionCache(object):
+    """ Compile-once store of CompiledSdA, keyed by architecture, batch
+    size and floatX """
+
+    def __init__(self):
+        self.entries = {}
+        self.hits    = 0
+        self.misses  = 0
+
+    def key(self, options):
+        if options['retrain'] == 0:
+            return ('sda',
+                    options['ndim'],
+                    tuple(int(n) for n in options['hlayers']),
+                    options['nclasses'],
+                    options['batchsize'],
+                    options['test_batchsize'],
+                    options['cache_layer_outputs'],
+                    options['input_dtype'],
+                    theano.config.floatX)
+        else:
+            sda = options['sda_reuse_model']
+            # the values of each source model are copied into the compiled
+            # one (see CompiledSdA.reuse)
+            return ('reuse',
+                    tuple(layer.W.get_value(borrow=True).shape for layer in sda.sigmoid_layers),
+                    options['nclasses'],
+                    tuple(options['retrain_ft_layers']),
+                    options['batchsize'],
+                    options['test_batchsize'],
+                    options['input_dtype'],
+                    theano.config.floatX)
+
+    def get(self, options):
+        """ Returns the CompiledSdA for `options`
+
+        For a new model (retrain == 0) the weights are drawn from
+        options['numpy_rng'], as if the model was built from scratch.
+        """
+        key = self.key(options)
+
+        if key in self.entries:
+            self.hits = self.hits + 1
+            compiled  = self.entries[key]
+            if options['retrain'] == 0:
+                compiled.reset(options['numpy_rng'], options['seed'])
+            else:
+                compiled.reuse(options['sda_reuse_model'])
+            return compiled
+
+        self.misses = self.misses + 1
+        if options['verbose'] > 4:
+            print >> sys.stderr, ('... compiling functions for {0}'.format(key))
+
+        if options['retrain'] == 0:
+            theano_rng = RandomStreams(seed=options['seed'])
+            sda = SdA(numpy_rng=options['numpy_rng'], theano_rng=theano_rng,
+                      n_ins = options['ndim'],
+                      hidden_layers_sizes=options['hlayers'],
+                      n_outs=options['nclasses'], n_outs_b=options['nclasses'], tau=None)
+            compiled = CompiledSdA(sda, options['batchsize'], options['test_batchsize'],
+                                   theano_rng=theano_rng,
+                                   cache_layer_outputs=options['cache_layer_outputs'],
+                                   input_dtype=options['input_dtype'])
+        else:
+            sda = options['sda_reuse_model']
+            n_outs = sda.logLayer_b.b.get_value(borrow=True).shape[0]
+            if n_outs != options['nclasses']:
+                print >> sys.stderr, ("Droping logistic layer...")
+                sda.change_lastlayer(sda.logLayer_b.W.get_value(borrow=True).shape[0], options['nclasses'])
+            compiled = CompiledSdA(sda, options['batchsize'],
+                                   options['test_batchsize'],
+                                   update_layerwise=options['retrain_ft_layers'],
+                                   input_dtype=options['input_dtype'])
+            compiled.reuse(sda)
+
+        self.entries[key] = compiled
+        return compiled
+
+    def stats(self):
+        return "compiled models: {0:d} | hits: {1:d} | misses: {2:d}".format(
+            len(self.entries), self.hits, self.misses)
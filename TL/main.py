@@ -31,7 +31,7 @@ from theano.tensor.shared_randomstreams import RandomStreams
 
 from mlp import HiddenLayer
 from dA import dA
-from SdA import SdA
+from SdA import SdA, dataset_size
 
 # --------------------------------------------------------------------------------------------------------------- 
 import itertools, numpy
@@ -39,9 +39,25 @@ numpy.set_printoptions(threshold=numpy.nan)
 
 from theano.tensor.shared_randomstreams import RandomStreams
 
-from data_preprocessing import load_data, gen_folds, confusion_matrix
+from data_preprocessing import load_data, gen_folds, input_dtype, dataset_labels
 
-from data_handling import save_results, save_gzdata, load_savedgzdata
+from metrics import evaluate_errors, confusion_matrix
+
+from data_handling import save_results, save_gzdata, save_gzdata_atomic, load_savedgzdata
+
+from function_cache import FunctionCache
+from parallel import get_pool
+
+from checkpoint import Checkpoint, checkpoint_filename, remove_checkpoints, job_signature, \
+    experiment_signature, signature_filename, is_done
+from pretrain_cache import PretrainCache, pretrain_key
+from dataset_cache import get_cache
+from stopping import get_stopping
+from sampling import get_sampler
+from streaming import StreamingSet
+
+# compiled models, reused by every fold, combination and run
+function_cache = FunctionCache()
 
 
 # DEBUG INFORMATION
@@ -53,94 +69,56 @@ print >> sys.stderr, "\n\n ------------- CHECK GPU NUMBER ----------------------
 def print_usage():
     print './main.py datasetpath [retrain_ft_layers]'
  
-def evaluate_error(y_valid, y_pred, options ):
-    # F-Score
-    # label 0 = nano
-    # label 1 = back
+def get_thresholds(threshold):
+    # a single operating point or a list of them
+    if isinstance(threshold, (list, tuple, numpy.ndarray)):
+        return list(threshold)
+    return [threshold]
 
-    background   = 1
-    nanoparticle = 0
-    
-    TP = 0
-    FN = 0
-    FP = 0
-    TN = 0
-    
-    for ith in range(0,len(y_pred)):
-        if y_pred[ith]   == background   and y_valid[ith] == background:
-            TN = TN + 1
-        elif y_pred[ith] == nanoparticle and y_valid[ith] == background:
-            FP = FP + 1
-        elif y_pred[ith] == background   and y_valid[ith] == nanoparticle:
-            FN = FN + 1
-        elif y_pred[ith] == nanoparticle and y_valid[ith] == nanoparticle:
-            TP = TP + 1
-            
-    Recall    = TP / (TP+FN+0.0001)
-    Precision = TP / (TP+FP+0.0001)
-
-    if options['measure'] == 'fmeasure':
-        test_scores = 1 - 2*(Precision*Recall) / (Precision+Recall+0.0001)
-    elif options['measure'] == 'f1score':
-        test_scores = 1 - 2*TP / (2*TP + FP + FN + 0.0001)
-    elif options['measure'] == 'acc':
-        test_scores = 1 - (TP + TN) / ( TP + TN + FP + FN + 0.0001 )
-    elif options['measure'] == 'weightedmer':
-        weights = numpy.zeros( y_valid.shape, dtype=numpy.float32 )
-        ind = y_valid == background   # background
-
-        weights[ ind] = options['weight']
-        weights[~ind] = 1
-        
-        test_scores = weights * numpy.array(y_valid != y_pred, dtype=numpy.float)
-        test_scores = numpy.mean( test_scores )
-
-    elif options['measure'] == 'weightedmercls':
-        indback = y_valid == background
-        indnano = y_valid == nanoparticle
-        ninstback = sum(indback)
-        ninstnano = sum(indnano)
-
-        weightscls = numpy.zeros( y_valid.shape, dtype=numpy.float32 )
-        # print >> sys.stderr, "back: {0:f} | nano: {1:f}".format(ninstback,ninstnano)
-        val = numpy.minimum(ninstback,ninstnano)/(numpy.maximum(ninstback,ninstnano)*1.)
-        # print >> sys.stderr, val
-        
-        if ninstback > ninstnano:
-            weightscls[indnano] = 2-val
-            weightscls[indback] = 1
-        else:
-            weightscls[indnano] = 1
-            weightscls[indback] = 2-val
-        
-        weights = numpy.zeros( y_valid.shape, dtype=numpy.float32 )
-        ind = y_valid == background   # background
+def predict_thresholds(y_pred_prob, thresholds):
+    """ Predictions for every threshold, one row per threshold
 
-        weights[ ind] = options['weight']
-        weights[~ind] = 1
-        
-        test_scores = weightscls  * numpy.array(y_valid != y_pred, dtype=numpy.float)
-        test_scores = numpy.mean( test_scores )
-    
-    #print >> sys.stderr, test_scores
-    
-    return test_scores
+    A threshold of None stands for the argmax of the probabilities.
+    """
+    thresholds = get_thresholds(thresholds)
+    y_preds    = numpy.empty((len(thresholds),y_pred_prob.shape[0]), dtype=numpy.uint8)
+
+    cut = numpy.array([ t is not None for t in thresholds ])
+    if cut.any():
+        values = numpy.array([ t for t in thresholds if t is not None ], dtype=y_pred_prob.dtype)
+        y_preds[cut,:] = y_pred_prob[:,0][numpy.newaxis,:] < values[:,numpy.newaxis]
+    if not cut.all():
+        y_preds[~cut,:] = numpy.argmax( y_pred_prob, axis = 1 )
+
+    return y_preds
+
+def selection_threshold(threshold):
+    """ Operating point the model is selected on while finetuning: the
+    first threshold (None is the argmax), the same one for the whole job """
+    return get_thresholds(threshold)[0]
 
     
 # -------------------------------------------------------------------------------------
-def evaluate_model(sda,testdata,options):
+def score_model(sda,testdata,options,compiled=None):
+    """ Scores the model for every threshold in options['threshold']
 
-    train_set_x, train_set_y = testdata
-    
-    if options['retrain'] == 0:    
+    The thresholds are applied to the same probabilities, the model is
+    evaluated only once. The model itself was selected on the first
+    threshold (see selection_threshold).
+    """
+
+    if compiled is not None:
+        compiled.bind(test_set=testdata)
+        test_model = compiled.test_model
+    elif options['retrain'] == 0:    
         test_model = sda.build_test_function(
             dataset       = testdata,
-            batch_size    = 1, # options['batchsize']
+            batch_size    = options['test_batchsize'],
             )
     else:
         test_model = sda.build_test_function_reuse(
             dataset       = testdata,
-            batch_size    = 1, #options['batchsize'],
+            batch_size    = options['test_batchsize'],
         )
 
     # print sda.params[1].get_value()[-1]
@@ -150,19 +128,25 @@ def evaluate_model(sda,testdata,options):
     (ytest,ypred,ypred_prob) = test_model()
 
     print >> sys.stderr, "Test GT Differences: "
-    print >> sys.stderr, sum(ytest != train_set_y.eval())
+    print >> sys.stderr, sum(ytest != dataset_labels(testdata))
 
     if options['oneclass'] == True:
         options['nclasses'] = 2
     
     # ypred      = numpy.array( ypred_prob[:,0] < options['threshold'], dtype=numpy.uint8)
-    if options['threshold'] != None:
-        ypred = numpy.array( ypred_prob[:,0] < options['threshold'], dtype=numpy.uint8)
-    else:
-        ypred = numpy.argmax( ypred_prob, axis = 1 )
+    ypreds      = predict_thresholds( ypred_prob, options['threshold'] )
+    test_scores = evaluate_errors( ytest, ypreds, options )
 
-    
-    test_score = evaluate_error( ytest, ypred, options )
+    return (test_scores, ytest, ypreds)
+
+def evaluate_model(sda,testdata,options,compiled=None):
+
+    (test_scores, ytest, ypreds) = score_model(sda,testdata,options,compiled)
+
+    # best operating point
+    best       = numpy.argmin( test_scores )
+    test_score = test_scores[best]
+    ypred      = ypreds[best]
 
     cm = confusion_matrix( ytest, ypred, options['nclasses'] )
 
@@ -176,26 +160,85 @@ def evaluate_model(sda,testdata,options):
     return (test_score, ytest, ypred)
     
 # -------------------------------------------------------------------------------------
-def pretrain_finetune_model(sda,pretraining_fns,train_set,test_set,options):
-    train_set_x, train_set_y = train_set
-
-    n_train_batches  = train_set_x.get_value(borrow=True).shape[0]
+def stream_state(compiled):
+    # position of the training stream, if the training set is streamed
+    if compiled.stream is None:
+        return None
+    return compiled.stream.state()
+
+def pretrain_finetune_model(sda,compiled,train_set,test_set,options):
+    compiled.bind(train_set=train_set, valid_set=test_set)
+    pretraining_fns = compiled.pretraining_fns
+    train_fn        = compiled.train_fn
+    validate_model  = compiled.validate_model
+
+    n_train_batches  = dataset_size(train_set)
     n_train_batches /= options['batchsize']
 
+    # resume from the last checkpointed epoch of this job, if any
+    checkpoint = Checkpoint(options['checkpoint'], job_signature(options), options['checkpoint_interval'])
+    saved      = checkpoint.load()
+    if saved is not None:
+        checkpoint.restore(sda, compiled.theano_rng, saved)
+        saved.setdefault('epochs', [])
+        if compiled.stream is not None and saved.get('stream') is not None:
+            compiled.stream.set_state(saved['stream'])
+    else:
+        saved = {'phase': 'pretrain', 'layer': 0, 'epoch': -1, 'pretrain_time': 0., 'epochs': []}
+
     if options['retrain'] == 0:    
     
-        bestmodelsda = copy.copy( sda )
         # -----------------------------------------------
         # PRETRAINING
         # -----------------------------------------------  
         if options['verbose'] > 5:
             print >> sys.stderr, ('... pre-training the model')
-        start_time = time.clock()
+        start_time = time.clock() - saved['pretrain_time']
         ## Pre-train layer-wise
         corruption_levels = options['corruptlevels']
-        for i in xrange(sda.n_layers):
+        if saved['phase'] == 'pretrain':
+            first_layer = saved['layer']
+        else:
+            first_layer = sda.n_layers
+
+        # the same stack may have been pretrained for another combination;
+        # it is only memoized when this call pretrains layers, a job
+        # resumed in finetuning holds finetuned parameters
+        memo = None
+        if options['pretrain_cache'] is not None and saved['phase'] == 'pretrain' and first_layer < sda.n_layers:
+            memo     = PretrainCache(options['pretrain_cache'], options['pretrain_cache_size'])
+            memo_key = pretrain_key(options, train_set)
+            entry    = memo.load(memo_key)
+            if entry is not None:
+                memo.restore(sda, entry)
+                saved['epochs'] = entry['epochs']
+                first_layer = sda.n_layers
+                memo = None
+                # timed as the pretraining that produced the stack, so
+                # the times of all combinations are comparable
+                start_time = time.clock() - entry['pretrain_time']
+
+        # epochs reached by each layer
+        reached  = saved['epochs'][0:first_layer]
+        stopping = get_stopping(options, compiled)
+        for i in xrange(first_layer, sda.n_layers):
+            if i == saved['layer']:
+                first_epoch = saved['epoch'] + 1
+            else:
+                first_epoch = 0
+            stopping.start(i)
+            if i == saved['layer'] and 'stopping' in saved:
+                # resumed within the layer
+                stopping.set_state(saved['stopping'])
+            epoch = first_epoch - 1
+
+            # the trained layers below are run once over the training
+            # set (all of them when resuming)
+            if compiled.encode is not None and i > 0:
+                for j in xrange(1 if i == first_layer else i, i + 1):
+                    compiled.encode(j, options['cache_layer_folder'])
             # go through pretraining epochs
-            for epoch in xrange(options['pretraining_epochs']):
+            for epoch in xrange(first_epoch, options['pretraining_epochs']):
                 # go through the training set
                 c = []
                 for batch_index in xrange(n_train_batches):
@@ -206,35 +249,39 @@ def pretrain_finetune_model(sda,pretraining_fns,train_set,test_set,options):
                 if epoch % 100 == 0 and options['verbose'] > 5:
                     print >> sys.stderr, ('Pre-training layer %02i, epoch %04d, cost ' % (i, epoch)),
                     print >> sys.stderr, (numpy.mean(c))
+
+                stop = stopping.stop(epoch, numpy.mean(c))
+                if checkpoint.due(epoch + 1) and not stop:
+                    checkpoint.save(sda, compiled.theano_rng,
+                                    {'phase': 'pretrain', 'layer': i, 'epoch': epoch,
+                                     'pretrain_time': time.clock() - start_time,
+                                     'epochs': reached,
+                                     'stopping': stopping.state(),
+                                     'stream': stream_state(compiled)})
+
+                if stop:
+                    if options['verbose'] > 4:
+                        print >> sys.stderr, ('Pre-training layer %02i stopped at epoch %04d' % (i, epoch))
+                    break
+            reached = reached + [epoch + 1]
+            saved['epochs'] = reached
+
         end_time = time.clock()
+        saved['pretrain_time'] = end_time - start_time
+        if memo is not None:
+            memo.save(memo_key, sda, end_time - start_time, saved['epochs'])
+        options['pretraining_epochs_reached'] = saved['epochs']
         if options['savetimes']:
             filename = '{0:s}/times_pr_{1:03d}_{2:03d}.pkl.gz'.format(options['outputfolderres'],options['nrun'],string.atoi(options['resolution']))
             save_gzdata(filename, end_time - start_time)
+            filename = '{0:s}/epochs_pr_{1:03d}_{2:03d}.pkl.gz'.format(options['outputfolderres'],options['nrun'],string.atoi(options['resolution']))
+            save_gzdata(filename, saved['epochs'])
         
         if options['verbose'] > 4:
             print  >> sys.stderr, ('The pretraining code for file ' +
                                    os.path.split(__file__)[1] +
                                    ' ran for %.2fm' % ((end_time - start_time) / 60.))
 
-        # get the training, validation and testing function for the model
-        #dataset = [folds[0][0], folds[1][0], folds[2]]
-        dataset = [train_set, test_set]
-    
-        if options['verbose'] > 5:
-            print >> sys.stderr,('... getting the finetuning functions')
-        train_fn, validate_model = sda.build_finetune_functions(
-            datasets=dataset,
-            batch_size=options['batchsize'],
-            learning_rate=options['finetune_lr']
-        )
-
-    else:
-        dataset = [train_set, test_set]
-
-        train_fn, validate_model = sda.build_finetune_functions_reuse(
-            datasets=dataset, batch_size=options['batchsize'],
-            learning_rate=options['finetune_lr'], update_layerwise=options['retrain_ft_layers'])
-        
     # ------------------------------------------------------------------------------------------------
         
     # -----------------------------------------------
@@ -254,17 +301,51 @@ def pretrain_finetune_model(sda,pretraining_fns,train_set,test_set,options):
                                   # check every epoch
 
     best_validation_loss = numpy.inf
+    best_iter = 0
     test_score = 0.
 
-    start_time = time.clock()
-
     done_looping = False
     epoch = 0
+    finetune_time = 0.
+
+    # the best model is kept as a snapshot of the parameter values
+    sda.snapshot()
+
+    if saved['phase'] != 'pretrain':
+        sda.snapshot( saved['best'] )
+        epoch                = saved['epoch']
+        patience             = saved['patience']
+        best_validation_loss = saved['best_validation_loss']
+        best_iter            = saved['best_iter']
+        done_looping         = saved['done_looping']
+        finetune_time        = saved['finetune_time']
+
+    start_time = time.clock() - finetune_time
+
+    if compiled.stream is not None and saved['phase'] == 'pretrain':
+        # finetuning epochs are numbered from the first one, whether the
+        # stack was pretrained here or taken from the memo
+        compiled.stream.set_state({'epoch': -1})
+
+    # class-balanced or weighted minibatches, drawn by index
+    sampler = get_sampler( options, dataset_labels(train_set) )
+    if sampler is not None and isinstance(train_set, StreamingSet):
+        # the stream starts over in the order of the sampler
+        compiled.stream.close()
+        compiled.stream.sampler = sampler
+    elif sampler is not None:
+        train_rows = compiled.train[2].get_value(borrow=True)
 
     while (epoch < options['training_epochs']) and (not done_looping):
         epoch = epoch + 1
+        if sampler is not None and not isinstance(train_set, StreamingSet):
+            # the draws of an epoch only depend on it, so a resumed job
+            # sees the same minibatches
+            rng = numpy.random.RandomState([options['seed'], epoch])
+            compiled.train[2].set_value(train_rows[sampler.draw(rng)], borrow=True)
+
         for minibatch_index in xrange(n_train_batches):
-            minibatch_avg_cost = train_fn(minibatch_index)
+            minibatch_avg_cost = train_fn(minibatch_index, lr=options['finetune_lr'])
 
             iter = (epoch - 1) * n_train_batches + minibatch_index
 
@@ -279,13 +360,12 @@ def pretrain_finetune_model(sda,pretraining_fns,train_set,test_set,options):
                 # raw_input()
                 # alll
 
-                # we are going to control the predictions according to their prob
-                if options['threshold'] != None:
-                    y_pred = numpy.array( y_pred_prob[:,0] < options['threshold'], dtype=numpy.uint8)
-                else:
-                    y_pred = numpy.argmax( y_pred_prob, axis = 1 )
-
-                this_validation_loss = evaluate_error( y_valid, y_pred, options )
+                # we are going to control the predictions according to their prob;
+                # early stopping and the best model follow one operating
+                # point, the other thresholds are only scored on the
+                # selected model (see score_model)
+                y_pred = predict_thresholds( y_pred_prob, selection_threshold(options['threshold']) )[0]
+                this_validation_loss = evaluate_errors( y_valid, y_pred, options )
 
                 # if epoch % 10 == 0:
                 #     cm = confusion_matrix(y_valid, y_pred, options['nclasses'])
@@ -308,7 +388,7 @@ def pretrain_finetune_model(sda,pretraining_fns,train_set,test_set,options):
 
                 # if we got the best validation score until now
                 if this_validation_loss < best_validation_loss:
-                    bestmodelsda = copy.copy(sda)
+                    sda.snapshot()
 
                     # % ------------------------------------------------------------
                     if options['oneclass'] == True:
@@ -346,14 +426,33 @@ def pretrain_finetune_model(sda,pretraining_fns,train_set,test_set,options):
                         done_looping = True
                         break
 
+        if checkpoint.due(epoch) or done_looping or epoch == options['training_epochs']:
+            checkpoint.save(sda, compiled.theano_rng,
+                            {'phase': 'finetune', 'epoch': epoch,
+                             'patience': patience,
+                             'best_validation_loss': best_validation_loss,
+                             'best_iter': best_iter,
+                             'best': sda.snapshot_values(),
+                             'done_looping': done_looping,
+                             'pretrain_time': saved['pretrain_time'],
+                             'epochs': saved['epochs'],
+                             'stream': stream_state(compiled),
+                             'finetune_time': time.clock() - start_time})
+
     end_time = time.clock()
 
+    if sampler is not None and not isinstance(train_set, StreamingSet):
+        compiled.train[2].set_value(train_rows, borrow=True)
+
     if options['savetimes']:
         filename = '{0:s}/times_fn_{1:03d}_{2:03d}.pkl.gz'.format(options['outputfolderres'],options['nrun'],string.atoi(options['resolution']))
         save_gzdata(filename, end_time - start_time)
 
     print >> sys.stderr, ("Stopped at epoch %04i" % epoch )
-    return (best_validation_loss,bestmodelsda)
+
+    # the returned model is the best one, not the last one
+    sda.restore_snapshot()
+    return (best_validation_loss,sda)
     
 # -------------------------------------------------------------------------------------
 def build_model(trainval_set, options):
@@ -364,57 +463,79 @@ def build_model(trainval_set, options):
             print >> sys.stderr, ('... building the model')
         # construct the stacked denoising autoencoder class
     
-        train_set_x, train_set_y = trainval_set
-
         #print train_set_x.get_value(borrow=True).shape
         #print train_set_y.shape.eval()
 
-        n_train_batches  = train_set_x.get_value(borrow=True).shape[0]
-        n_train_batches /= options['batchsize']
-
         #print >> sys.stderr, options['nclasses']
         #print >> sys.stderr, train_set_y.eval()
         #aakak
-        
-        sda = SdA(numpy_rng=options['numpy_rng'], theano_rng=options['theano_rng'],
-                  n_ins = options['ndim'],
-                  hidden_layers_sizes=options['hlayers'],
-                  n_outs=options['nclasses'], n_outs_b=options['nclasses'], tau=None)
 
-        if options['verbose'] > 4:
-            print >> sys.stderr, ('... getting the pretraining functions')
-        pretraining_fns = sda.pretraining_functions(train_set_x=train_set_x,
-                                                    batch_size=options['batchsize'], tau=None)
+        # the functions are compiled only once per architecture and
+        # batch size; the model gets new initial weights from numpy_rng
+        compiled = function_cache.get(options)
+        sda      = compiled.sda
 
     else:
-        # Restoring to Finetuned values
-        sda_reuse_pt_model = []
-        for para_copy in options['sda_reuse_model'].params:
-            sda_reuse_pt_model.append(para_copy.get_value())
-
-        ###
-        sda = options['sda_reuse_model']
-        
-        for ids in range(len(sda.params)):
-            sda.params_b[ids].set_value(sda_reuse_pt_model[ids]) # set the value
-
-
-        n_outs = sda.params_b[-2].get_value().shape[0]        
-        if options['nclasses_source'] != options['nclasses']:
-            print >> sys.stderr, ("Droping logistic layer...")
-            sda.change_lastlayer(n_outs,options['nclasses'])
-
-        # print sda.params[1].get_value()[-1]
-        # print sda.params_b[1].get_value()[-1]
-        # kkk
+        # Restoring to Finetuned values: the compiled model takes the
+        # values of the source model, and a new logistic layer when the
+        # number of classes changes (see CompiledSdA.reuse)
 
         ########### Reuse layer wise fine-tuning #################
         #print '... getting the finetuning functions'
         #print 'Reuse layer wise finetuning'
-        pretraining_fns = None
+        compiled = function_cache.get(options)
+        sda      = compiled.sda
         
-    return (sda,pretraining_fns)
+    return (sda,compiled)
+
 
+# -------------------------------------------------------------------------------------
+def job_seed(nrun, k, cv):
+    # each (run, combination, fold) job has its own random streams, so
+    # the results do not depend on which process runs it, or when
+    return numpy.random.RandomState([nrun, k, cv]).randint(2 ** 30)
+
+# folds and options of the cross validation, inherited by the workers
+_cv_state = {}
+
+def run_cv_job(job):
+    """ Trains combination k on fold cv and returns its test error, one
+    per threshold """
+    (k, cv) = job
+    folds   = _cv_state['folds']
+
+    modeloptions = copy.copy( _cv_state['gridoptions'][k] )
+    # combinations with the same pretraining share their seed, and so
+    # their pretrained stack
+    seed = job_seed(_cv_state['nrun'], modeloptions['pretrain_id'], cv)
+    modeloptions['numpy_rng'] = numpy.random.RandomState(seed)
+    modeloptions['seed']      = seed
+    modeloptions['checkpoint'] = checkpoint_filename(modeloptions, _cv_state['nrun'],
+                                                     'job_{0:03d}_{1:02d}'.format(k,cv))
+
+    trainset = folds[0]
+    valset   = folds[1]
+    testset  = folds[2]
+
+    # print >> sys.stderr, sda_reuse_model
+    (sda,compiled) = build_model(trainset[cv],modeloptions)
+    # print >> sys.stderr, sda
+    sda  = pretrain_finetune_model(sda,compiled,
+                                   trainset[cv],
+                                   valset[cv],
+                                   modeloptions)[1]
+    merrori = score_model(sda,testset[cv],modeloptions,compiled)[0]
+
+    # from now on the grid file keeps the result of this job
+    Checkpoint(modeloptions['checkpoint'], None, None).remove()
+    return merrori
+
+def imap_phases( pool, fn, phases ):
+    """ pool.imap of fn over each list of `phases` in turn: a phase is
+    given to the pool once the previous one is done """
+    for phase in phases:
+        for result in pool.imap( fn, phase ):
+            yield result
 
 # -------------------------------------------------------------------------------------
 def do_experiment( folds, options, nrun, sda_reuse_model ):
@@ -428,7 +549,6 @@ def do_experiment( folds, options, nrun, sda_reuse_model ):
         options['pretrain_lr'],
         options['finetune_lr'],
         options['batchsize'],
-        options['threshold'],
         options['corruptlevels']
     )
     )
@@ -437,11 +557,11 @@ def do_experiment( folds, options, nrun, sda_reuse_model ):
     
     print >> sys.stderr, ('Number of combinations {0:03d}'.format(len(param)))
 
-    step = 0
-    besterror = numpy.inf
     # ---------------------------------------------------------------
     # cross validation
     # ---------------------------------------------------------------
+    gridoptions = []
+    pretrain_ids = {}
     for k in range(0,len(param)):
         
         (nneurons,
@@ -451,7 +571,6 @@ def do_experiment( folds, options, nrun, sda_reuse_model ):
          pretrain_lr,
          finetune_lr,
          batchsize,
-         threshold,
          corruptlevels) = param[k]
 
         modeloptions = {
@@ -462,13 +581,18 @@ def do_experiment( folds, options, nrun, sda_reuse_model ):
             'retrain'            : options['retrain'],
             'verbose'            : options['verbose'],
             'ndim'               : options['ndim'],
+            'input_dtype'        : options['input_dtype'],
+            'dataset_key'        : options['dataset_key'],
+            'signature'          : options['signature'],
             'nclasses_source'    : options['nclasses_source'],
             'nclasses'           : options['nclasses'],
             'numpy_rng'          : options['numpy_rng'],
             'theano_rng'         : options['theano_rng'],
+            'seed'               : options['seed'],
             'measure'            : options['measure'],
             'oneclass'           : options['oneclass'],
             'batchsize'          : batchsize,
+            'test_batchsize'     : options['test_batchsize'],
             'hlayers'            : nneurons * numpy.ones((hlayers,)),
             # numpy.array(nneurons * numpy.ones((hlayers,)) * (1/(2*numpy.arange(1,hlayers+1)*1.)),dtype=numpy.int),
             'corruptlevels'      : corruptlevels*numpy.ones((hlayers,),dtype=numpy.float32),
@@ -476,46 +600,116 @@ def do_experiment( folds, options, nrun, sda_reuse_model ):
             'training_epochs'    : training_epochs,
             'pretrain_lr'        : pretrain_lr,
             'finetune_lr'        : finetune_lr,
-            'threshold'          : threshold,
+            # thresholds are post-hoc operating points, all of them
+            # are scored from the same trained model
+            'threshold'          : get_thresholds(options['threshold']),
             'sda_reuse_model'    : sda_reuse_model,
             'retrain_ft_layers'  : options['retrain_ft_layers'],
             'weight'             : options['weight'],
+            'replicate'          : options['replicate'],
+            'sampler'            : options['sampler'],
+            'sampler_weights'    : options['sampler_weights'],
+            'checkpoint'         : None,
+            'checkpoint_interval': options['checkpoint_interval'],
+            'cache_layer_outputs': options['cache_layer_outputs'],
+            'cache_layer_folder' : options['cache_layer_folder'],
+            'pretrain_cache'     : options['pretrain_cache'],
+            'pretrain_cache_size': options['pretrain_cache_size'],
+            'pretrain_stop'         : options['pretrain_stop'],
+            'pretrain_stop_tol'     : options['pretrain_stop_tol'],
+            'pretrain_stop_window'  : options['pretrain_stop_window'],
+            'pretrain_stop_patience': options['pretrain_stop_patience'],
+            'pretrain_stop_seconds' : options['pretrain_stop_seconds'],
+            'pretrain_id'        : pretrain_ids.setdefault((nneurons, hlayers, pretraining_epochs,
+                                                            pretrain_lr, batchsize, corruptlevels),
+                                                           len(pretrain_ids)),
         }
-        if k == 0:
-            bestmodeloptions = copy.copy( modeloptions )
+        gridoptions.append( modeloptions )
+
+    # every (combination, fold) pair is an independent job
+    jobs = [ (k,cv) for k in range(0,len(param)) for cv in range(0,options['folds']) ]
+
+    # errors of the jobs finished before a restart
+    gridfile = checkpoint_filename(options, nrun, 'grid')
+    done     = {}
+    if os.path.isfile(gridfile):
+        grid = load_savedgzdata(gridfile)
+        if grid['param'] == param and grid.get('signature') == options['signature']:
+            done = grid['errors']
+    pending = [ job for job in jobs if job not in done ]
+
+    if options['nworkers'] > 1 and options['pretrain_cache'] is not None:
+        # the first job of each pretraining (pretrain_id, fold) runs
+        # before the jobs that reuse its stack, so they do not all miss
+        # the memo and pretrain the same stack at once
+        first = {}
+        for (k,cv) in pending:
+            first.setdefault((gridoptions[k]['pretrain_id'],cv), (k,cv))
+        leaders = [ job for job in pending if job in first.values() ]
+        pending = leaders + [ job for job in pending if job not in first.values() ]
+    else:
+        leaders = pending
+    print >> sys.stderr, ('Jobs already done: {0:03d} of {1:03d}'.format(len(jobs)-len(pending),len(jobs)))
+
+    global _cv_state
+    _cv_state = { 'folds': folds, 'gridoptions': gridoptions, 'nrun': nrun }
 
-        if modeloptions['verbose'] > 2:
+    if options['nworkers'] > 1 and len(pending) > 0:
+        pool   = get_pool( options['nworkers'], options['blas_threads'] )
+        errors = imap_phases( pool, run_cv_job, [leaders, pending[len(leaders):]] )
+    else:
+        pool   = None
+        errors = itertools.imap( run_cv_job, pending )
+
+    # best mean error over the combinations with every fold done, as the
+    # progress line showed when the jobs ran in order
+    def mean_error(k):
+        return numpy.min( sum( done[(k,cv)] for cv in range(0,options['folds']) ) / options['folds'] )
+    complete  = [ k for k in range(0,len(param))
+                  if all( (k,cv) in done for cv in range(0,options['folds']) ) ]
+    besterror = min( [ mean_error(k) for k in complete ] + [ numpy.inf ] )
+
+    for step, ((k,cv), merrori) in enumerate( itertools.izip( pending, errors ) ):
+        if cv == 0 and gridoptions[k]['verbose'] > 2:
             print >> sys.stderr, "######################################################"
             print >> sys.stderr, "                     CROSS-VAL                        "
             print >> sys.stderr, "######################################################"
-            print >> sys.stderr, modeloptions
-
-        merror  = 0
-        merrori = 0
-        for cv in range(0,options['folds']):
-            counter = step/(len(param)*options['folds']*1.)
-            print >> sys.stderr, ('###### {t:0{format}.1f}% ({e:0.2f})'.format(format=5,t=counter*100,e=besterror) )
-            trainset = folds[0]
-            valset   = folds[1]
-            testset  = folds[2]
-
-            # print >> sys.stderr, sda_reuse_model
-            (sda,pretraining_fns) = build_model(trainset[cv],modeloptions)
-            # print >> sys.stderr, sda
-            sda  = pretrain_finetune_model(sda,pretraining_fns,
-                                           trainset[cv],
-                                           valset[cv],
-                                           modeloptions)[1]
-            merrori = evaluate_model(sda,testset[cv],modeloptions)[0]
-            merror  = merror + merrori
-            # print >> sys.stderr, sda, sda_reuse_model
-            
-            step = step + 1
-        merror = merror / options['folds']
-
-        if merror < besterror:
-            besterror        = merror
+            print >> sys.stderr, gridoptions[k]
+
+        done[(k,cv)] = merrori
+        if all( (k,f) in done for f in range(0,options['folds']) ):
+            besterror = min( besterror, mean_error(k) )
+
+        counter = (step+1)/(len(pending)*1.)
+        print >> sys.stderr, ('###### {t:0{format}.1f}% ({e:0.2f})'.format(format=5,t=counter*100,e=besterror) )
+
+        save_gzdata_atomic(gridfile, {'param': param, 'errors': done, 'signature': options['signature']})
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # one error per threshold
+    merrors = [ 0 ] * len(param)
+    for (k,cv) in jobs:
+        merrors[k] = merrors[k] + done[(k,cv)]
+
+    # the selection goes through the combinations in order, whatever the
+    # order the jobs finished
+    besterror = numpy.inf
+    for k in range(0,len(param)):
+        modeloptions = gridoptions[k]
+        if k == 0:
+            bestmodeloptions = copy.copy( modeloptions )
+            bestmodeloptions['threshold'] = modeloptions['threshold'][0]
+
+        merror = merrors[k] / options['folds']
+        bestth = numpy.argmin( merror )
+
+        if merror[bestth] < besterror:
+            besterror        = merror[bestth]
             bestmodeloptions = copy.copy( modeloptions )
+            bestmodeloptions['threshold'] = modeloptions['threshold'][bestth]
 
     # print >> sys.stderr, "------------------------------"
     # -------------------------------------------------------------------
@@ -532,23 +726,24 @@ def do_experiment( folds, options, nrun, sda_reuse_model ):
     
     bestmodeloptions['savetimes'] = True 
     bestmodeloptions['nrun']      = nrun
+    bestmodeloptions['checkpoint'] = checkpoint_filename(options, nrun, 'final')
 
     # print >> sys.stderr, sda_reuse_model
     start_time = time.clock()
-    (sda,pretraining_fns) = build_model(trainset, bestmodeloptions)
+    (sda,compiled) = build_model(trainset, bestmodeloptions)
     end_time = time.clock()
     
     pretrain_time = end_time - start_time
 
     start_time = time.clock()
-    sda = pretrain_finetune_model(sda, pretraining_fns,
+    sda = pretrain_finetune_model(sda, compiled,
                                   trainset,
                                   valset,
                                   bestmodeloptions)[1]
     end_time = time.clock()
     finetune_time = end_time - start_time
     
-    result = evaluate_model( sda, testset, bestmodeloptions )
+    result = evaluate_model( sda, testset, bestmodeloptions, compiled )
     # print >> sys.stderr, sda, sda_reuse_model
     print >> sys.stderr, "time pretrain: {0:f} | time fine-tune: {1:f}".format(pretrain_time, finetune_time)
     result = result + ( pretrain_time, finetune_time )
@@ -561,6 +756,65 @@ def do_experiment( folds, options, nrun, sda_reuse_model ):
     
     return result
 
+# -----------------------------------------------------------------------------------------------------
+# dataset and options of TL, inherited by the workers
+_run_state = {}
+
+def run_experiment( nrun ):
+    """ One independent repetition: folds, cross validation, final model
+    and its res_*, *_model.pkl.gz and *_ids.pkl.gz files """
+    dataset = _run_state['dataset']
+    options = copy.copy( _run_state['options'] )
+
+    filename = '{0:s}/res_{1:05d}_{2:03d}.pkl.gz'.format(options['outputfolderres'],nrun,string.atoi(options['resolution']))
+    if options['resume'] and is_done(options, nrun, filename):
+        print >> sys.stderr, ("### {0:03d} of {1:03d} already done".format(nrun,options['nruns']))
+        return nrun
+
+    # checkpoints of another experiment are not resumed
+    gridfile = checkpoint_filename(options, nrun, 'grid')
+    if not options['resume'] or \
+       (os.path.isfile(gridfile) and load_savedgzdata(gridfile).get('signature') != options['signature']):
+        remove_checkpoints(options, nrun)
+
+    print >> sys.stderr, ("### {0:03d} of {1:03d}".format(nrun,options['nruns']))
+    options['numpy_rng']  = numpy.random.RandomState(nrun)
+    options['theano_rng'] = RandomStreams(seed=nrun)
+    options['seed']       = nrun
+
+    # --------------
+    # generate folds
+    folds = gen_folds( dataset, options, nrun )    
+    # continue
+    
+    if options['retrain'] == 1:
+        filename = "{0:s}/{1:05d}_{2:03d}_model.pkl.gz".format(options['sourcemodelspath'], nrun,
+                                                          string.atoi(options['resolution_source']))
+        print >> sys.stderr, ":: Loading model {0:s}...\n".format(filename)
+        sda_reuse_model = load_savedgzdata ( filename )
+
+        #print sda_reuse_model.logLayer.W.get_value()
+        #print sda_reuse_model.logLayer.W.get_value()
+        #kkk
+        
+    else:
+        sda_reuse_model = None
+
+    # ----------------------------------------------------------------------------
+    results = do_experiment( folds, options, nrun, sda_reuse_model )
+    # ----------------------------------------------------------------------------
+
+    # --------------------------------------------------
+    filename = '{0:s}/res_{1:05d}_{2:03d}.pkl.gz'.format(options['outputfolderres'],nrun,string.atoi(options['resolution']))
+    save_results(filename,results)
+    save_gzdata_atomic(signature_filename(options, nrun), options['signature'])
+    remove_checkpoints(options, nrun)
+
+    if options['verbose'] > 0:
+        print >> sys.stderr, function_cache.stats()
+
+    return nrun
+
 # -----------------------------------------------------------------------------------------------------
 def TL(
         source, target = None,
@@ -587,7 +841,9 @@ def TL(
         'weight'            : 200,
         'datanormalize'     : True,
         # ---------- one-class learning
-        'replicate'         : False,
+        'replicate'         : False,      # balanced minibatches; same as sampler 'balanced'
+        'sampler'           : None,       # finetuning minibatches: None, 'balanced' or 'weighted' (see sampling)
+        'sampler_weights'   : {0: 1., 1: 1.},  # share of each class (0 = nano, 1 = back) with 'weighted'
         'oneclass'          : False,
         # ---------- source problem params
         'database_source'   : 'db2',
@@ -602,6 +858,29 @@ def TL(
         # ---------- hyperparams
         'nruns'             : 20,
         'folds'             : 3,
+        # ---------- parallel execution of the (combination, fold) jobs
+        'nworkers'          : 1,          # processes; 1 runs the jobs sequentially
+        'nworkers_runs'     : 1,          # processes running whole repetitions (nruns) at once
+        'blas_threads'      : None,       # BLAS threads per worker; None shares the cores
+        # ---------- checkpoints
+        'resume'            : True,       # skip finished runs/jobs, continue from the last checkpoint
+        'checkpoint_interval': 100,       # epochs between checkpoints; None disables them
+        # ---------- pretraining
+        'cache_layer_outputs': True,      # pretrain each layer on the cached output of the layer below
+        'cache_layer_folder' : None,      # memory-map the cached outputs in this folder; None keeps them in memory
+        # ---------- data
+        'load_workers'       : 4,         # processes reading the .mat files when the patch store is written
+        'dataset_cache'      : outputfolder + '/dataset_cache',  # converted datasets (patch stores), by source files and options; the dataset folder may be read-only
+        'dataset_cache_size' : 20e9,      # bytes; the least recently used stores are removed beyond it
+        'streaming'          : False,     # read the training sets from the patch store while training
+        'stream_chunk'       : 50,        # minibatches per chunk read in the background
+        'pretrain_cache'     : outputfolder + '/pretrain_cache',  # pretrained stacks shared by finetune-only combinations; None disables it
+        'pretrain_cache_size': 2e9,       # bytes; the least recently used stacks are removed beyond it
+        'pretrain_stop'      : [],        # any of 'plateau', 'heldout', 'time'; [] runs every pretraining epoch
+        'pretrain_stop_tol'  : 1e-3,      # relative improvement below which the cost has flattened
+        'pretrain_stop_window': 50,       # epochs per plateau window / between held-out checks
+        'pretrain_stop_patience': 5,      # held-out checks without improvement
+        'pretrain_stop_seconds': 3600,    # wall-clock budget per layer
         'hlayers'           : [len(retrain_ft_layers) / 2],    # X hidden + 1 log layer
         'nneurons'          : [ 1000],     # range(500, 1001, 250),
         'pretraining_epochs': [ 1000],     # [200]
@@ -610,6 +889,7 @@ def TL(
         'finetune_lr'       : [ 0.1 , 0.01],  #[ 0.1, 0.01],
         'threshold'         : [0.8], #[ 0.5 , 0.6, 0.8], #numpy.arange(.5,1.01,.1),
         'batchsize'         : [ batchsize], #[100] or [1000] depending on the size of the dataset. 
+        'test_batchsize'    : 5000,       # samples per call of the test function
         # ---------- end of hyperparams
         'corruptlevels'     : [0.1], #numpy.arange(0.1, 0.4, 0.1)
     }
@@ -633,40 +913,37 @@ def TL(
         options['resolution'] = options['resolution_source']
 
     (dataset, ndim, nclasses)   = load_data( datasetpath, options )
+    print >> sys.stderr, get_cache( options['dataset_cache'], options['dataset_cache_size'] ).stats()
     options['ndim']     = ndim
     options['nclasses'] = nclasses
+    options['input_dtype'] = input_dtype( dataset, options )
+    options['dataset_key'] = dataset.key
+    options['signature']   = experiment_signature( options )
+    if options['streaming']:
+        # the cached layer outputs would span the whole training set
+        options['cache_layer_outputs'] = False
 
     # --------------------------------------------------------------------------------------------
-    for nrun in range(1,options['nruns']+1):
-        print >> sys.stderr, ("### {0:03d} of {1:03d}".format(nrun,options['nruns']))
-        options['numpy_rng']  = numpy.random.RandomState(nrun)
-        options['theano_rng'] = RandomStreams(seed=nrun)
-
-        # --------------
-        # generate folds
-        folds = gen_folds( dataset, options, nrun )    
-        # continue
-        
-        if options['retrain'] == 1:
-            filename = "{0:s}/{1:05d}_{2:03d}_model.pkl.gz".format(options['sourcemodelspath'], nrun,
-                                                              string.atoi(options['resolution_source']))
-            print >> sys.stderr, ":: Loading model {0:s}...\n".format(filename)
-            sda_reuse_model = load_savedgzdata ( filename )
-
-            #print sda_reuse_model.logLayer.W.get_value()
-            #print sda_reuse_model.logLayer.W.get_value()
-            #kkk
-            
-        else:
-            sda_reuse_model = None
-
-        # ----------------------------------------------------------------------------
-        results = do_experiment( folds, options, nrun, sda_reuse_model )
-        # ----------------------------------------------------------------------------
-    
-        # --------------------------------------------------
-        filename = '{0:s}/res_{1:05d}_{2:03d}.pkl.gz'.format(options['outputfolderres'],nrun,string.atoi(options['resolution']))
-        save_results(filename,results)
+    runs = range(1,options['nruns']+1)
+
+    if options['nworkers_runs'] > 1:
+        # the dataset is placed once in shared memory and read by all workers
+        dataset = dataset.shared()
+        # workers of a pool cannot start pools of their own
+        options['nworkers'] = 1
+
+    global _run_state
+    _run_state = { 'dataset': dataset, 'options': options }
+
+    if options['nworkers_runs'] > 1:
+        pool = get_pool( options['nworkers_runs'], options['blas_threads'] )
+        for nrun in pool.imap_unordered( run_experiment, runs ):
+            print >> sys.stderr, ("### run {0:03d} finished".format(nrun))
+        pool.close()
+        pool.join()
+    else:
+        for nrun in runs:
+            run_experiment( nrun )
         
     #-------------end testing the SdA
 
@@ -0,0 +1,130 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+# ------------------------------------------------------------------------------------
+# Vectorized evaluation measures.
+#
+# Every function accepts either one prediction vector (n,) or a batch of
+# them (B,n) -- e.g. one row per threshold or per model -- and returns
+# one value or one value per row.
+# ------------------------------------------------------------------------------------
+import numpy
+
+# label 0 = nano
+# label 1 = back
+background   = 1
+nanoparticle = 0
+
+def _as_batch(y_preds):
+    y_preds = numpy.asarray(y_preds)
+    return (numpy.atleast_2d(y_preds), y_preds.ndim == 1)
+
+def confusion_counts(y_valid, y_preds):
+    """ Returns (TP, FP, FN, TN) with the nanoparticle as positive class """
+    y_valid = numpy.asarray(y_valid).astype(numpy.intp)
+    (y_preds, single) = _as_batch(y_preds)
+    (nrows, nsamples) = y_preds.shape
+
+    # cell of the 2x2 table for each (row, sample); other labels are not counted
+    y_preds = y_preds.astype(numpy.intp)
+    valid   = ((y_valid == 0) | (y_valid == 1))[numpy.newaxis,:] & ((y_preds == 0) | (y_preds == 1))
+    cells   = 4 * numpy.arange(nrows)[:,numpy.newaxis] + 2 * y_valid[numpy.newaxis,:] + y_preds
+    table   = numpy.bincount(cells[valid], minlength=4*nrows).reshape((nrows,2,2))
+
+    TP = table[:,nanoparticle,nanoparticle]
+    FN = table[:,nanoparticle,background]
+    FP = table[:,background,nanoparticle]
+    TN = table[:,background,background]
+
+    if single:
+        return (TP[0], FP[0], FN[0], TN[0])
+    return (TP, FP, FN, TN)
+
+def evaluate_errors(y_valid, y_preds, options):
+    """ Error of each prediction vector according to options['measure']
+
+    Same measures as the former per-sample loop: fmeasure, f1score, acc,
+    weightedmer and weightedmercls.
+    """
+    y_valid = numpy.asarray(y_valid)
+    (y_preds, single) = _as_batch(y_preds)
+
+    if options['measure'] in ['fmeasure','f1score','acc']:
+        (TP, FP, FN, TN) = [ c.astype(numpy.float64) for c in confusion_counts(y_valid, y_preds) ]
+
+        Recall    = TP / (TP+FN+0.0001)
+        Precision = TP / (TP+FP+0.0001)
+
+        if options['measure'] == 'fmeasure':
+            test_scores = 1 - 2*(Precision*Recall) / (Precision+Recall+0.0001)
+        elif options['measure'] == 'f1score':
+            test_scores = 1 - 2*TP / (2*TP + FP + FN + 0.0001)
+        else:
+            test_scores = 1 - (TP + TN) / ( TP + TN + FP + FN + 0.0001 )
+
+    elif options['measure'] in ['weightedmer','weightedmercls']:
+        ind = y_valid == background   # background
+
+        weights = numpy.ones( y_valid.shape, dtype=numpy.float32 )
+        if options['measure'] == 'weightedmer':
+            weights[ind] = options['weight']
+        else:
+            ninstback = numpy.sum(ind)
+            ninstnano = numpy.sum(y_valid == nanoparticle)
+            val = numpy.minimum(ninstback,ninstnano)/(numpy.maximum(ninstback,ninstnano)*1.)
+
+            if ninstback > ninstnano:
+                weights[y_valid == nanoparticle] = 2-val
+            else:
+                weights[ind] = 2-val
+            weights[~ind & (y_valid != nanoparticle)] = 0
+
+        # weighted mean of the misclassifications, all rows at once
+        errors      = y_preds != y_valid[numpy.newaxis,:]
+        test_scores = errors.dot(weights.astype(numpy.float64)) / errors.shape[1]
+
+    else:
+        raise ValueError('unknown measure: %r' % options['measure'])
+
+    if single:
+        return test_scores[0]
+    return test_scores
+
+def confusion_matrix(ytest, ypred, K):
+    """ KxK confusion matrix (true class in rows), or one per row of ypred """
+    (ypred, single) = _as_batch(ypred)
+    nsamples = min(len(ytest),ypred.shape[1])
+
+    ytest = numpy.asarray(ytest)[0:nsamples].astype(numpy.intp)
+    ypred = ypred[:,0:nsamples].astype(numpy.intp)
+    # a label out of range would be counted in another cell, or row
+    for (name, labels) in [('ytest', ytest), ('ypred', ypred)]:
+        if labels.size > 0 and (labels.min() < 0 or labels.max() >= K):
+            raise ValueError('%s labels out of range for %d classes: %r' %
+                             (name, K, numpy.unique(labels[(labels < 0) | (labels >= K)])))
+
+    nrows = ypred.shape[0]
+    cells = K*K*numpy.arange(nrows)[:,numpy.newaxis] + K*ytest[numpy.newaxis,:] + ypred
+    cm    = numpy.bincount(cells.ravel(), minlength=K*K*nrows).reshape((nrows,K,K))
+    cm    = cm.astype(numpy.float64)
+
+    if single:
+        return cm[0]
+    return cm
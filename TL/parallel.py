@@ -0,0 +1,121 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+# ------------------------------------------------------------------------------------
+# Process pools for independent training jobs.
+#
+# Workers are forked, so they inherit the data of the parent (folds,
+# options, ...) without pickling it. Theano must run on the CPU: a GPU
+# context does not survive a fork.
+# ------------------------------------------------------------------------------------
+import os, sys, ctypes, multiprocessing
+import numpy
+
+BLAS_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                  'GOTO_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS']
+
+# thread pools of the libraries numpy and Theano may have loaded: part of
+# the file name, then the functions that set and get the number of threads
+# (OpenBLAS builds may add a prefix or a suffix to them)
+BLAS_LIBRARIES = [('openblas', 'openblas_set_num_threads', 'openblas_get_num_threads'),
+                  ('mkl_rt',   'MKL_Set_Num_Threads',      'MKL_Get_Max_Threads'),
+                  ('gomp',     'omp_set_num_threads',      'omp_get_max_threads'),
+                  ('iomp5',    'omp_set_num_threads',      'omp_get_max_threads')]
+
+def loaded_libraries():
+    """ Shared libraries mapped in this process (Linux only) """
+    try:
+        with open('/proc/self/maps') as f:
+            paths = [ line.split()[-1] for line in f if '.so' in line ]
+    except IOError:
+        return []
+    return sorted(set(path for path in paths if os.path.isfile(path)))
+
+def _symbol(lib, name):
+    for symbol in [name, name + '64_', 'scipy_' + name, 'scipy_' + name + '64_']:
+        try:
+            return getattr(lib, symbol)
+        except AttributeError:
+            pass
+    return None
+
+def blas_pools():
+    """ (library, set_threads, get_threads) of each thread pool loaded
+    in this process """
+    pools = []
+    for path in loaded_libraries():
+        for (name, setter, getter) in BLAS_LIBRARIES:
+            if name not in os.path.basename(path):
+                continue
+            try:
+                lib = ctypes.CDLL(path)
+            except OSError:
+                continue
+            (set_threads, get_threads) = (_symbol(lib, setter), _symbol(lib, getter))
+            if set_threads is not None and get_threads is not None:
+                pools.append((path, set_threads, get_threads))
+    return pools
+
+def blas_threads():
+    """ Number of threads of each thread pool loaded in this process """
+    return dict((path, get_threads()) for (path, set_threads, get_threads) in blas_pools())
+
+def limit_blas_threads(nthreads):
+    """ Caps the number of BLAS/OpenMP threads of this process
+
+    The libraries read the environment when they are loaded, so the
+    variables only cover the ones loaded from now on; the ones already
+    loaded (by numpy or Theano, before the fork) are set through their
+    own functions.
+    """
+    for var in BLAS_VARIABLES:
+        os.environ[var] = str(nthreads)
+
+    for (path, set_threads, get_threads) in blas_pools():
+        set_threads(ctypes.c_int(nthreads))
+
+def _init_worker(nthreads):
+    limit_blas_threads(nthreads)
+
+def get_pool(nworkers, nthreads=None):
+    """ Pool of `nworkers` processes with `nthreads` BLAS threads each
+
+    By default the cores are shared evenly among the workers, so they do
+    not oversubscribe the machine.
+    """
+    if nthreads is None:
+        nthreads = max(1, multiprocessing.cpu_count() / nworkers)
+
+    print >> sys.stderr, "Starting {0:d} workers with {1:d} BLAS threads each".format(nworkers, nthreads)
+    return multiprocessing.Pool(processes=nworkers, initializer=_init_worker, initargs=(nthreads,))
+
+def share_array(a):
+    """ Copy of `a` in shared memory
+
+    Forked workers read it in place: it is neither pickled nor duplicated
+    by copy-on-write.
+    """
+    a = numpy.ascontiguousarray(a)
+
+    raw    = multiprocessing.RawArray(ctypes.c_char, max(a.nbytes, 1))
+    shared = numpy.frombuffer(raw, dtype=a.dtype, count=a.size).reshape(a.shape)
+    shared[...] = a
+
+    return shared
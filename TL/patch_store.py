@@ -0,0 +1,301 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+# ------------------------------------------------------------------------------------
+# Columnar patch store.
+#
+# The patches of a set of .mat files are kept in three arrays: the pixels
+# (uint8, one patch per row), the image id of each patch (int32) and its
+# label (int8, 1 for background and -1 for nanoparticle). They are written
+# once, as .npy files, and then opened memory-mapped: a run starts without
+# reading the dataset and only touches the patches it uses.
+#
+# Patches are sorted by image id, so those of image k are the rows
+# offsets[k]:offsets[k+1] and a set of images is selected without
+# scanning the dataset.
+# ------------------------------------------------------------------------------------
+import os, sys, shutil, time, itertools
+import numpy, h5py
+
+import theano
+
+from data_handling import save_gzdata, load_savedgzdata
+
+STORE_ARRAYS = ['patches', 'ids', 'labels']
+
+# rows converted at once by PatchStore.gather
+GATHER_CHUNK = 65536
+
+# patches read at once from a .mat file by write_store
+READ_CHUNK = 16384
+
+def id_offsets(ids):
+    """ Offset table of ids sorted in ascending order: the rows of id k
+    are offsets[k]:offsets[k+1] """
+    if len(ids) == 0:
+        return numpy.zeros((1,), dtype=numpy.int64)
+    counts = numpy.bincount(ids, minlength=int(ids[-1]) + 1)
+    return numpy.r_[0, numpy.cumsum(counts)].astype(numpy.int64)
+
+class PatchStore(object):
+    """ Patches (nsamples, ndim), image ids (nsamples,) and labels
+    (nsamples,) of a dataset, sorted by image id """
+
+    def __init__(self, patches, ids, labels, offsets=None, key=None):
+        assert patches.shape[0] == ids.shape[0] == labels.shape[0]
+        self.patches  = patches
+        self.ids      = ids
+        self.labels   = labels
+        self._offsets = offsets
+        # identity of the data (e.g. the folder of a cached store), None
+        # for a store built in memory
+        self.key      = key
+
+    @property
+    def ndim(self):
+        return self.patches.shape[1]
+
+    @property
+    def nsamples(self):
+        return self.patches.shape[0]
+
+    @property
+    def offsets(self):
+        # computed on first use, so in-memory stores can be filled first
+        if self._offsets is None:
+            assert numpy.all(self.ids[1:] >= self.ids[:-1]), "patches must be sorted by image id"
+            self._offsets = id_offsets(self.ids)
+        return self._offsets
+
+    @property
+    def nimages(self):
+        return numpy.count_nonzero(numpy.diff(self.offsets))
+
+    def rows(self, ids):
+        """ Rows of the patches of the images `ids`, in ascending order;
+        ids without patches are ignored """
+        offsets = self.offsets
+
+        ids = numpy.unique(numpy.asarray(ids, dtype=numpy.int64))
+        ids = ids[(ids >= 0) & (ids < len(offsets) - 1)]
+
+        starts  = offsets[ids]
+        lengths = offsets[ids + 1] - starts
+
+        # concatenation of the ranges starts[k]:starts[k]+lengths[k]
+        nrows = lengths.sum()
+        rows  = numpy.ones((nrows,), dtype=numpy.int64)
+        keep  = lengths > 0
+        (starts, lengths) = (starts[keep], lengths[keep])
+        if nrows > 0:
+            ends = numpy.cumsum(lengths)
+            rows[0] = starts[0]
+            rows[ends[:-1]] = starts[1:] - (starts[:-1] + lengths[:-1]) + 1
+            rows = numpy.cumsum(rows)
+        return rows
+
+    def gather(self, rows, minvalue=0, maxvalue=None, dtype=theano.config.floatX):
+        """ Patches of `rows` in `dtype`, (x - minvalue) / (maxvalue -
+        minvalue + 0.001) when maxvalue is given
+
+        The conversion is done in place, a chunk of rows at a time: no
+        float64 copy of the selection is ever made.
+        """
+        x = numpy.empty((len(rows), self.ndim), dtype=dtype)
+
+        for first in xrange(0, len(rows), GATHER_CHUNK):
+            last  = min(first + GATHER_CHUNK, len(rows))
+            chunk = rows[first:last]
+            if len(chunk) > 0 and chunk[-1] - chunk[0] == len(chunk) - 1:
+                # contiguous rows are read as a slice
+                x[first:last] = self.patches[chunk[0]:chunk[-1]+1]
+            else:
+                x[first:last] = self.patches[chunk]
+
+            if maxvalue is not None:
+                x[first:last] -= minvalue
+                x[first:last] /= (maxvalue - minvalue + 0.001)
+
+        return x
+
+    def shared(self):
+        """ Store whose in-memory arrays are moved to shared memory, so
+        forked workers do not copy them; memory-mapped arrays are already
+        shared through the page cache """
+        from parallel import share_array
+
+        arrays = []
+        for a in [self.patches, self.ids, self.labels]:
+            if not isinstance(a, numpy.memmap):
+                a = share_array(a)
+            arrays.append(a)
+        return PatchStore(*arrays, offsets=self._offsets, key=self.key)
+
+def is_current(folder, manifest):
+    """ Whether the store in `folder` was written from `manifest` """
+    manifestfile = os.path.join(folder, 'manifest.pkl.gz')
+    return os.path.isfile(manifestfile) and load_savedgzdata(manifestfile) == manifest
+
+def save_store(folder, store, manifest):
+    """ Writes an in-memory store to `folder`, e.g. to cache a converted
+    dataset """
+    tmpfolder = '{0:s}.{1:d}.tmp'.format(folder, os.getpid())
+    if os.path.isdir(tmpfolder):
+        shutil.rmtree(tmpfolder)
+    os.makedirs(tmpfolder)
+
+    for name in STORE_ARRAYS:
+        numpy.save(os.path.join(tmpfolder, name + '.npy'), getattr(store, name))
+    numpy.save(os.path.join(tmpfolder, 'offsets.npy'), store.offsets)
+
+    save_gzdata(os.path.join(tmpfolder, 'manifest.pkl.gz'), manifest)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.rename(tmpfolder, folder)
+
+# destination of the chunks read by the workers of write_store, which
+# inherit it: the arrays are shared memory maps of the store files
+_target = {}
+
+# .mat files opened by this process
+_mat_files = {}
+
+def _read_chunk(task):
+    """ Copies columns [begin, end) of mpatches/`name` of a .mat file to
+    their rows of the store; returns the bytes read """
+    (filename, name, begin, end, first, label) = task
+    if filename not in _mat_files:
+        _mat_files[filename] = h5py.File(filename, 'r')
+    dset = _mat_files[filename].get('mpatches').get(name)
+
+    # uint8 columns, transposed straight into their rows
+    block = dset[1:, begin:end]
+    rows  = _target['dest'][first:first + (end - begin)]
+    _target['patches'][rows,:] = block.T
+    _target['labels'][rows]    = label
+
+    return block.nbytes
+
+def write_store(folder, datasetpath, files, options, manifest):
+    """ Writes the store of the .mat `files`, with its `manifest`
+
+    A first pass reads the shapes and the image ids only, so each array
+    is allocated once at its final size and every patch is written
+    directly at its row in image id order. The patches are then read in
+    chunks of READ_CHUNK, by options['load_workers'] processes at once.
+    """
+    sizes   = []
+    all_ids = []
+    offset  = 0
+    for f in files:
+        h = h5py.File(os.path.join(datasetpath, f), 'r')
+        mpatches = h.get('mpatches')
+        (ndim, nback) = mpatches.get('negative').shape
+        (ndim, nnano) = mpatches.get('positive').shape
+        back_ids = mpatches.get('negative')[0,:].astype(numpy.int32)
+        nano_ids = mpatches.get('positive')[0,:].astype(numpy.int32)
+        h.close()
+        sizes.append((nback, nnano))
+
+        # image ids are numbered from 1 in every file
+        all_ids.append(back_ids + offset)
+        all_ids.append(nano_ids + offset)
+        offset = all_ids[-2].max()
+    all_ids  = numpy.concatenate(all_ids)
+    nsamples = len(all_ids)
+
+    # row of each patch, in the order they are read
+    order = numpy.argsort(all_ids, kind='mergesort')
+    dest  = numpy.empty((nsamples,), dtype=numpy.int64)
+    dest[order] = numpy.arange(nsamples)
+
+    # written aside and renamed, an interrupted write is never opened
+    tmpfolder = '{0:s}.{1:d}.tmp'.format(folder, os.getpid())
+    if os.path.isdir(tmpfolder):
+        shutil.rmtree(tmpfolder)
+    os.makedirs(tmpfolder)
+
+    patches = numpy.lib.format.open_memmap(os.path.join(tmpfolder, 'patches.npy'), mode='w+',
+                                           dtype=numpy.uint8, shape=(nsamples, ndim-1))
+    labels  = numpy.lib.format.open_memmap(os.path.join(tmpfolder, 'labels.npy'), mode='w+',
+                                           dtype=numpy.int8, shape=(nsamples,))
+
+    ids = all_ids[order]
+    numpy.save(os.path.join(tmpfolder, 'ids.npy'), ids)
+    numpy.save(os.path.join(tmpfolder, 'offsets.npy'), id_offsets(ids))
+
+    # (file, dataset, first column, last column, first patch, label),
+    # patches numbered in the order of the first pass
+    tasks = []
+    first = 0
+    for f, (nback, nnano) in zip(files, sizes):
+        filename = os.path.join(datasetpath, f)
+        parts    = [('negative', nback, 1), ('positive', nnano, -1)]
+
+        for (name, npoints, label) in parts:
+            for begin in xrange(0, npoints, READ_CHUNK):
+                end = min(begin + READ_CHUNK, npoints)
+                tasks.append((filename, name, begin, end, first + begin, label))
+            first = first + npoints
+
+    global _target
+    _target = {'patches': patches, 'labels': labels, 'dest': dest}
+
+    for f in files:
+        print >> sys.stderr, ( "---> " + os.path.join(datasetpath, f) )
+    start_time = time.time()
+    if options['load_workers'] > 1 and len(tasks) > 1:
+        from parallel import get_pool
+        pool   = get_pool( min(options['load_workers'], len(tasks)), 1 )
+        nbytes = sum(pool.imap_unordered( _read_chunk, tasks ))
+        pool.close()
+        pool.join()
+    else:
+        nbytes = sum(itertools.imap( _read_chunk, tasks ))
+        for h in _mat_files.values():
+            h.close()
+        _mat_files.clear()
+    elapsed = time.time() - start_time
+
+    for a in [patches, labels]:
+        a.flush()
+    _target = {}
+    del patches, labels
+
+    print >> sys.stderr, ( "Read {0:.1f} MB in {1:.2f}s ({2:.1f} MB/s)".format(
+        nbytes / 1e6, elapsed, nbytes / 1e6 / max(elapsed, 1e-6)) )
+
+    save_gzdata(os.path.join(tmpfolder, 'manifest.pkl.gz'), manifest)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.rename(tmpfolder, folder)
+
+def open_store(folder):
+    arrays = [numpy.load(os.path.join(folder, name + '.npy'), mmap_mode='r') for name in STORE_ARRAYS]
+    return PatchStore(*arrays, offsets=numpy.load(os.path.join(folder, 'offsets.npy')),
+                      key=os.path.basename(os.path.normpath(folder)))
+
+def packed_store(dataset):
+    """ Store of a dataset packed in one matrix, one sample per column:
+    [[ ids ], [ data ], [ cls ]] """
+    order = numpy.argsort(dataset[0,:], kind='mergesort')
+    return PatchStore(numpy.asarray(dataset[1:-1,order].T, dtype=numpy.float32),
+                      numpy.asarray(dataset[0,order], dtype=numpy.int32),
+                      numpy.asarray(dataset[-1,order], dtype=numpy.int8))
@@ -0,0 +1,140 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+# ------------------------------------------------------------------------------------
+# On-disk memo of pretrained stacks.
+#
+# Unsupervised pretraining only depends on the architecture, its own
+# hyperparameters, the seed and the training data. Combinations of the
+# grid that differ only in finetuning hyperparameters (finetune_lr,
+# training_epochs, threshold) start from the same pretrained stack.
+#
+# The memo is bounded in size: the least recently used stacks are removed
+# once it grows over it.
+# ------------------------------------------------------------------------------------
+import os, sys, hashlib
+import numpy
+
+import theano
+
+from data_handling import save_gzdata_atomic, load_savedgzdata
+from cache_folder import ensure_dir, lru_evict
+from stopping import stopping_signature
+
+def array_fingerprint(a):
+    """ Digest of the values of a shared variable (or array) """
+    if hasattr(a, 'get_value'):
+        a = a.get_value(borrow=True)
+
+    data   = numpy.ascontiguousarray(a)
+    digest = hashlib.sha1()
+    digest.update(str((data.shape, data.dtype.str)))
+    digest.update(numpy.getbuffer(data))
+    return digest.hexdigest()
+
+def dataset_fingerprint(dataset, store_key=None):
+    """ Digest of the samples of a (x, y) or (x, y, rows) dataset, or of
+    a StreamingSet
+
+    The rows of a training set are rows of the patch store; when the
+    store has a key (see patch_store.open_store) the set is identified by
+    that key and its rows, without reading the patches. Otherwise the
+    patches themselves are hashed.
+    """
+    if hasattr(dataset, 'source'):
+        (source, rows) = (dataset.source, dataset.rows)
+    elif len(dataset) == 3:
+        (source, rows) = (dataset[0], dataset[2].get_value(borrow=True))
+    else:
+        (source, rows) = (dataset[0], None)
+
+    if store_key is not None and rows is not None:
+        digest = hashlib.sha1(str(store_key)).hexdigest()
+    else:
+        digest = array_fingerprint(source)
+    if rows is not None:
+        rows   = numpy.ascontiguousarray(rows, dtype=numpy.int64)
+        digest = hashlib.sha1(digest + hashlib.sha1(numpy.getbuffer(rows)).hexdigest()).hexdigest()
+    return digest
+
+def pretrain_key(options, train_set):
+    # minibatches are drawn in order, so the batch size is part of
+    # pretraining too
+    return (tuple(int(n) for n in options['hlayers']),
+            options['ndim'],
+            options['pretraining_epochs'],
+            float(options['pretrain_lr']),
+            tuple(float(c) for c in options['corruptlevels']),
+            options['batchsize'],
+            options['cache_layer_outputs'],
+            stopping_signature(options),
+            options['seed'],
+            options['input_dtype'],
+            theano.config.floatX,
+            dataset_fingerprint(train_set, options['dataset_key']))
+
+
+class PretrainCache(object):
+    """ Pretrained parameters stored in `folder`, one file per key, up
+    to `maxbytes` in total """
+
+    def __init__(self, folder, maxbytes):
+        self.folder   = folder
+        self.maxbytes = maxbytes
+        ensure_dir(folder)
+
+    def filename(self, key):
+        name = hashlib.sha1(repr(key)).hexdigest()
+        return '{0:s}/pretrain_{1:s}.pkl.gz'.format(self.folder, name)
+
+    def load(self, key):
+        """ Returns the saved entry, or None """
+        filename = self.filename(key)
+        if not os.path.isfile(filename):
+            return None
+
+        entry = load_savedgzdata(filename)
+        if entry['key'] != key:
+            return None
+        # the modification time of an entry is its last use
+        try:
+            os.utime(filename, None)
+        except OSError:
+            # removed meanwhile by another process
+            pass
+        return entry
+
+    def save(self, key, sda, pretrain_time, epochs):
+        save_gzdata_atomic(self.filename(key),
+                           {'key': key,
+                            'params': [var.get_value() for var in sda.model_variables()],
+                            'pretrain_time': pretrain_time,
+                            'epochs': epochs})
+        self.evict(keep=self.filename(key))
+
+    def evict(self, keep=None):
+        """ Removes the least recently used entries until the memo fits
+        in maxbytes; `keep` is never removed """
+        lru_evict(self.folder, 'pretrain_', self.maxbytes, keep)
+
+    def restore(self, sda, entry):
+        for var, value in zip(sda.model_variables(), entry['params']):
+            var.set_value(value)
+        print >> sys.stderr, "Pretrained stack from {0:s}".format(self.filename(entry['key']))
@@ -0,0 +1,77 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# Class-balanced minibatches.
+#
+# Instead of replicating samples of the minority class, the samples of
+# each finetuning epoch are drawn with replacement so that every class
+# makes a set share of them. Only indices are drawn: they become the rows
+# of the training slot (or the order of a training stream), the patches
+# are never copied.
+# ------------------------------------------------------------------------------------
+import numpy
+
+class ClassSampler(object):
+    """ Draws nsamples positions of a training set whose samples have
+    `labels`, so that on average class c makes weights[c] / sum(weights)
+    of them (classes not in `weights` weigh 1) """
+
+    def __init__(self, labels, weights=None):
+        labels = numpy.asarray(labels)
+        if weights is None:
+            weights = {}
+        (classes, inverse) = numpy.unique(labels, return_inverse=True)
+        counts = numpy.bincount(inverse).astype(numpy.float64)
+        share  = numpy.array([weights.get(c, 1.) for c in classes], dtype=numpy.float64)
+
+        # probability of each sample, as a cumulative distribution
+        self.cdf = numpy.cumsum((share / counts)[inverse])
+        self.cdf = self.cdf / self.cdf[-1]
+
+    @property
+    def nsamples(self):
+        return len(self.cdf)
+
+    def draw(self, rng):
+        """ Positions of the samples of one epoch, in random order """
+        positions = numpy.searchsorted(self.cdf, rng.random_sample(self.nsamples), side='right')
+        return numpy.minimum(positions, self.nsamples - 1)
+
+def get_sampler( options, labels ):
+    """ ClassSampler of options['sampler'] for a training set with
+    `labels`, or None to go through the samples as they are
+
+    'balanced' gives every class the same share, 'weighted' the shares of
+    options['sampler_weights']; replicate asks for balanced minibatches.
+    """
+    sampler = options['sampler']
+    if sampler is None and options['replicate']:
+        sampler = 'balanced'
+
+    if sampler is None:
+        return None
+    elif sampler == 'balanced':
+        return ClassSampler(labels)
+    elif sampler == 'weighted':
+        return ClassSampler(labels, options['sampler_weights'])
+    else:
+        raise ValueError('unknown sampler: %r' % sampler)
@@ -0,0 +1,160 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+# ------------------------------------------------------------------------------------
+# Stopping policies for the layer-wise pretraining.
+#
+# A policy is told when a layer starts (`start`) and, after every epoch,
+# decides whether to stop it (`stop`). options['pretraining_epochs']
+# remains the upper bound. Its state within a layer (`state`,
+# `set_state`) is checkpointed with the layer, so a resumed layer goes on
+# with the same counters.
+# ------------------------------------------------------------------------------------
+import sys, time
+import numpy
+
+class Plateau(object):
+    """ Stops when the mean training cost of the last `window` epochs
+    improved less than `tol` (relative) over the previous window """
+
+    def __init__(self, tol, window):
+        self.tol    = tol
+        self.window = window
+
+    def start(self, layer):
+        self.costs = []
+
+    def state(self):
+        return list(self.costs)
+
+    def set_state(self, state):
+        self.costs = list(state)
+
+    def stop(self, epoch, cost):
+        self.costs.append(cost)
+        if len(self.costs) < 2 * self.window or len(self.costs) % self.window != 0:
+            return False
+
+        previous = numpy.mean(self.costs[-2*self.window:-self.window])
+        current  = numpy.mean(self.costs[-self.window:])
+        return (previous - current) < self.tol * abs(previous)
+
+
+class HeldOut(object):
+    """ Stops when the reconstruction cost on held-out data has not
+    improved by `tol` (relative) for `patience` checks, one check every
+    `interval` epochs
+
+    `recon_fns[i]()` returns the held-out cost of layer i.
+    """
+
+    def __init__(self, recon_fns, tol, patience, interval):
+        self.recon_fns = recon_fns
+        self.tol       = tol
+        self.patience  = patience
+        self.interval  = interval
+
+    def start(self, layer):
+        self.layer = layer
+        self.best  = numpy.inf
+        self.waits = 0
+
+    def state(self):
+        return (self.best, self.waits)
+
+    def set_state(self, state):
+        (self.best, self.waits) = state
+
+    def stop(self, epoch, cost):
+        if (epoch + 1) % self.interval != 0:
+            return False
+
+        loss = self.recon_fns[self.layer]()
+        if loss < self.best * (1 - self.tol):
+            self.best  = loss
+            self.waits = 0
+        else:
+            self.waits = self.waits + 1
+        return self.waits >= self.patience
+
+
+class WallClock(object):
+    """ Stops a layer after `seconds` of training """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def start(self, layer):
+        self.start_time = time.time()
+
+    def state(self):
+        # seconds spent on the layer
+        return time.time() - self.start_time
+
+    def set_state(self, state):
+        self.start_time = time.time() - state
+
+    def stop(self, epoch, cost):
+        return time.time() - self.start_time > self.seconds
+
+
+class AnyOf(object):
+    """ Stops as soon as one of the policies does """
+
+    def __init__(self, policies):
+        self.policies = policies
+
+    def start(self, layer):
+        for policy in self.policies:
+            policy.start(layer)
+
+    def state(self):
+        return [policy.state() for policy in self.policies]
+
+    def set_state(self, state):
+        for (policy, s) in zip(self.policies, state):
+            policy.set_state(s)
+
+    def stop(self, epoch, cost):
+        # every policy sees every epoch
+        return any([policy.stop(epoch, cost) for policy in self.policies])
+
+
+def get_stopping(options, compiled):
+    """ Policy described by options['pretrain_stop'], a list of 'plateau',
+    'heldout' and 'time' (empty: run every epoch) """
+    policies = []
+    for name in options['pretrain_stop']:
+        if name == 'plateau':
+            policies.append(Plateau(options['pretrain_stop_tol'], options['pretrain_stop_window']))
+        elif name == 'heldout':
+            policies.append(HeldOut(compiled.reconstruction_fns(), options['pretrain_stop_tol'],
+                                    options['pretrain_stop_patience'], options['pretrain_stop_window']))
+        elif name == 'time':
+            policies.append(WallClock(options['pretrain_stop_seconds']))
+        else:
+            raise ValueError('unknown stopping policy: %r' % name)
+    return AnyOf(policies)
+
+def stopping_signature(options):
+    # part of the identity of a pretrained stack
+    return (tuple(options['pretrain_stop']), options['pretrain_stop_tol'],
+            options['pretrain_stop_window'], options['pretrain_stop_patience'],
+            options['pretrain_stop_seconds'])
@@ -0,0 +1,206 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+# ------------------------------------------------------------------------------------
+# Streaming training sets.
+#
+# The training set is not held by a shared variable: a background thread
+# reads it from the patch store in chunks of minibatches, in a new random
+# order every epoch, while the model trains on the previous chunk (double
+# buffering). The order of an epoch only depends on the seed and the
+# epoch number, so a job resumed at an epoch (see `state`) reads the same
+# minibatches. The training functions keep their signature, f(index, ...):
+# `streamed` wraps them so that each call first makes the chunk holding
+# minibatch `index` the content of the training slot.
+# ------------------------------------------------------------------------------------
+import sys, threading, Queue
+import numpy
+
+class ReadError(object):
+    """ Error of the background reader, as given by sys.exc_info() """
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def _put(queue, stop, item):
+    """ Puts `item` in `queue` unless `stop` is set first; returns
+    whether it was put """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+class StreamingSet(object):
+    """ Samples `rows` of a store, read by `read(rows)` -> (x, y)
+
+    `source` is the data the rows refer to (used to fingerprint the set).
+    """
+
+    def __init__(self, read, rows, labels, source, chunk_batches, seed):
+        self.read          = read
+        self.rows          = numpy.asarray(rows, dtype=numpy.int64)
+        self.labels        = labels
+        self.source        = source
+        self.chunk_batches = chunk_batches
+        self.seed          = seed
+
+    @property
+    def nsamples(self):
+        return len(self.rows)
+
+    def stream(self, batch_size):
+        return MinibatchStream(self, batch_size)
+
+
+class MinibatchStream(object):
+    """ Chunks of `chunk_batches` minibatches of a StreamingSet, epoch
+    after epoch, prefetched by a background thread
+
+    As with the in-memory sets, an epoch has nsamples / batch_size full
+    minibatches; the samples left out change with the order. Epochs are
+    counted by the consumer: the first minibatch of an epoch starts the
+    next one.
+    """
+
+    def __init__(self, dataset, batch_size):
+        self.dataset       = dataset
+        self.batch_size    = batch_size
+        self.chunk_batches = dataset.chunk_batches
+        self.n_batches     = dataset.nsamples / batch_size
+        self.nchunks       = (self.n_batches + self.chunk_batches - 1) / self.chunk_batches
+        # epoch of the current chunk, -1 before the first one
+        self.epoch         = -1
+        # order of the samples of an epoch (see sampling.ClassSampler);
+        # None is a permutation
+        self.sampler       = None
+
+        self.current = None
+        self.thread  = None
+
+    def order(self, epoch):
+        """ Samples of the minibatches of `epoch`, in order """
+        rng = numpy.random.RandomState([self.dataset.seed, epoch])
+        if self.sampler is None:
+            order = rng.permutation(self.dataset.nsamples)
+        else:
+            order = self.sampler.draw(rng)
+        return order[0:self.n_batches * self.batch_size]
+
+    def _produce(self, epoch, start_chunk, queue, stop):
+        # an error of the reader is handed over to the consumer, which
+        # raises it (see load), instead of ending the thread silently
+        try:
+            self._read_chunks(epoch, start_chunk, queue, stop)
+        except Exception:
+            _put(queue, stop, ReadError(sys.exc_info()))
+
+    def _read_chunks(self, epoch, start_chunk, queue, stop):
+        chunk_size = self.chunk_batches * self.batch_size
+        while not stop.is_set():
+            order = self.order(epoch)
+            for c in xrange(start_chunk, self.nchunks):
+                rows = self.dataset.rows[order[c * chunk_size:(c + 1) * chunk_size]]
+
+                # read in store order, which is faster, then shuffled
+                sort = numpy.argsort(rows)
+                (x_sorted, y_sorted) = self.dataset.read(rows[sort])
+                x = numpy.empty_like(x_sorted)
+                y = numpy.empty_like(y_sorted)
+                x[sort] = x_sorted
+                y[sort] = y_sorted
+
+                if not _put(queue, stop, (epoch, c, x, y)):
+                    return
+            (epoch, start_chunk) = (epoch + 1, 0)
+
+    def start(self, epoch, start_chunk):
+        self.close()
+        # one chunk in use, one ready in the queue and one being read
+        self.queue  = Queue.Queue(maxsize=1)
+        self.stop   = threading.Event()
+        self.thread = threading.Thread(target=self._produce, args=(epoch, start_chunk, self.queue, self.stop))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
+            self.thread = None
+
+    def state(self):
+        """ Position of the stream, to be checkpointed with the model """
+        return {'epoch': self.epoch}
+
+    def set_state(self, state):
+        """ Goes back (or on) to the position `state`: the next epoch
+        is the one after state['epoch'] """
+        self.close()
+        self.current = None
+        self.epoch   = state['epoch']
+
+    def load(self, chunk, new_epoch):
+        """ Makes `chunk` the current one; returns True when it changed
+
+        The first minibatch of an epoch always takes the next chunk of the
+        stream, even if the epoch has a single chunk.
+        """
+        if self.current is not None and self.current[1] == chunk and not new_epoch:
+            return False
+
+        if new_epoch or self.epoch < 0:
+            self.epoch = self.epoch + 1
+        if self.thread is None:
+            self.start(self.epoch, chunk)
+        item = self._get()
+        if item[0:2] != (self.epoch, chunk):
+            # the previous epoch was cut short: start over from `chunk`
+            self.start(self.epoch, chunk)
+            item = self._get()
+
+        self.current = item
+        return True
+
+    def _get(self):
+        """ Next chunk of the queue; raises the error of the reader, if
+        it failed """
+        item = self.queue.get()
+        if isinstance(item, ReadError):
+            self.close()
+            (exc_type, exc_value, exc_traceback) = item.exc_info
+            raise exc_type, exc_value, exc_traceback
+        return item
+
+
+def streamed(fn, stream, bind):
+    """ Wraps a training function of minibatch `index` so that it reads
+    the chunk of `stream` holding it; `bind(x, y)` gives a chunk to the
+    training slot """
+    def f(index, *args, **kwargs):
+        if stream.load(index / stream.chunk_batches, index == 0):
+            (epoch, c, x, y) = stream.current
+            bind(x, y)
+        return fn(index % stream.chunk_batches, *args, **kwargs)
+    return f
@@ -24,13 +24,15 @@ import sys, string, os, copy, time, re, csv
 import itertools, numpy, h5py
 # opencv
 import cv2
+from scipy.spatial import cKDTree
 
 lib_path = os.path.abspath('../TL/')
 sys.path.append(lib_path)
 
 from SdA import *
 
-from data_preprocessing import load_data, gen_folds, confusion_matrix, shared_dataset
+from data_preprocessing import load_data, gen_folds, confusion_matrix, shared_dataset, extract_patches
+from function_cache import Predictor
 from data_handling import save_results, save_data, load_saveddata,load_savedgzdata, save_gzdata
 from matplotlib import pyplot as plt
 
@@ -51,59 +53,67 @@ method:
 \t - tl
 """
 
-def checkResults(nelem_x, nmbrAnn, anncenters, pt, ypred, mindistgiven=10):
-    # --------------------------------------------------------------------------------
-    # check results
-    TP = 0; FP = 0; FN = 0;
-    
-    GT  = numpy.full((nmbrAnn,),0,dtype=numpy.uint8)
-
-    for i in range(0,nelem_x):
-        # background
-        if ypred[i] == 1:
-            continue
-        
-        pti = pt[:,i]
-        pti = pti.reshape((2,-1))
-        pti = numpy.tile(pti,(1,nmbrAnn))
-
-        # calculates the distance of one detection against all anotations
-        dists      = numpy.sqrt( numpy.sum( (pti - anncenters) * (pti - anncenters), axis=0) )
-        mindistidx = numpy.nonzero( dists <= mindistgiven )[0]
-        
-        nanofound = False
-        if len( mindistidx ) > 0:
-            mindistance       = dists[mindistidx]
-            orderedmindistidx = numpy.argsort( mindistance )
-
-            for arg in orderedmindistidx:
-                # print arg,
-                # raw_input()
-                
-                if GT[mindistidx[arg]] == 0:
-                    GT[mindistidx[arg]] = 1
-                    TP = TP + 1
-                    nanofound = True
-                    break
-                
-            if nanofound == False:
-                FP = FP + 1
-                
+class Matcher(object):
+    """ Matching of detections to the annotation centers `anncenters`
+    (2 x M), through a KD-tree of the annotations """
+
+    def __init__(self, anncenters):
+        self.anncenters = numpy.asarray(anncenters, dtype=numpy.float).reshape((2,-1)).T
+        self.nmbrAnn    = self.anncenters.shape[0]
+        if self.nmbrAnn > 0:
+            self.tree = cKDTree(self.anncenters)
+
+    def match(self, pt, radii, keep=None):
+        """ Matches of the detections `pt` (2 x N) for each radius of
+        `radii`, as a list of (TP, FP, FN, pairs)
+
+        In order, each detection (of those in `keep`) takes the nearest
+        annotation within the radius that is still free, and is a true
+        positive, or else a false positive; pairs holds the (detection,
+        annotation) indices of the true positives.
+        """
+        pt  = numpy.asarray(pt, dtype=numpy.float).reshape((2,-1)).T
+        idx = numpy.arange(pt.shape[0])
+        if keep is not None:
+            idx = idx[numpy.asarray(keep, dtype=numpy.bool)]
+
+        # annotations within the largest radius of each detection, nearest first
+        neighbours = []
+        if self.nmbrAnn > 0 and len(idx) > 0:
+            for (i, cand) in zip(idx, self.tree.query_ball_point(pt[idx], max(radii))):
+                cand  = numpy.asarray(cand, dtype=numpy.intp)
+                dists = numpy.sqrt( numpy.sum( (self.anncenters[cand] - pt[i])**2, axis=1 ) )
+                order = numpy.lexsort((cand, dists))
+                neighbours.append((i, cand[order], dists[order]))
         else:
-            FP = FP + 1
+            neighbours = [(i, numpy.zeros((0,), dtype=numpy.intp), numpy.zeros((0,))) for i in idx]
+
+        results = []
+        for radius in radii:
+            GT    = numpy.zeros((self.nmbrAnn,), dtype=numpy.bool)
+            pairs = []
+            for (i, cand, dists) in neighbours:
+                free = cand[(dists <= radius) & ~GT[cand]]
+                if len(free) > 0:
+                    GT[free[0]] = True
+                    pairs.append((i, free[0]))
+
+            TP = len(pairs)
+            results.append((TP, len(idx) - TP, self.nmbrAnn - TP,
+                            numpy.array(pairs, dtype=numpy.intp).reshape((-1,2))))
+        return results
 
-    FN = sum(GT == 0)
-
-    # print FN + TP, nmbrAnn
-    # print TP
-    return (TP,FP,FN)
+def checkResults(nelem_x, nmbrAnn, anncenters, pt, ypred, mindistgiven=10):
+    """ (TP, FP, FN) of the detections predicted as nanoparticles (not
+    background) within `mindistgiven` of an annotation """
+    pt   = numpy.asarray(pt).reshape((2,-1))[:,0:nelem_x]
+    keep = numpy.asarray(ypred)[0:nelem_x] != 1
+    return Matcher(anncenters).match(pt, [mindistgiven], keep)[0][0:3]
 
 # ---------------------------------------------------------------------------------------------------------------------
-def getPrecisionRecall(nfiles,files,ids,path,imgsbasepath,imgspath,annbasepath,annfiles, model, (rd,th,nrunImg,cv), printImg=False):
+def getPrecisionRecall(nfiles,files,ids,path,imgsbasepath,imgspath,annbasepath,annfiles, predictor, (rd,th,nrunImg,cv), printImg=False):
     resize   = 1.
-    minvalue = 0.
-    maxvalue = 255.
-        
+
     # --------------------------------------------
     Precision = 0
     Recall    = 0
@@ -128,9 +138,9 @@ def getPrecisionRecall(nfiles,files,ids,path,imgsbasepath,imgspath,annbasepath,a
 
         detectedx = fx.get('data')
         #print numpy.array( detectedx )
-        detectedx = numpy.array( detectedx, dtype=numpy.float ) # samples were resized
+        detectedx = numpy.array( detectedx, dtype=numpy.float ).ravel() # samples were resized
         detectedy = fy.get('data')
-        detectedy = numpy.array( detectedy, dtype=numpy.float ) # samples were resized
+        detectedy = numpy.array( detectedy, dtype=numpy.float ).ravel() # samples were resized
         
         # get imgs
         print >> sys.stderr, "loading... {0:s}".format( imgspath[ids[count]] )
@@ -166,67 +176,31 @@ def getPrecisionRecall(nfiles,files,ids,path,imgsbasepath,imgspath,annbasepath,a
             countann = countann + 1
 
         nmbrAnn   = anncenters.shape[1]
-        toDiscard = numpy.zeros((len(detectedx),1))
-
-        # print nmbrAnn
-        # alla
-        isFirst = True
-        for i in range(0,len(detectedx)):
 
-            if detectedy[i]-10 < 0 or detectedy[i]+10 > height or \
-               detectedx[i]-10 < 0 or detectedx[i]+10 > width:
-                toDiscard[i] = 1
-                continue
+        # patches around the detections; those leaving the image are discarded
+        (data, valid) = extract_patches(img[:,:,1], detectedx*resize, detectedy*resize, 20)
 
-            d = img[detectedy[i]*resize-10:detectedy[i]*resize+10, detectedx[i]*resize-10:detectedx[i]*resize+10,1]
-            
-            ndim = numpy.size(d)
-            d = numpy.reshape(d, (-1,ndim))
-            d = d.astype(dtype=numpy.float)
-            
-            # print [detectedx[i], detectedy[i]]
-            if isFirst == True:
-                # valid points
-                pt = numpy.c_[detectedx[i], detectedy[i]].T
-
-                # patch
-                data = numpy.c_[d].T
-                isFirst = False
-            else:
-                p  = numpy.c_[detectedx[i], detectedy[i]].T
-                pt = numpy.c_[pt, p]
-
-                d = numpy.c_[d].T
-                data = numpy.c_[data, d]
-
-        set_x   = data[0:,].T
+        # valid points
+        pt      = numpy.c_[detectedx[valid], detectedy[valid]].T
+        set_x   = data[valid]
         nelem_x = set_x.shape[0]
 
-        #minvalue = numpy.min(set_x)
-        #maxvalue = numpy.max(set_x)
-        
-        set_x = (set_x - minvalue) / (maxvalue-minvalue+0.001)
-        set_y = numpy.zeros((nelem_x,),dtype=numpy.float)
+        # the annotations are indexed once for both evaluations
+        matcher  = Matcher(anncenters)
 
         ypredlog = numpy.zeros((nelem_x,)) # all detections
-        ( TP, FP, FN ) = checkResults( nelem_x, nmbrAnn, anncenters, pt, ypredlog, mindistgiven=4/resize )
+        ( TP, FP, FN ) = matcher.match( pt, [4/resize] )[0][0:3]
         print >> sys.stderr, "(LoG) TP: {0:05d} | FP: {1:05d} | FN: {2:05d} | N: {3:05d}".format(TP, FP, FN, nmbrAnn)
         Precision_LoG_ = TP/(TP+FP+0.0001)
         Recall_LoG_    = TP/(TP+FN+0.0001)
 
-        test_data_x, test_labels_y = shared_dataset(set_x,set_y)
-        
-        test_model = model.build_test_function(
-            dataset       = (test_data_x,test_labels_y),
-            batch_size    = 1,
-        )
-
-        (ytrue,ypred,yprob) = test_model()
+        # grey levels, normalized by the predictor
+        (ypred,yprob) = predictor(set_x)
         #ypred = numpy.array( map(lambda x: not x>.6,numpy.amax(yprob,axis=1)), dtype=numpy.uint8)
         # ypred = numpy.zeros((nelem_x,)) # all detections
         # print 'No samples: {0:03d}'.format(len(ytrue))
         
-        (TP,FP,FN) = checkResults(nelem_x, nmbrAnn, anncenters, pt, ypred, mindistgiven=20/resize)[0:3]
+        (TP,FP,FN) = matcher.match( pt, [20/resize], keep=numpy.asarray(ypred) != 1 )[0][0:3]
         print >> sys.stderr, "(SdA) TP: {0:05d} | FP: {1:05d} | FN: {2:05d} | N: {3:05d}".format(TP, FP, FN, nmbrAnn)
         Precision_ = TP/(TP+FP+0.0001)
         Recall_    = TP/(TP+FN+0.0001)
@@ -325,6 +299,8 @@ def main(resolution,method,pathRes):
         filename = '{0:s}/{1:05d}_{2:03d}_model.pkl.gz'.format(basepath,nrun,string.atoi(resolution))
         print >> sys.stderr, "Loading " + filename
         model    = load_savedgzdata(filename)
+        # compiled once, for all the images of the run
+        predictor = Predictor(model)
 
         # get ids
         pathids = '{0:s}/{1:05d}_{2:05d}_test_ids.pkl.gz'.format(basepath,nrun,string.atoi(resolution))
@@ -339,7 +315,7 @@ def main(resolution,method,pathRes):
         
         nfiles = len(files)
 
-        (Precision, Recall, PrecisionLoG,RecallLoG,nDetections) = getPrecisionRecall(nfiles,files,ids,imgpathsae,imgsbasepath,imgspath,annbasepath,annfiles,model,(0,0,nrun,0),printImg=True)
+        (Precision, Recall, PrecisionLoG,RecallLoG,nDetections) = getPrecisionRecall(nfiles,files,ids,imgpathsae,imgsbasepath,imgspath,annbasepath,annfiles,predictor,(0,0,nrun,0),printImg=True)
         
         print >> sys.stderr, "Precision LoG: {0:05f} | Recall LoG: {1:05f}".format(PrecisionLoG, RecallLoG)
         print >> sys.stderr, "Precision SdA: {0:05f} | Recall SdA: {1:05f}".format(Precision, Recall)
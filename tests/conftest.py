@@ -0,0 +1,134 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# The modules of TL, Detection and sda_log_evaluation import each other by
+# their flat names, as when they are run from their own folder.
+# ------------------------------------------------------------------------------------
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ['TL', 'Detection', 'sda_log_evaluation']:
+    sys.path.insert(0, os.path.join(root, folder))
+
+
+# ------------------------------------------------------------------------------------
+# Test modules import what they need through `requires`, so a missing
+# module skips them instead of failing their collection. The skip is
+# silent beyond pytest's "skipped" count: a run without the training
+# stack passes while checking almost nothing (see README.md). The models are
+# trained with the options do_experiment gives its jobs; the fixtures
+# build them in one place, for a small model.
+# ------------------------------------------------------------------------------------
+import pytest
+
+# modules main and the models import
+TRAINING = ['numpy', 'scipy', 'h5py', 'theano', 'matplotlib']
+
+def requires(*modules):
+    """ Skips the calling test module unless every one of `modules`
+    imports; returns the first one """
+    return [ pytest.importorskip(name) for name in modules ][0]
+
+@pytest.fixture
+def sets():
+    """ (train, validation) sets of 16-dimensional samples """
+    import numpy
+    from data_preprocessing import shared_dataset
+
+    rng = numpy.random.RandomState(1234)
+    (x, xv) = (rng.rand(60, 16), rng.rand(40, 16))
+    (y, yv) = ((x.mean(axis=1) > 0.5).astype(numpy.int32), (xv.mean(axis=1) > 0.5).astype(numpy.int32))
+    return (shared_dataset(x, y), shared_dataset(xv, yv))
+
+@pytest.fixture
+def folds():
+    """ folds of gen_folds: train, val and test sets of each of 3 folds,
+    then the final train, val and test sets """
+    import numpy
+    from data_preprocessing import shared_dataset
+
+    def random_set(rng, nsamples):
+        x = rng.rand(nsamples, 16)
+        return shared_dataset(x, (x.mean(axis=1) > 0.5).astype(numpy.int32))
+
+    rng  = numpy.random.RandomState(1234)
+    sets = [ [ random_set(rng, n) for k in range(0,3) ] for n in [60, 40, 40] ]
+    return sets + [ random_set(rng, n) for n in [60, 40, 40] ]
+
+@pytest.fixture
+def job_options():
+    """ job_options(folder=None, seed=1234, **changes): options of a
+    (combination, fold) job of do_experiment, with its checkpoint in
+    `folder` """
+    import numpy, theano
+
+    def make(folder=None, seed=1234, **changes):
+        options = { 'retrain': 0, 'verbose': 0, 'savetimes': False,
+                    'ndim': 16, 'nclasses': 2, 'hlayers': numpy.array([8., 6.]),
+                    'input_dtype': theano.config.floatX,
+                    'dataset_key': None, 'signature': [('database', "'test'")],
+                    'seed': seed, 'numpy_rng': numpy.random.RandomState(seed),
+                    'batchsize': 10, 'test_batchsize': 25,
+                    'corruptlevels': numpy.array([0.1, 0.2], dtype=numpy.float32),
+                    'pretraining_epochs': 5, 'training_epochs': 6,
+                    'pretrain_lr': 0.1, 'finetune_lr': 0.1, 'retrain_ft_layers': [1,1,1,1,1,1],
+                    'threshold': [0.5, 0.8], 'measure': 'acc', 'weight': 200, 'oneclass': False,
+                    'replicate': False, 'sampler': None, 'sampler_weights': {0: 1., 1: 1.},
+                    'checkpoint': None, 'checkpoint_interval': 2,
+                    'cache_layer_outputs': True, 'cache_layer_folder': None,
+                    'pretrain_cache': None, 'pretrain_cache_size': 1e9,
+                    'pretrain_stop': [], 'pretrain_stop_tol': 1e-3, 'pretrain_stop_window': 50,
+                    'pretrain_stop_patience': 5, 'pretrain_stop_seconds': 3600 }
+        if folder is not None:
+            options['checkpoint'] = str(folder.join('ckpt_job.pkl.gz'))
+        options.update(changes)
+        return options
+    return make
+
+@pytest.fixture
+def experiment_options():
+    """ experiment_options(folder, nworkers=1, **changes): options of
+    do_experiment for a grid of 4 combinations and 3 folds, with its
+    results in `folder` """
+    import numpy, theano
+    from theano.tensor.shared_randomstreams import RandomStreams
+
+    def make(folder, nworkers=1, **changes):
+        options = { 'outputfolder': str(folder), 'outputfolderres': str(folder), 'resolution': '050',
+                    'retrain': 0, 'verbose': 0, 'ndim': 16, 'nclasses': 2, 'nclasses_source': 2,
+                    'input_dtype': theano.config.floatX, 'dataset_key': None, 'signature': [],
+                    'numpy_rng': numpy.random.RandomState(1), 'theano_rng': RandomStreams(seed=1), 'seed': 1,
+                    'measure': 'acc', 'weight': 200, 'oneclass': False, 'folds': 3,
+                    'nneurons': [8], 'hlayers': [2], 'pretraining_epochs': [3], 'training_epochs': [4],
+                    'pretrain_lr': [0.1, 0.01], 'finetune_lr': [0.1, 0.05], 'batchsize': [10],
+                    'corruptlevels': [0.1], 'threshold': [0.5, 0.8], 'test_batchsize': 25,
+                    'retrain_ft_layers': [1,1,1,1,1,1], 'replicate': False, 'sampler': None,
+                    'sampler_weights': {0: 1., 1: 1.}, 'checkpoint_interval': 2,
+                    'cache_layer_outputs': True, 'cache_layer_folder': None,
+                    'pretrain_cache': str(folder.join('pretrain_cache')), 'pretrain_cache_size': 1e9,
+                    'pretrain_stop': [], 'pretrain_stop_tol': 1e-3, 'pretrain_stop_window': 50,
+                    'pretrain_stop_patience': 5, 'pretrain_stop_seconds': 3600,
+                    'nworkers': nworkers, 'blas_threads': 1 }
+        options.update(changes)
+        return options
+    return make
@@ -0,0 +1,231 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# Model state and compiled functions of the SdA.
+# ------------------------------------------------------------------------------------
+import pytest
+
+from conftest import requires, TRAINING
+
+numpy = requires(*TRAINING)
+
+import theano
+import theano.tensor as T
+
+from SdA import SdA
+from data_preprocessing import shared_dataset
+from metrics import evaluate_errors
+
+def small_sda(seed=1234):
+    return SdA(numpy_rng=numpy.random.RandomState(seed), n_ins=16, hidden_layers_sizes=[8, 6],
+               n_outs=2, n_outs_b=2)
+
+def values(sda):
+    return [ var.get_value() for var in sda.model_variables() ]
+
+def perturb(sda, rng):
+    for var in sda.model_variables():
+        value = var.get_value()
+        var.set_value((value + rng.uniform(-1, 1, size=value.shape)).astype(value.dtype))
+
+# ------------------------------------------------------------------------------------
+# snapshots of the best model
+def test_snapshot_buffers():
+    rng = numpy.random.RandomState(0)
+    sda = small_sda()
+
+    sda.snapshot()
+    first = values(sda)
+    for (buf, var) in zip(sda.snapshot_values(), sda.model_variables()):
+        assert not numpy.may_share_memory(buf, var.get_value(borrow=True))
+
+    # the live model changes, the snapshot does not
+    perturb(sda, rng)
+    for (buf, value) in zip(sda.snapshot_values(), first):
+        assert numpy.array_equal(buf, value)
+
+    # a new snapshot goes to the other buffer
+    previous = sda.snapshot_values()
+    sda.snapshot()
+    second   = values(sda)
+    assert all( not numpy.may_share_memory(a, b) for (a, b) in zip(previous, sda.snapshot_values()) )
+    for (buf, value) in zip(previous, first):
+        assert numpy.array_equal(buf, value)
+
+    # restored values are copies
+    perturb(sda, rng)
+    sda.restore_snapshot()
+    for (var, value) in zip(sda.model_variables(), second):
+        assert numpy.array_equal(var.get_value(), value)
+    perturb(sda, rng)
+    for (buf, value) in zip(sda.snapshot_values(), second):
+        assert numpy.array_equal(buf, value)
+
+def test_snapshot_of_values():
+    sda = small_sda()
+    saved = [ v + 1 for v in values(sda) ]
+
+    # as a checkpoint restores it
+    sda.snapshot(saved)
+    sda.restore_snapshot()
+    for (var, value) in zip(sda.model_variables(), saved):
+        assert numpy.array_equal(var.get_value(), value)
+    saved[0][...] = 0
+    assert not numpy.array_equal(sda.snapshot_values()[0], saved[0])
+
+def test_finetuned_model_is_best(sets, job_options, monkeypatch):
+    import main
+
+    options = job_options(signature=[], pretraining_epochs=0, threshold=[0.5],
+                          checkpoint_interval=None, cache_layer_outputs=False)
+
+    # one validation per epoch; the second one is the best
+    losses = iter([0.5, 0.3, 0.4, 0.35, 0.6, 0.45])
+    monkeypatch.setattr(main, 'evaluate_errors', lambda y_valid, y_preds, options: numpy.array([next(losses)]))
+
+    (sda, compiled) = main.build_model(sets[0], options)
+    validated = []
+    validate  = compiled.validate_model
+    def recording_validate():
+        validated.append(values(sda))
+        return validate()
+    monkeypatch.setattr(compiled, 'validate_model', recording_validate)
+
+    (loss, sda) = main.pretrain_finetune_model(sda, compiled, sets[0], sets[1], options)
+    assert len(validated) == 6
+    assert loss == 0.3
+    for (var, best, last) in zip(sda.model_variables(), validated[1], validated[-1]):
+        assert numpy.array_equal(var.get_value(), best)
+    assert not all( numpy.array_equal(b, l) for (b, l) in zip(validated[1], validated[-1]) )
+
+def test_selection_threshold(sets, job_options):
+    # the model is selected on the first threshold, whatever the other
+    # thresholds scored on it
+    import main
+
+    models = []
+    for thresholds in [[0.5], [0.5, 0.8], [0.5, 0.2, None]]:
+        options = job_options(threshold=thresholds, pretraining_epochs=0, cache_layer_outputs=False)
+        (sda, compiled) = main.build_model(sets[0], options)
+        (loss, sda) = main.pretrain_finetune_model(sda, compiled, sets[0], sets[1], options)
+        models.append((loss, values(sda)))
+
+    (loss, expected) = models[0]
+    for (l, model) in models[1:]:
+        assert l == loss
+        for (v, e) in zip(model, expected):
+            assert numpy.array_equal(v, e)
+
+# ------------------------------------------------------------------------------------
+# fused test function
+def loop_test_function(sda, dataset, batch_size):
+    """ build_test_function before the fused scan: three functions per
+    batch, floor(nsamples / batch_size) batches """
+    (test_set_x, test_set_y) = dataset
+    index = T.lscalar('index')
+
+    batch = lambda data: data[index * batch_size:(index + 1) * batch_size]
+    prediction_i      = theano.function([index], outputs=sda.logLayer.y_pred,
+                                        givens={sda.x: batch(test_set_x)})
+    prediction_prob_i = theano.function([index], outputs=sda.logLayer.p_y_given_x,
+                                        givens={sda.x: batch(test_set_x)})
+    y_test_i          = theano.function([index], outputs=batch(test_set_y))
+
+    def test_score():
+        n_test_batches = test_set_x.get_value(borrow=True).shape[0] / batch_size
+        y_pred      = sum([prediction_i(i).tolist() for i in xrange(n_test_batches)], [])
+        y_pred_prob = numpy.array(sum([prediction_prob_i(i).tolist() for i in xrange(n_test_batches)], []))
+        y_test      = numpy.array(sum([y_test_i(i).tolist() for i in xrange(n_test_batches)], []))
+        return (y_test, numpy.array(y_pred), y_pred_prob)
+
+    return test_score
+
+@pytest.fixture
+def trained_sda():
+    rng = numpy.random.RandomState(4321)
+    sda = small_sda()
+    for param in sda.params:
+        value = param.get_value(borrow=True)
+        param.set_value(rng.uniform(-1, 1, size=value.shape).astype(theano.config.floatX))
+    return sda
+
+@pytest.mark.parametrize('batch_size', [1, 10, 53, 100])
+def test_scan_function(trained_sda, batch_size):
+    rng = numpy.random.RandomState(1234)
+    testset = shared_dataset(rng.rand(53, 16), rng.randint(0, 2, size=53))
+
+    (y_test, y_pred, y_pred_prob) = trained_sda.build_test_function(testset, batch_size)()
+    # the former loop scored every sample with batches of one
+    (l_test, l_pred, l_pred_prob) = loop_test_function(trained_sda, testset, 1)()
+
+    assert y_test.shape == y_pred.shape == (53,)
+    assert numpy.array_equal(y_test, l_test)
+    assert numpy.array_equal(y_pred, l_pred)
+    assert numpy.allclose(y_pred_prob, l_pred_prob, atol=1e-6)
+    for measure in ['acc', 'fmeasure', 'weightedmer']:
+        options = {'measure': measure, 'weight': 200}
+        assert numpy.allclose(evaluate_errors(y_test, y_pred, options),
+                              evaluate_errors(l_test, l_pred, options))
+
+def test_scan_function_rows(trained_sda):
+    rng  = numpy.random.RandomState(1234)
+    (x, y) = shared_dataset(rng.rand(53, 16), rng.randint(0, 2, size=53))
+    rows = rng.permutation(53)[0:37].astype(numpy.int32)
+
+    scores = trained_sda.build_test_function((x, y, theano.shared(rows)), 10)()
+    full   = trained_sda.build_test_function((x, y), 10)()
+    # every row once, in the order of the rows
+    for (s, f) in zip(scores, full):
+        assert len(s) == len(rows)
+        assert numpy.allclose(s, f[rows])
+
+# ------------------------------------------------------------------------------------
+# pretraining on the cached layer outputs
+@pytest.mark.parametrize('encode_batch_size', [7, 100])
+def test_cached_pretraining(encode_batch_size):
+    from theano.tensor.shared_randomstreams import RandomStreams
+
+    rng  = numpy.random.RandomState(1234)
+    (x, y) = shared_dataset(rng.rand(60, 16), rng.randint(0, 2, size=60))
+    rows   = theano.shared(rng.permutation(60)[0:50].astype(numpy.int32))
+
+    models = []
+    for cached in [False, True]:
+        sda = SdA(numpy_rng=numpy.random.RandomState(1234), theano_rng=RandomStreams(seed=1234),
+                  n_ins=16, hidden_layers_sizes=[8, 6, 5], n_outs=2, n_outs_b=2)
+        if cached:
+            (fns, encode) = sda.cached_pretraining_functions(x, 10, None, encode_batch_size, train_rows=rows)
+        else:
+            (fns, encode) = (sda.pretraining_functions(x, 10, None, train_rows=rows), None)
+
+        costs = []
+        for i in xrange(sda.n_layers):
+            if encode is not None and i > 0:
+                encode(i)
+            for epoch in xrange(3):
+                costs.extend( fns[i](index=k, corruption=0.2, lr=0.1) for k in xrange(5) )
+        models.append((costs, values(sda)))
+
+    ((costs, params), (cached_costs, cached_params)) = models
+    assert numpy.allclose(costs, cached_costs)
+    for (p, c) in zip(params, cached_params):
+        assert numpy.allclose(p, c, atol=1e-6)
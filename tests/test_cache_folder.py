@@ -0,0 +1,73 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# Entries of a cache folder, least recently used first out.
+# ------------------------------------------------------------------------------------
+import os
+
+from cache_folder import ensure_dir, lru_entries, lru_evict
+
+def entry(folder, name, nbytes, mtime):
+    path = os.path.join(folder, name)
+    if name.startswith('store_'):
+        os.makedirs(path)
+        with open(os.path.join(path, 'data.npy'), 'wb') as f:
+            f.write(b'x' * nbytes)
+    else:
+        with open(path, 'wb') as f:
+            f.write(b'x' * nbytes)
+    os.utime(path, (mtime, mtime))
+    return path
+
+def test_entries(tmpdir):
+    folder = str(tmpdir)
+    new    = entry(folder, 'store_b', 20, 2000)
+    old    = entry(folder, 'store_a', 10, 1000)
+    # being written, or of another cache
+    entry(folder, 'store_c.123.tmp', 10, 500)
+    entry(folder, 'pretrain_a.pkl.gz', 10, 500)
+
+    assert lru_entries(folder, 'store_') == [(1000, 10, old), (2000, 20, new)]
+
+def test_evict(tmpdir):
+    folder = str(tmpdir)
+    paths  = [ entry(folder, 'pretrain_{0:d}.pkl.gz'.format(k), 10, 1000 * (k + 1)) for k in range(4) ]
+    tmp    = entry(folder, 'pretrain_9.pkl.gz.123.tmp', 100, 100)
+
+    # the oldest entry is kept, the next ones go until 20 bytes are left
+    assert lru_evict(folder, 'pretrain_', 20, keep=paths[0]) == paths[1:3]
+    assert [ path for (mtime, size, path) in lru_entries(folder, 'pretrain_') ] == [paths[0], paths[3]]
+    assert os.path.isfile(tmp)
+    assert lru_evict(folder, 'pretrain_', 20) == []
+
+def test_evict_folders(tmpdir):
+    folder = str(tmpdir)
+    paths  = [ entry(folder, 'store_{0:d}'.format(k), 10, 1000 * (k + 1)) for k in range(3) ]
+    assert lru_evict(folder, 'store_', 15) == paths[0:2]
+    assert not os.path.exists(paths[0])
+    assert os.listdir(folder) == ['store_2']
+
+def test_ensure_dir(tmpdir):
+    folder = str(tmpdir.join('a', 'b'))
+    ensure_dir(folder)
+    ensure_dir(folder)
+    assert os.path.isdir(folder)
@@ -0,0 +1,124 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# A job or an experiment interrupted after a checkpoint and resumed ends
+# with the model of the same one run without interruption.
+# ------------------------------------------------------------------------------------
+import pytest
+
+from conftest import requires, TRAINING
+
+numpy = requires(*TRAINING)
+
+import main
+from checkpoint import Checkpoint, checkpoint_filename
+from pretrain_cache import PretrainCache, pretrain_key
+from data_handling import load_savedgzdata
+
+class Interrupted(Exception):
+    pass
+
+def train(options, sets):
+    """ parameter values of the model a job returns """
+    (sda, compiled) = main.build_model(sets[0], options)
+    sda = main.pretrain_finetune_model(sda, compiled, sets[0], sets[1], options)[1]
+    return [ var.get_value() for var in sda.model_variables() ]
+
+def interrupt_at(monkeypatch, phase, layer, epoch):
+    """ the job stops right after the checkpoint of `epoch` (of `layer`
+    when pretraining) """
+    save = Checkpoint.save
+    def interrupting_save(self, sda, theano_rng, state):
+        save(self, sda, theano_rng, state)
+        if (state['phase'], state.get('layer'), state['epoch']) == (phase, layer, epoch):
+            raise Interrupted()
+    monkeypatch.setattr(Checkpoint, 'save', interrupting_save)
+    return save
+
+@pytest.mark.parametrize('phase,layer,epoch', [('pretrain', 0, 3), ('pretrain', 1, 1), ('finetune', None, 4)])
+def test_resumed_job(sets, job_options, tmpdir, monkeypatch, phase, layer, epoch):
+    expected = train(job_options(tmpdir.mkdir('uninterrupted')), sets)
+
+    folder = tmpdir.mkdir('interrupted')
+    memo   = str(folder.join('pretrain_cache'))
+    save   = interrupt_at(monkeypatch, phase, layer, epoch)
+    with pytest.raises(Interrupted):
+        train(job_options(folder, pretrain_cache=memo), sets)
+    monkeypatch.setattr(Checkpoint, 'save', save)
+
+    saved = load_savedgzdata(job_options(folder)['checkpoint'])
+    assert (saved['phase'], saved['epoch']) == (phase, epoch)
+
+    options = job_options(folder, pretrain_cache=memo)
+    entry   = PretrainCache(memo, 1e9).load(pretrain_key(options, sets[0]))
+    if phase == 'finetune':
+        # pretraining was done before the interruption
+        assert entry is not None
+    else:
+        assert entry is None
+
+    resumed = train(options, sets)
+    assert len(resumed) == len(expected)
+    for (r, e) in zip(resumed, expected):
+        assert numpy.allclose(r, e)
+
+    # the memo keeps the pretrained stack, not the finetuned model
+    memoized = PretrainCache(memo, 1e9).load(pretrain_key(job_options(folder, pretrain_cache=memo), sets[0]))
+    if entry is not None:
+        for (m, p) in zip(memoized['params'], entry['params']):
+            assert numpy.array_equal(m, p)
+    assert not all( numpy.allclose(m, r) for (m, r) in zip(memoized['params'], resumed) )
+
+def test_resumed_retrain_experiment(folds, experiment_options, tmpdir, monkeypatch):
+    # the jobs skipped on resuming do not change the model the next ones
+    # retrain
+    folder = tmpdir.mkdir('source')
+    main.do_experiment(folds, experiment_options(folder), 1, None)
+    source = str(folder.join('00001_050_model.pkl.gz'))
+
+    def experiment(folder):
+        options = experiment_options(folder, retrain=1)
+        result  = main.do_experiment(folds, options, 1, load_savedgzdata(source))
+        return (result, load_savedgzdata(checkpoint_filename(options, 1, 'grid'))['errors'])
+
+    (expected, expected_errors) = experiment(tmpdir.mkdir('uninterrupted'))
+
+    # interrupted after 5 of the 12 jobs
+    run_cv_job = main.run_cv_job
+    calls = []
+    def interrupting_job(job):
+        if len(calls) == 5:
+            raise Interrupted()
+        calls.append(job)
+        return run_cv_job(job)
+    monkeypatch.setattr(main, 'run_cv_job', interrupting_job)
+    folder = tmpdir.mkdir('interrupted')
+    with pytest.raises(Interrupted):
+        experiment(folder)
+    monkeypatch.setattr(main, 'run_cv_job', run_cv_job)
+
+    (resumed, errors) = experiment(folder)
+    assert sorted(errors.keys()) == sorted(expected_errors.keys())
+    for job in errors:
+        assert numpy.allclose(errors[job], expected_errors[job])
+    assert numpy.allclose(resumed[0], expected[0])
+    assert numpy.array_equal(resumed[2], expected[2])
@@ -0,0 +1,155 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# Batched conversions of data_preprocessing against the per-image code
+# they replaced.
+# ------------------------------------------------------------------------------------
+import pytest
+
+from conftest import requires
+
+numpy = requires('numpy', 'theano', 'h5py', 'matplotlib')
+
+import data_preprocessing
+from data_preprocessing import resize_matrix, loadConvertMNIST, extract_patches
+from patch_store import PatchStore
+
+@pytest.fixture
+def mnist():
+    rng = numpy.random.RandomState(1234)
+    return (rng.rand(25, 28*28).astype(numpy.float32), rng.randint(0, 10, size=25))
+
+def test_resize_identity():
+    assert numpy.allclose(resize_matrix(20, 20), numpy.eye(20))
+
+@pytest.mark.parametrize('patchsize', [10, 20, 28, 40])
+def test_loadConvertMNIST(mnist, patchsize, monkeypatch):
+    cv2 = pytest.importorskip('cv2')
+    # several chunks
+    monkeypatch.setattr(data_preprocessing, 'RESIZE_CHUNK', 7)
+    (x, y) = mnist
+
+    store = PatchStore(numpy.zeros((30, patchsize*patchsize), dtype=numpy.float32),
+                       numpy.zeros((30,), dtype=numpy.int32), numpy.zeros((30,), dtype=numpy.int8))
+    (store, ids) = loadConvertMNIST(patchsize, 5, store, 28, x, y)
+    assert ids == 30
+
+    for k in range(0,len(y)):
+        # loadConvertMNIST before the matrices
+        p = cv2.resize(numpy.reshape(x[k,:], (28,28)), (patchsize,patchsize)).ravel()
+        assert numpy.allclose(store.patches[5+k], p, atol=1e-5)
+    assert numpy.array_equal(store.ids[5:], numpy.arange(5, 30))
+    assert numpy.array_equal(store.labels[5:], y)
+
+def sliced_patches(img, x, y, size):
+    """ patches of getPrecisionRecall before extract_patches: one slice
+    per point, points whose patch leaves the image discarded """
+    (height, width) = img.shape
+    (data, valid) = ([], [])
+    for i in range(0,len(x)):
+        if y[i]-size//2 < 0 or y[i]+size//2 > height or \
+           x[i]-size//2 < 0 or x[i]+size//2 > width:
+            valid.append(False)
+            continue
+        # float bounds were truncated
+        d = img[int(y[i]-size//2):int(y[i]+size//2), int(x[i]-size//2):int(x[i]+size//2)]
+        data.append(numpy.reshape(d, (-1,)))
+        valid.append(True)
+    return (numpy.array(data), numpy.array(valid))
+
+@pytest.mark.parametrize('size', [20, 8])
+def test_extract_patches(size):
+    rng = numpy.random.RandomState(1234)
+    img = rng.randint(0, 256, size=(60, 80)).astype(numpy.uint8)
+    # some points on and beyond the borders
+    x   = numpy.r_[rng.randint(0, 80, size=50), 0, size//2, 80 - size//2, 80]
+    y   = numpy.r_[rng.randint(0, 60, size=50), size//2, 0, 60 - size//2, 60]
+
+    (patches, valid) = extract_patches(img, x, y, size)
+    (data, expected) = sliced_patches(img, x, y, size)
+    assert numpy.array_equal(valid, expected)
+    assert numpy.array_equal(patches[valid], data)
+    assert not numpy.any(patches[~valid])
+
+def test_extract_patches_float_points():
+    rng = numpy.random.RandomState(1234)
+    img = rng.randint(0, 256, size=(60, 80)).astype(numpy.uint8)
+    # detections of the LoG detector: centres in (h-10, h-9] and (w-10,
+    # w-9] leave the image, as in the float check of getPrecisionRecall
+    x = numpy.r_[rng.rand(50) * 80, 70., 70.5, 71., 40., 40., 40., 9.5, 10., 10.5]
+    y = numpy.r_[rng.rand(50) * 60, 30., 30., 30., 50., 50.5, 51., 30., 30., 30.]
+
+    (patches, valid) = extract_patches(img, x, y, 20)
+    (data, expected) = sliced_patches(img, x, y, 20)
+    assert numpy.array_equal(valid, expected)
+    assert numpy.array_equal(valid[50:], [True, False, False, True, False, False, False, True, True])
+    assert numpy.array_equal(patches[valid], data)
+
+def test_extract_patches_small_image():
+    img = numpy.ones((10, 10))
+    (patches, valid) = extract_patches(img, [5], [5], 20)
+    assert patches.shape == (1, 400)
+    assert not numpy.any(valid)
+
+def fold_options(tmpdir):
+    return { 'datanormalize': True, 'streaming': False, 'oneclass': False, 'verbose': 0,
+             'numpy_rng': numpy.random.RandomState(1234), 'trainsize': 0.6, 'folds': 3,
+             'outputfolder': str(tmpdir), 'resolution': '050000' }
+
+@pytest.fixture
+def uint8_store():
+    """ store as write_store writes it: uint8 patches, int8 labels """
+    rng = numpy.random.RandomState(1234)
+    ids = numpy.sort(rng.randint(0, 12, size=200)).astype(numpy.int32)
+    return PatchStore(rng.randint(0, 256, size=(200, 16)).astype(numpy.uint8), ids,
+                      numpy.where(rng.rand(200) < 0.5, 1, -1).astype(numpy.int8))
+
+def test_gen_folds_uint8(uint8_store, tmpdir):
+    store = uint8_store
+    float_store = PatchStore(store.patches.astype(numpy.float32), store.ids, store.labels)
+
+    folds       = data_preprocessing.gen_folds(store, fold_options(tmpdir), 1)
+    float_folds = data_preprocessing.gen_folds(float_store, fold_options(tmpdir), 1)
+
+    # one list of sets per fold, then the final sets
+    sets       = folds[0] + folds[1] + folds[2] + folds[3:]
+    float_sets = float_folds[0] + float_folds[1] + float_folds[2] + float_folds[3:]
+    for (s, f) in zip(sets, float_sets):
+        (x, y, rows) = (s[0].get_value(borrow=True), data_preprocessing.dataset_labels(s),
+                        s[2].get_value(borrow=True))
+        assert x.dtype == numpy.uint8
+        # every set indexes the whole store
+        assert numpy.array_equal(x, store.patches)
+        assert numpy.array_equal(rows, f[2].get_value(borrow=True))
+        assert numpy.array_equal(y, (store.labels[rows] + 1) // 2)
+        assert numpy.array_equal(y, data_preprocessing.dataset_labels(f))
+        assert numpy.allclose(x[rows] / 255.001, f[0].get_value(borrow=True)[rows], atol=1e-6)
+
+def test_get_data_uint8(uint8_store):
+    options = { 'datanormalize': True, 'oneclass': False }
+    data    = data_preprocessing.shared_store(uint8_store, options)
+
+    testset = data_preprocessing.get_data(data, uint8_store, [0, 5, 11], options)
+    rows    = testset[2].get_value(borrow=True)
+    assert numpy.array_equal(rows, uint8_store.rows([0, 5, 11]))
+    assert numpy.array_equal(testset[0].get_value(borrow=True)[rows], uint8_store.patches[rows])
+    assert numpy.array_equal(data_preprocessing.dataset_labels(testset), (uint8_store.labels[rows] + 1) // 2)
@@ -0,0 +1,134 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# Converted datasets cached by source files and options, least recently
+# used first out.
+# ------------------------------------------------------------------------------------
+import os
+import pytest
+
+from conftest import requires
+
+numpy = requires('numpy', 'h5py', 'theano')
+
+from dataset_cache import DatasetCache, dataset_key, folder_size
+from patch_store import PatchStore, save_store
+
+OPTIONS = {'database': 'db2', 'resolution': '050000', 'datanormalize': True, 'patchsize': 20}
+
+@pytest.fixture
+def sources(tmpdir):
+    files = []
+    for k in range(0,3):
+        f = tmpdir.join('db2_050000_{0:d}.mat'.format(k))
+        f.write('x' * (k + 1))
+        files.append(str(f))
+    return files
+
+class Writer(object):
+    """ write function of DatasetCache.load: a small store per call """
+
+    def __init__(self, nsamples=100):
+        self.calls    = 0
+        self.nsamples = nsamples
+
+    def __call__(self, folder, key):
+        self.calls = self.calls + 1
+        rng = numpy.random.RandomState(len(key['files']))
+        store = PatchStore(rng.randint(0, 256, size=(self.nsamples, 16)).astype(numpy.uint8),
+                           numpy.arange(self.nsamples, dtype=numpy.int32),
+                           numpy.ones((self.nsamples,), dtype=numpy.int8))
+        save_store(folder, store, key)
+
+def test_key(sources):
+    key = dataset_key(sources, OPTIONS)
+    assert dataset_key(list(sources), dict(OPTIONS)) == key
+    # options the conversion does not depend on; the patches are
+    # normalized when they are read
+    assert dataset_key(sources, dict(OPTIONS, verbose=5, nruns=3)) == key
+    assert dataset_key(sources, dict(OPTIONS, datanormalize=False)) == key
+
+    assert dataset_key(sources[0:2], OPTIONS) != key
+    for (name, value) in [('resolution', '100000'), ('patchsize', 28)]:
+        assert dataset_key(sources, dict(OPTIONS, **{name: value})) != key
+
+    # a source file rewritten with another content
+    with open(sources[1], 'w') as f:
+        f.write('y' * 10)
+    assert dataset_key(sources, OPTIONS) != key
+
+def test_hit(sources, tmpdir):
+    cache = DatasetCache(str(tmpdir.join('cache')), 1e9)
+    write = Writer()
+
+    key   = dataset_key(sources, OPTIONS)
+    first = cache.load(key, write)
+    again = cache.load(dataset_key(sources, OPTIONS), write)
+    assert write.calls == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert isinstance(again.patches, numpy.memmap)
+    assert numpy.array_equal(again.patches, first.patches)
+
+    cache.load(dataset_key(sources, dict(OPTIONS, patchsize=28)), write)
+    assert write.calls == 2
+    assert len(cache.entries()) == 2
+
+def test_interrupted_write(sources, tmpdir):
+    cache  = DatasetCache(str(tmpdir.join('cache')), 1e9)
+    key    = dataset_key(sources, OPTIONS)
+    folder = cache.store_folder(key)
+    # a store without the manifest of its key is written again
+    os.makedirs(folder)
+    write = Writer()
+    cache.load(key, write)
+    assert write.calls == 1
+    assert cache.hits == 0
+
+def test_eviction(sources, tmpdir):
+    write = Writer()
+    keys  = [ dataset_key(sources[0:k], OPTIONS) for k in range(1,4) ]
+
+    cache = DatasetCache(str(tmpdir.join('cache')), 1e9)
+    cache.load(keys[0], write)
+    size  = folder_size(cache.store_folder(keys[0]))
+
+    # room for two stores
+    cache = DatasetCache(str(tmpdir.join('cache')), 2.5 * size)
+    cache.load(keys[1], write)
+    os.utime(cache.store_folder(keys[0]), (1000, 1000))
+    os.utime(cache.store_folder(keys[1]), (2000, 2000))
+    # the oldest store is used again
+    cache.load(keys[0], write)
+    assert write.calls == 2
+
+    cache.load(keys[2], write)
+    assert write.calls == 3
+    folders = [ folder for (mtime, s, folder) in cache.entries() ]
+    assert sorted(folders) == sorted([cache.store_folder(keys[0]), cache.store_folder(keys[2])])
+    assert sum(s for (mtime, s, folder) in cache.entries()) <= cache.maxbytes
+
+def test_store_over_limit(sources, tmpdir):
+    # the store just written is kept, even alone over the limit
+    cache = DatasetCache(str(tmpdir.join('cache')), 1)
+    key   = dataset_key(sources, OPTIONS)
+    cache.load(key, Writer())
+    assert [ folder for (mtime, s, folder) in cache.entries() ] == [cache.store_folder(key)]
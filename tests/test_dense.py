@@ -0,0 +1,66 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# Dense scoring of an image against the per-patch scores of the
+# candidates, as getPrecisionRecall computes them.
+# ------------------------------------------------------------------------------------
+import pytest
+
+from conftest import requires, TRAINING
+
+numpy = requires(*TRAINING)
+
+import theano
+
+from SdA import SdA
+from dense import DenseSdA
+from function_cache import Predictor
+from data_preprocessing import extract_patches
+
+@pytest.fixture
+def sda():
+    """ small trained-looking model: random weights everywhere, the
+    logistic layer included """
+    rng = numpy.random.RandomState(1234)
+    sda = SdA(numpy_rng=rng, n_ins=8*8, hidden_layers_sizes=[10, 6], n_outs=2, n_outs_b=2)
+    for param in sda.params:
+        value = param.get_value(borrow=True)
+        param.set_value(rng.uniform(-1, 1, size=value.shape).astype(theano.config.floatX))
+    return sda
+
+@pytest.mark.parametrize('tile', [7, 128])
+def test_probabilities(sda, tile):
+    rng = numpy.random.RandomState(4321)
+    img = rng.randint(0, 256, size=(30, 25)).astype(numpy.uint8)
+
+    probs = DenseSdA(sda, patchsize=8, tile=tile).probabilities(img)
+    assert probs.shape == (2, 30, 25)
+
+    # every pixel as a candidate
+    (y, x) = [ c.ravel() for c in numpy.mgrid[0:30, 0:25] ]
+    (patches, valid) = extract_patches(img, x, y, 8)
+    (y_pred, y_pred_prob) = Predictor(sda, input_dtype='uint8')(patches[valid])
+
+    assert numpy.allclose(probs[:, y[valid], x[valid]].T, y_pred_prob, atol=1e-6)
+    # NaN where the patch leaves the image
+    assert numpy.all(numpy.isnan(probs[:, y[~valid], x[~valid]]))
+    assert not numpy.any(numpy.isnan(probs[:, y[valid], x[valid]]))
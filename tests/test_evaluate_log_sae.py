@@ -0,0 +1,94 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# Matching of detections through the KD-tree against the per-detection
+# loop of checkResults it replaced.
+# ------------------------------------------------------------------------------------
+import pytest
+
+from conftest import requires
+
+numpy = requires('numpy', 'scipy', 'cv2', 'h5py', 'theano', 'matplotlib')
+
+from evaluate_log_sae import Matcher, checkResults
+
+def loop_checkResults(nelem_x, nmbrAnn, anncenters, pt, ypred, mindistgiven=10):
+    """ checkResults before the KD-tree """
+    TP = 0; FP = 0
+    GT = numpy.full((nmbrAnn,),0,dtype=numpy.uint8)
+
+    for i in range(0,nelem_x):
+        # background
+        if ypred[i] == 1:
+            continue
+
+        pti   = numpy.tile(pt[:,i].reshape((2,-1)),(1,nmbrAnn))
+        dists = numpy.sqrt( numpy.sum( (pti - anncenters) * (pti - anncenters), axis=0) )
+        mindistidx = numpy.nonzero( dists <= mindistgiven )[0]
+
+        nanofound = False
+        for arg in numpy.argsort( dists[mindistidx] ):
+            if GT[mindistidx[arg]] == 0:
+                GT[mindistidx[arg]] = 1
+                TP = TP + 1
+                nanofound = True
+                break
+        if nanofound == False:
+            FP = FP + 1
+
+    return (TP,FP,sum(GT == 0))
+
+@pytest.fixture
+def detections():
+    rng        = numpy.random.RandomState(1234)
+    anncenters = rng.rand(2, 40) * 200
+    # detections near some of the annotations, and elsewhere
+    near = anncenters[:,rng.randint(0, 40, size=60)] + rng.randn(2, 60) * 6
+    pt   = numpy.c_[ near, rng.rand(2, 30) * 200 ]
+    pt   = pt[:,rng.permutation(pt.shape[1])]
+    ypred = rng.randint(0, 2, size=pt.shape[1])
+    return (anncenters, pt, ypred)
+
+@pytest.mark.parametrize('radius', [2, 5, 10, 20])
+def test_checkResults(detections, radius):
+    (anncenters, pt, ypred) = detections
+    nelem_x = pt.shape[1] - 5
+    assert tuple(checkResults(nelem_x, anncenters.shape[1], anncenters, pt, ypred, radius)) == \
+           loop_checkResults(nelem_x, anncenters.shape[1], anncenters, pt, ypred, radius)
+
+def test_match_radii(detections):
+    (anncenters, pt, ypred) = detections
+    radii   = [2, 5, 10, 20]
+    matches = Matcher(anncenters).match(pt, radii)
+    for (radius, (TP, FP, FN, pairs)) in zip(radii, matches):
+        expected = loop_checkResults(pt.shape[1], anncenters.shape[1], anncenters, pt,
+                                     numpy.zeros(pt.shape[1]), radius)
+        assert (TP, FP, FN) == expected
+        # each annotation is taken once, within the radius
+        assert len(numpy.unique(pairs[:,1])) == TP
+        dists = numpy.sqrt(numpy.sum((pt[:,pairs[:,0]] - anncenters[:,pairs[:,1]])**2, axis=0))
+        assert numpy.all(dists <= radius)
+
+def test_match_empty():
+    pt = numpy.array([[1., 2.], [3., 4.]])
+    assert Matcher(numpy.zeros((2,0))).match(pt, [10])[0][0:3] == (0, 2, 0)
+    assert Matcher(pt).match(numpy.zeros((2,0)), [10])[0][0:3] == (0, 0, 2)
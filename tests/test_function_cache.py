@@ -0,0 +1,104 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# A model reused from the function cache starts as a model built from
+# scratch with the same seed.
+# ------------------------------------------------------------------------------------
+import pytest
+
+from conftest import requires, TRAINING
+
+numpy = requires(*TRAINING)
+
+import theano
+from theano.tensor.shared_randomstreams import RandomStreams
+
+from SdA import SdA
+from function_cache import FunctionCache
+from data_preprocessing import shared_dataset
+
+@pytest.fixture
+def options(job_options):
+    """ options(seed, **changes): options of a job of do_experiment, as
+    FunctionCache.get reads them """
+    def make(seed, **changes):
+        opts = job_options(seed=seed, cache_layer_outputs=False, finetune_lr=0.1, pretrain_lr=0.01)
+        opts.update(changes)
+        return opts
+    return make
+
+def values(sda):
+    return [ var.get_value() for var in sda.model_variables() ]
+
+@pytest.fixture
+def train_set():
+    rng = numpy.random.RandomState(1234)
+    return shared_dataset(rng.rand(60, 16), rng.randint(0, 2, size=60))
+
+def pretrain(compiled, train_set, nbatches=6):
+    """ costs of some pretraining steps of each layer, which draw the
+    corruption noise """
+    compiled.bind(train_set=train_set)
+    return [ fn(index=k, corruption=0.3, lr=0.1)
+             for fn in compiled.pretraining_fns for k in xrange(nbatches) ]
+
+def test_key(options):
+    cache = FunctionCache()
+    key   = cache.key(options(1))
+    # finetuning hyperparameters and seeds share the compiled model
+    assert cache.key(options(2, finetune_lr=0.01, pretrain_lr=0.1)) == key
+    assert cache.key(options(1, hlayers=[8, 6])) == key
+    for changes in [{'hlayers': [8, 8]}, {'hlayers': [8]}, {'ndim': 25}, {'nclasses': 3},
+                    {'batchsize': 100}, {'test_batchsize': 50}, {'cache_layer_outputs': True},
+                    {'input_dtype': 'uint8'}]:
+        assert cache.key(options(1, **changes)) != key
+
+def test_hits(options):
+    cache = FunctionCache()
+    first = cache.get(options(1))
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert cache.get(options(2)) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.get(options(1, batchsize=20)) is not first
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert len(cache.entries) == 2
+
+def test_hit_as_fresh_build(options, train_set):
+    cache = FunctionCache()
+    # a previous job trains the cached model and draws noise
+    pretrain(cache.get(options(1)), train_set)
+
+    hit   = cache.get(options(7))
+    fresh = FunctionCache().get(options(7))
+    assert hit is not fresh
+
+    # same initial weights as the constructor draws
+    built = SdA(numpy_rng=numpy.random.RandomState(7), theano_rng=RandomStreams(seed=7),
+                n_ins=16, hidden_layers_sizes=[8, 6], n_outs=2, n_outs_b=2)
+    for (h, f, b) in zip(values(hit.sda), values(fresh.sda), values(built)):
+        assert numpy.array_equal(h, f)
+        assert numpy.array_equal(h, b)
+
+    # and the same corruption noise
+    assert numpy.allclose(pretrain(hit, train_set), pretrain(fresh, train_set))
+    for (h, f) in zip(values(hit.sda), values(fresh.sda)):
+        assert numpy.allclose(h, f)
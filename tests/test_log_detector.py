@@ -0,0 +1,162 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# The LoG port against a literal transcription of LoG.m: full 2-D
+# fspecial kernels, imfilter as padding plus correlation, imregionalmax
+# by flood fill and imdilate over the disk footprint.
+# ------------------------------------------------------------------------------------
+import pytest
+
+from conftest import requires
+
+numpy = requires('numpy', 'scipy', 'cv2')
+
+from log_detector import log_filter, regional_maxima, log_detector
+
+PADDING = {'symmetric': 'symmetric', 'replicate': 'edge'}
+
+def fspecial_gaussian(n, sigma):
+    siz = (n - 1) / 2.
+    (y, x) = numpy.mgrid[-siz:siz+1, -siz:siz+1]
+    h = numpy.exp(-(x*x + y*y) / (2. * sigma * sigma))
+    h[h < numpy.finfo(float).eps * h.max()] = 0
+    return h / h.sum()
+
+def fspecial_log(n, sigma):
+    siz = (n - 1) / 2.
+    (y, x) = numpy.mgrid[-siz:siz+1, -siz:siz+1]
+    h  = fspecial_gaussian(n, sigma)
+    h1 = h * (x*x + y*y - 2. * sigma * sigma) / sigma**4
+    return h1 - h1.sum() / (n * n)
+
+def imfilter(img, h, mode):
+    """ correlation with the centre of h on its element (size+1)/2 (1-based) """
+    (hy, hx) = h.shape
+    (cy, cx) = ((hy - 1) // 2, (hx - 1) // 2)
+    padded = numpy.pad(img, ((cy, hy - 1 - cy), (cx, hx - 1 - cx)), mode=PADDING[mode])
+    out = numpy.zeros(img.shape)
+    for a in range(0,hy):
+        for b in range(0,hx):
+            out += h[a,b] * padded[a:a+img.shape[0], b:b+img.shape[1]]
+    return out
+
+def imregionalmax(f):
+    """ 8-connected plateaus whose neighbours are all lower """
+    (h, w) = f.shape
+    result = numpy.zeros(f.shape, dtype=bool)
+    seen   = numpy.zeros(f.shape, dtype=bool)
+    for i in range(0,h):
+        for j in range(0,w):
+            if seen[i,j]:
+                continue
+            (plateau, stack, ismax) = ([], [(i,j)], True)
+            seen[i,j] = True
+            while stack:
+                (y, x) = stack.pop()
+                plateau.append((y, x))
+                for dy in (-1, 0, 1):
+                    for dx in (-1, 0, 1):
+                        (v, u) = (y + dy, x + dx)
+                        if (dy, dx) == (0, 0) or not (0 <= v < h and 0 <= u < w):
+                            continue
+                        if f[v,u] > f[i,j]:
+                            ismax = False
+                        elif f[v,u] == f[i,j] and not seen[v,u]:
+                            seen[v,u] = True
+                            stack.append((v, u))
+            for (y, x) in plateau:
+                result[y,x] = ismax
+    return result
+
+def imdilate_disk(f, radius):
+    (h, w) = f.shape
+    padded = numpy.pad(f, radius, mode='constant', constant_values=-numpy.inf)
+    out    = numpy.empty(f.shape)
+    out.fill(-numpy.inf)
+    for dy in range(-radius,radius+1):
+        for dx in range(-radius,radius+1):
+            if dx*dx + dy*dy <= radius*radius:
+                out = numpy.maximum(out, padded[radius+dy:radius+dy+h, radius+dx:radius+dx+w])
+    return out
+
+def LoG(im, Rmin, Rmax, step, sigma, th, disk_size, signal):
+    """ LoG.m, without mask """
+    img = imfilter(numpy.asarray(im, dtype=numpy.float64),
+                   fspecial_gaussian(int(round(5*sigma)), sigma), 'symmetric')
+    (rows, cols) = img.shape
+
+    block = []
+    for r in numpy.arange(Rmin, Rmax + 1e-10, step):
+        s = int(round(r / 1.5))
+        h = (s**2) * fspecial_log(int(round(s*5)), s)
+        h = numpy.abs(h) if signal == 2 else signal * h
+        block.append(imfilter(img, h, 'replicate'))
+    block = numpy.array(block)
+    Cxy   = block.max(axis=0)
+    indx  = block.argmax(axis=0) * step + 1
+
+    Cxy_g  = imfilter(Cxy, fspecial_gaussian(10, 1.4), 'symmetric')
+    ir_max = imregionalmax(Cxy_g) * Cxy_g
+    ir_med = imdilate_disk(ir_max, disk_size)
+    ir_max = (ir_med == ir_max) * ir_max
+
+    sp = []
+    (c, r) = numpy.nonzero((ir_max > th).T)
+    for p in range(0,len(r)):
+        rdx = indx[r[p],c[p]] + Rmin - 1
+        (x, y) = (c[p] + 1, r[p] + 1)
+        if x - rdx > 0 and y - rdx > 0 and x + rdx < cols and y + rdx < rows:
+            sp.append((x, y, rdx, ir_max[r[p],c[p]]))
+    return sorted(sp, key=lambda d: -d[3])
+
+@pytest.fixture
+def image():
+    """ dark particles on a bright, noisy background """
+    rng    = numpy.random.RandomState(1234)
+    (y, x) = numpy.mgrid[0:64, 0:72]
+    im     = 200 + rng.randn(64, 72) * 5
+    for (cy, cx, r) in [(15, 20, 4), (40, 50, 6), (50, 15, 5), (20, 55, 3)]:
+        im -= 120 * numpy.exp(-((x - cx)**2 + (y - cy)**2) / (2. * r * r))
+    return im
+
+@pytest.mark.parametrize('s', [2, 3, 5])
+@pytest.mark.parametrize('signal', [1, -1, 2])
+def test_log_filter(image, s, signal):
+    h = (s**2) * fspecial_log(int(round(s*5)), s)
+    h = numpy.abs(h) if signal == 2 else signal * h
+    assert numpy.allclose(log_filter(image, s, signal), imfilter(image, h, 'replicate'), atol=1e-8)
+
+def test_regional_maxima():
+    rng = numpy.random.RandomState(0)
+    # plateaus of equal values, some of them maxima
+    f = rng.randint(0, 6, size=(30, 40)).astype(numpy.float64)
+    assert numpy.array_equal(regional_maxima(f), imregionalmax(f))
+
+@pytest.mark.parametrize('signal', [1, 2])
+def test_log_detector(image, signal):
+    sp = log_detector(image, 3, 7, 2, 1, 5, 4, signal=signal)
+    expected = LoG(image, 3, 7, 2, 1, 5, 4, signal)
+    assert len(expected) > 0
+    assert len(sp['x']) == len(expected)
+    for (k, (x, y, rdx, resp)) in enumerate(expected):
+        assert (sp['x'][k], sp['y'][k], sp['radius'][k]) == (x, y, rdx)
+        assert numpy.allclose(sp['resp'][k], resp)
@@ -0,0 +1,131 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# The vectorized measures against the per-sample loops they replaced.
+# ------------------------------------------------------------------------------------
+import pytest
+
+from conftest import requires
+
+numpy = requires('numpy')
+
+from metrics import evaluate_errors, confusion_counts, confusion_matrix
+
+background   = 1
+nanoparticle = 0
+
+def loop_error(y_valid, y_pred, options):
+    """ evaluate_error of main.py before the vectorization """
+    TP = FN = FP = TN = 0
+    for ith in range(0,len(y_pred)):
+        if y_pred[ith]   == background   and y_valid[ith] == background:
+            TN = TN + 1
+        elif y_pred[ith] == nanoparticle and y_valid[ith] == background:
+            FP = FP + 1
+        elif y_pred[ith] == background   and y_valid[ith] == nanoparticle:
+            FN = FN + 1
+        elif y_pred[ith] == nanoparticle and y_valid[ith] == nanoparticle:
+            TP = TP + 1
+
+    Recall    = TP / (TP+FN+0.0001)
+    Precision = TP / (TP+FP+0.0001)
+
+    errors = numpy.array(y_valid != y_pred, dtype=numpy.float64)
+    if options['measure'] == 'fmeasure':
+        return 1 - 2*(Precision*Recall) / (Precision+Recall+0.0001)
+    elif options['measure'] == 'f1score':
+        return 1 - 2*TP / (2*TP + FP + FN + 0.0001)
+    elif options['measure'] == 'acc':
+        return 1 - (TP + TN) / ( TP + TN + FP + FN + 0.0001 )
+    elif options['measure'] == 'weightedmer':
+        weights = numpy.ones( y_valid.shape, dtype=numpy.float32 )
+        weights[y_valid == background] = options['weight']
+        return numpy.mean( weights * errors )
+    else:
+        indback = y_valid == background
+        indnano = y_valid == nanoparticle
+        ninstback = sum(indback)
+        ninstnano = sum(indnano)
+        val = numpy.minimum(ninstback,ninstnano)/(numpy.maximum(ninstback,ninstnano)*1.)
+
+        weightscls = numpy.zeros( y_valid.shape, dtype=numpy.float32 )
+        if ninstback > ninstnano:
+            weightscls[indnano] = 2-val
+            weightscls[indback] = 1
+        else:
+            weightscls[indnano] = 1
+            weightscls[indback] = 2-val
+        return numpy.mean( weightscls * errors )
+
+def loop_confusion_matrix(ytest, ypred, K):
+    """ confusion_matrix of data_preprocessing.py before the vectorization """
+    nsamples = min(len(ytest),len(ypred))
+    cm = numpy.zeros((K,K))
+    for elem in range(0,nsamples):
+        cm[ytest[elem],ypred[elem]] = cm[ytest[elem],ypred[elem]] + 1
+    return cm
+
+@pytest.fixture
+def labels():
+    rng     = numpy.random.RandomState(1234)
+    y_valid = (rng.rand(300) < 0.8).astype(numpy.int32)
+    y_preds = (rng.rand(5,300) < 0.7).astype(numpy.int32)
+    return (y_valid, y_preds)
+
+@pytest.mark.parametrize('measure', ['fmeasure','f1score','acc','weightedmer','weightedmercls'])
+def test_evaluate_errors(labels, measure):
+    (y_valid, y_preds) = labels
+    options = {'measure': measure, 'weight': 200}
+
+    scores = evaluate_errors(y_valid, y_preds, options)
+    assert scores.shape == (y_preds.shape[0],)
+    for row in range(0,y_preds.shape[0]):
+        expected = loop_error(y_valid, y_preds[row], options)
+        assert numpy.allclose(scores[row], expected)
+        assert numpy.allclose(evaluate_errors(y_valid, y_preds[row], options), expected)
+
+def test_confusion_counts(labels):
+    (y_valid, y_preds) = labels
+    (TP, FP, FN, TN) = confusion_counts(y_valid, y_preds[0])
+    assert TP + FP + FN + TN == len(y_valid)
+    assert TP == numpy.sum((y_valid == nanoparticle) & (y_preds[0] == nanoparticle))
+    assert FP == numpy.sum((y_valid == background) & (y_preds[0] == nanoparticle))
+
+def test_confusion_matrix(labels):
+    (y_valid, y_preds) = labels
+    cms = confusion_matrix(y_valid, y_preds, 2)
+    for row in range(0,y_preds.shape[0]):
+        assert numpy.array_equal(cms[row], loop_confusion_matrix(y_valid, y_preds[row], 2))
+    # the shorter of the two vectors
+    assert numpy.array_equal(confusion_matrix(y_valid[0:100], y_preds[0], 2),
+                             loop_confusion_matrix(y_valid[0:100], y_preds[0], 2))
+
+def test_unknown_measure(labels):
+    (y_valid, y_preds) = labels
+    with pytest.raises(ValueError):
+        evaluate_errors(y_valid, y_preds, {'measure': 'auc', 'weight': 200})
+
+@pytest.mark.parametrize('ytest,ypred', [([0, 1, 2], [0, 1, 1]), ([0, 1, 1], [0, 2, 1]),
+                                         ([0, -1, 1], [0, 1, 1]), ([0, 1, 1], [[0, 1, 1], [0, -1, 1]])])
+def test_confusion_matrix_labels(ytest, ypred):
+    with pytest.raises(ValueError):
+        confusion_matrix(numpy.array(ytest), numpy.array(ypred), 2)
@@ -0,0 +1,102 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# The cross-validation grid run by a pool of workers gives the results
+# of the grid run in order.
+# ------------------------------------------------------------------------------------
+import pytest
+
+from conftest import requires, TRAINING
+
+numpy = requires(*TRAINING)
+
+import main
+from parallel import get_pool, blas_threads
+from checkpoint import checkpoint_filename
+from data_handling import load_savedgzdata
+
+def worker_blas_threads(i):
+    return blas_threads()
+
+def test_worker_blas_threads():
+    # the thread pools of the BLAS numpy loaded before the fork
+    threads = blas_threads()
+    if len(threads) == 0:
+        pytest.skip('no BLAS thread pool to cap')
+    numpy.dot(numpy.ones((200,200)), numpy.ones((200,200)))
+
+    pool = get_pool(2, 1)
+    try:
+        workers = pool.map(worker_blas_threads, range(4))
+    finally:
+        pool.close()
+        pool.join()
+    for counts in workers:
+        assert sorted(counts.keys()) == sorted(threads.keys())
+        assert all(n == 1 for n in counts.values())
+    # the parent keeps its threads
+    assert blas_threads() == threads
+
+# options that select the best combination
+SELECTED = ['hlayers', 'pretraining_epochs', 'training_epochs', 'pretrain_lr', 'finetune_lr',
+            'batchsize', 'corruptlevels', 'threshold', 'pretrain_id']
+
+def run_grid(options, folds, source=None):
+    """ result of the final model, errors of the grid and selected
+    options of an experiment, retraining the model saved in `source` """
+    folder  = options['outputfolder']
+    sda_reuse_model = None if source is None else load_savedgzdata(source)
+    result  = main.do_experiment(folds, options, 1, sda_reuse_model)
+
+    grid = load_savedgzdata(checkpoint_filename(options, 1, 'grid'))
+    best = load_savedgzdata(folder + '/00001_050_options.pkl.gz')
+    return (result, grid['errors'], best)
+
+def assert_same_runs(runs):
+    ((result, errors, best), (p_result, p_errors, p_best)) = runs
+    assert sorted(errors.keys()) == sorted(p_errors.keys())
+    assert len(errors) == 4 * 3
+    for job in errors:
+        assert numpy.allclose(errors[job], p_errors[job])
+    for name in SELECTED:
+        assert numpy.all(numpy.asarray(best[name]) == numpy.asarray(p_best[name]))
+
+    # test error, labels and predictions of the final model
+    assert numpy.allclose(result[0], p_result[0])
+    assert numpy.array_equal(result[1], p_result[1])
+    assert numpy.array_equal(result[2], p_result[2])
+
+def test_parallel_grid(folds, experiment_options, tmpdir):
+    assert_same_runs([ run_grid(experiment_options(tmpdir.mkdir('workers_{0:d}'.format(nworkers)), nworkers),
+                                folds)
+                       for nworkers in [1, 3] ])
+
+def test_parallel_retrain_grid(folds, experiment_options, tmpdir):
+    # every retraining job starts from the source model, whichever
+    # jobs the worker ran before it
+    folder = tmpdir.mkdir('source')
+    run_grid(experiment_options(folder), folds)
+    source = str(folder.join('00001_050_model.pkl.gz'))
+
+    assert_same_runs([ run_grid(experiment_options(tmpdir.mkdir('retrain_{0:d}'.format(nworkers)), nworkers,
+                                                   retrain=1), folds, source)
+                       for nworkers in [1, 3] ])
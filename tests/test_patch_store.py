@@ -0,0 +1,86 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# Patch store against the selection of get_data on the packed dataset
+# matrix it replaced.
+# ------------------------------------------------------------------------------------
+import pytest
+
+from conftest import requires
+
+numpy = requires('numpy', 'h5py', 'theano')
+
+import patch_store
+from patch_store import packed_store, save_store, open_store
+
+def packed_dataset(rng, nimages=12, ndim=16):
+    """ [[ ids ], [ data ], [ cls ]], one sample per column, as load_data
+    built it; images 3 and 7 have no patches """
+    ids = numpy.concatenate([ [k] * rng.randint(1,30) for k in range(0,nimages) if k not in (3,7) ])
+    x   = rng.randint(0, 256, size=(ndim, len(ids)))
+    cls = numpy.where(rng.rand(len(ids)) < 0.5, 1, -1)
+    return numpy.r_[ ids[numpy.newaxis,:], x, cls[numpy.newaxis,:] ].astype(numpy.float64)
+
+def get_data(dataset, ids, minvalue=0, maxvalue=255):
+    """ get_data of data_preprocessing.py before the store, without the
+    shared variables """
+    idx = numpy.in1d(dataset[0,:],ids)
+    x   = dataset[1:-1,idx].T
+    y   = (dataset[-1,idx] + 1) / 2
+    return ((x - minvalue) / (maxvalue-minvalue+0.001), y)
+
+@pytest.fixture
+def dataset():
+    return packed_dataset(numpy.random.RandomState(1234))
+
+@pytest.mark.parametrize('ids', [[0,1,2], [11,5,3,0], [3,7], [4,100,-1]])
+def test_selection(dataset, ids, monkeypatch):
+    # several gather chunks per selection
+    monkeypatch.setattr(patch_store, 'GATHER_CHUNK', 7)
+    store = packed_store(dataset)
+
+    rows   = store.rows(ids)
+    (x, y) = get_data(dataset, ids)
+    assert numpy.allclose(store.gather(rows, 0, 255, dtype=numpy.float32), x, atol=1e-6)
+    assert numpy.array_equal((store.labels[rows] + 1) // 2, y)
+    assert numpy.array_equal(store.gather(rows, dtype=numpy.float64), dataset[1:-1,numpy.in1d(dataset[0,:],ids)].T)
+
+def test_unsorted_dataset(dataset):
+    order = numpy.random.RandomState(0).permutation(dataset.shape[1])
+    store = packed_store(dataset[:,order])
+    assert numpy.all(numpy.diff(store.ids) >= 0)
+    assert store.nimages == 10
+
+    rows = store.rows([5])
+    assert numpy.array_equal(numpy.sort(store.gather(rows, dtype=numpy.float64), axis=0),
+                             numpy.sort(get_data(dataset, [5], 0, 0.999)[0], axis=0))
+
+def test_saved_store(dataset, tmpdir):
+    store  = packed_store(dataset)
+    folder = str(tmpdir.join('store_test'))
+    save_store(folder, store, {'files': []})
+
+    opened = open_store(folder)
+    assert opened.key == 'store_test'
+    assert numpy.array_equal(opened.offsets, store.offsets)
+    rows = opened.rows([1,2,9])
+    assert numpy.array_equal(opened.gather(rows, dtype=numpy.float64), store.gather(rows, dtype=numpy.float64))
@@ -0,0 +1,81 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# Class samplers against the class shares of a set balanced by
+# replicating its minority class.
+# ------------------------------------------------------------------------------------
+import pytest
+
+from conftest import requires
+
+numpy = requires('numpy')
+
+from sampling import ClassSampler, get_sampler
+
+def replicated(labels, weights):
+    """ Positions of a set where each class is replicated to its share """
+    positions = []
+    for c in numpy.unique(labels):
+        rows = numpy.flatnonzero(labels == c)
+        positions.append(numpy.resize(rows, int(weights.get(c, 1.) * len(labels))))
+    return numpy.concatenate(positions)
+
+def shares(labels, positions):
+    return numpy.bincount(labels[positions], minlength=2) / float(len(positions))
+
+@pytest.fixture
+def labels():
+    rng = numpy.random.RandomState(1234)
+    return (rng.rand(2000) < 0.9).astype(numpy.int32)
+
+@pytest.mark.parametrize('weights', [None, {0: 1., 1: 3.}])
+def test_class_shares(labels, weights):
+    sampler = ClassSampler(labels, weights)
+    rng     = numpy.random.RandomState(0)
+    drawn   = numpy.concatenate([sampler.draw(rng) for epoch in range(0,20)])
+
+    expected = shares(labels, replicated(labels, weights or {}))
+    assert numpy.allclose(shares(labels, drawn), expected, atol=0.01)
+
+def test_draw(labels):
+    sampler   = ClassSampler(labels)
+    positions = sampler.draw(numpy.random.RandomState(0))
+    assert len(positions) == len(labels)
+    assert positions.min() >= 0 and positions.max() < len(labels)
+
+    # every sample of the minority class is drawn about as often
+    rng    = numpy.random.RandomState(1)
+    counts = numpy.bincount(numpy.concatenate([sampler.draw(rng) for epoch in range(0,50)]),
+                            minlength=len(labels))
+    minority = counts[labels == 0]
+    assert abs(minority.mean() - 50 * len(labels) / 2. / len(minority)) < 0.05 * minority.mean()
+
+def test_get_sampler(labels):
+    options = {'sampler': None, 'replicate': False, 'sampler_weights': {0: 1., 1: 1.}}
+    assert get_sampler(options, labels) is None
+
+    options['replicate'] = True
+    assert isinstance(get_sampler(options, labels), ClassSampler)
+
+    options['sampler'] = 'oversample'
+    with pytest.raises(ValueError):
+        get_sampler(options, labels)
@@ -0,0 +1,84 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# Stopping policies: no policy runs every epoch, as the fixed loop did,
+# and a policy restored from its state decides as if it had not stopped.
+# ------------------------------------------------------------------------------------
+import pytest
+
+from conftest import requires
+
+numpy = requires('numpy')
+
+from stopping import Plateau, HeldOut, AnyOf, get_stopping
+
+def options(names):
+    return { 'pretrain_stop': names, 'pretrain_stop_tol': 0.01, 'pretrain_stop_window': 5,
+             'pretrain_stop_patience': 2, 'pretrain_stop_seconds': 3600 }
+
+def epochs_run(policy, costs):
+    """ epochs of the pretraining loop until the policy stops it """
+    policy.start(0)
+    for epoch, cost in enumerate(costs):
+        if policy.stop(epoch, cost):
+            return epoch + 1
+    return len(costs)
+
+def test_no_policy_runs_every_epoch():
+    costs = numpy.ones(50)
+    assert epochs_run(get_stopping(options([]), None), costs) == len(costs)
+
+def test_plateau():
+    # still improving by half every epoch
+    assert epochs_run(Plateau(0.01, 5), 0.5 ** numpy.arange(40)) == 40
+    # flat from the start: stops at the end of the second window
+    assert epochs_run(Plateau(0.01, 5), numpy.ones(40)) == 10
+
+def test_heldout():
+    losses  = iter([1.0, 0.5, 0.5, 0.5, 0.5])
+    policy  = HeldOut([lambda: next(losses)], 0.01, 2, 3)
+    # one check every 3 epochs; the 3rd and 4th checks do not improve
+    assert epochs_run(policy, numpy.ones(30)) == 12
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        get_stopping(options(['never']), None)
+
+@pytest.mark.parametrize('resume_at', [3, 7, 12])
+def test_resumed_policy(resume_at):
+    costs = numpy.concatenate([numpy.linspace(2, 1, 10), numpy.ones(30)])
+    full  = epochs_run(AnyOf([Plateau(0.01, 5)]), costs)
+
+    policy = AnyOf([Plateau(0.01, 5)])
+    policy.start(0)
+    for epoch in range(0,resume_at):
+        assert not policy.stop(epoch, costs[epoch])
+    state = policy.state()
+
+    # the checkpoint is loaded by a new process
+    resumed = AnyOf([Plateau(0.01, 5)])
+    resumed.start(0)
+    resumed.set_state(state)
+    for epoch in range(resume_at,len(costs)):
+        if resumed.stop(epoch, costs[epoch]):
+            break
+    assert epoch + 1 == full
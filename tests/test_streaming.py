@@ -0,0 +1,136 @@
+# Ricardo Sousa
+# rsousa at rsousa.org
+
+# Copyright 2014 Ricardo Sousa
+
+# This file is part of NanoParticles.
+
+# NanoParticles is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+
+# NanoParticles is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NanoParticles. If not, see http://www.gnu.org/licenses/.
+
+
+# ------------------------------------------------------------------------------------
+# Minibatches of a streamed training set, as the training functions
+# see them through `streamed`.
+# ------------------------------------------------------------------------------------
+import pytest
+
+from conftest import requires
+
+# the prefetch thread hands chunks over through the Python 2 Queue
+numpy = requires('numpy', 'Queue')
+
+from streaming import StreamingSet, streamed
+
+@pytest.fixture
+def dataset():
+    """ 95 rows of a store of 200 patches; the first column of a patch
+    is its row """
+    rng   = numpy.random.RandomState(1234)
+    store = numpy.c_[ numpy.arange(200), rng.rand(200, 3) ]
+    rows  = numpy.sort(rng.permutation(200)[0:95])
+    read  = lambda r: (store[r], r % 2)
+    return (store, lambda chunk_batches: StreamingSet(read, rows, rows % 2, store, chunk_batches, 1234))
+
+def minibatch_fn(stream):
+    """ training function of minibatch `index`: returns the rows of the
+    minibatch in the bound chunk """
+    slot = {}
+    def bind(x, y):
+        slot['x'] = x
+    def fn(index):
+        return slot['x'][index * stream.batch_size:(index + 1) * stream.batch_size, 0].astype(numpy.int64)
+    return streamed(fn, stream, bind)
+
+def run_epochs(stream, nepochs):
+    f = minibatch_fn(stream)
+    return [ numpy.concatenate([ f(index) for index in xrange(stream.n_batches) ])
+             for epoch in xrange(nepochs) ]
+
+@pytest.mark.parametrize('chunk_batches', [1, 4, 9, 20])
+def test_epochs(dataset, chunk_batches):
+    (store, streaming_set) = dataset
+    s      = streaming_set(chunk_batches)
+    stream = s.stream(10)
+    assert (stream.n_batches, stream.nchunks) == (9, (9 + chunk_batches - 1) // chunk_batches)
+
+    epochs = run_epochs(stream, 3)
+    stream.close()
+    for (epoch, seen) in enumerate(epochs):
+        # full minibatches of distinct samples of the set, in the order
+        # of the epoch
+        assert len(seen) == 90
+        assert len(numpy.unique(seen)) == 90
+        assert numpy.all(numpy.in1d(seen, s.rows))
+        assert numpy.array_equal(seen, s.rows[stream.order(epoch)])
+    assert not numpy.array_equal(epochs[0], epochs[1])
+
+def test_cut_epoch(dataset):
+    (store, streaming_set) = dataset
+    stream = streaming_set(2).stream(10)
+    f = minibatch_fn(stream)
+
+    # a pretraining epoch stopped after 5 minibatches
+    for index in xrange(5):
+        f(index)
+    seen = numpy.concatenate([ f(index) for index in xrange(stream.n_batches) ])
+    stream.close()
+    assert numpy.array_equal(seen, stream.dataset.rows[stream.order(1)])
+
+def test_resumed_stream(dataset):
+    (store, streaming_set) = dataset
+    stream = streaming_set(4).stream(10)
+    epochs = run_epochs(stream, 4)
+    stream.close()
+
+    # a new process resumes after the second epoch
+    stream = streaming_set(4).stream(10)
+    run_epochs(stream, 2)
+    state  = stream.state()
+    stream.close()
+
+    resumed = streaming_set(4).stream(10)
+    resumed.set_state(state)
+    for (seen, expected) in zip(run_epochs(resumed, 2), epochs[2:]):
+        assert numpy.array_equal(seen, expected)
+    resumed.close()
+
+def test_close(dataset):
+    (store, streaming_set) = dataset
+    stream = streaming_set(2).stream(10)
+    run_epochs(stream, 1)
+
+    thread = stream.thread
+    assert thread is not None and thread.is_alive()
+    stream.close()
+    assert stream.thread is None
+    assert not thread.is_alive()
+    # closing twice is harmless, and the stream starts again when read
+    stream.close()
+    assert len(run_epochs(stream, 1)[0]) == 90
+    stream.close()
+
+def test_read_error(dataset):
+    (store, streaming_set) = dataset
+    def read(rows):
+        raise IOError('bad rows')
+    s = streaming_set(2)
+    s.read = read
+    stream = s.stream(10)
+    f = minibatch_fn(stream)
+
+    # the error of the reader is raised by the training function, and
+    # the stream is closed
+    with pytest.raises(IOError):
+        f(0)
+    assert stream.thread is None